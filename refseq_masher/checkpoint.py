@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+
+"""Per-sample checkpointing of results for resumable batch runs
+
+Each finished sample's results table is atomically persisted to a checkpoint
+directory along with an append-only journal of completed samples. Journal
+entries are keyed by a fingerprint of the command, the result-affecting
+options, the sample name and the size and modification time of each input
+file, so a rerun with the same options and inputs skips completed samples
+while any change to an input or option causes that sample to be recomputed.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from typing import Callable, Dict, List, Optional
+
+import pandas as pd
+
+from . import __version__
+
+#: Journal of completed samples filename within a checkpoint directory
+JOURNAL_FILENAME = 'journal.jsonl'
+
+
+def _atomic_write_pickle(df: pd.DataFrame, path: str) -> None:
+    tmp_path = '{}.tmp-{}'.format(path, os.getpid())
+    try:
+        df.to_pickle(tmp_path)
+        with open(tmp_path, 'rb') as f:
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+class CheckpointJournal:
+    """Journal of completed samples and their persisted results in a checkpoint directory
+
+    Args:
+        checkpoint_dir: Directory to persist per-sample results and the journal to (created if missing)
+        command: Name of the command being checkpointed (e.g. "matches")
+        options: Result-affecting command options; changing any of these invalidates prior checkpoints
+    """
+
+    def __init__(self, checkpoint_dir: str, command: str, options: Dict):
+        self.checkpoint_dir = os.path.abspath(checkpoint_dir)
+        self.command = command
+        self.options = options
+        self.journal_path = os.path.join(self.checkpoint_dir, JOURNAL_FILENAME)
+        os.makedirs(self.checkpoint_dir, exist_ok=True)
+        #: serializes journal appends from concurrently run samples
+        self._lock = threading.Lock()
+        self.completed = self._read_journal()
+        logging.info('Checkpoint journal "%s" has %s completed samples', self.journal_path, len(self.completed))
+
+    def _read_journal(self) -> Dict[str, Dict]:
+        completed = {}
+        if not os.path.exists(self.journal_path):
+            return completed
+        with open(self.journal_path) as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # partially written last line from an interrupted run
+                    logging.warning('Skipping malformed checkpoint journal line: %s', line.strip())
+                    continue
+                result = entry.get('result')
+                if result is not None and not os.path.exists(os.path.join(self.checkpoint_dir, result)):
+                    logging.warning('Checkpoint result file "%s" for sample "%s" is missing. Sample will be rerun.',
+                                    result, entry.get('sample'))
+                    continue
+                completed[entry['key']] = entry
+        return completed
+
+    def fingerprint(self, sample_name: str, input_paths: List[str]) -> str:
+        """Fingerprint a sample by command, options, sample name and input file paths, sizes and mtimes
+
+        Args:
+            sample_name: Sample name
+            input_paths: Sample input file paths
+
+        Returns:
+            (str): hex digest identifying the sample's inputs and analysis options
+        """
+        inputs = []
+        for path in input_paths:
+            st = os.stat(path)
+            inputs.append([os.path.abspath(path), st.st_size, st.st_mtime_ns])
+        payload = json.dumps(dict(version=__version__,
+                                  command=self.command,
+                                  options=self.options,
+                                  sample=sample_name,
+                                  inputs=inputs),
+                             sort_keys=True)
+        return hashlib.sha1(payload.encode()).hexdigest()
+
+    def is_completed(self, key: str) -> bool:
+        return key in self.completed
+
+    def load(self, key: str) -> Optional[pd.DataFrame]:
+        """Load the persisted results for a completed sample
+
+        Returns:
+            (pd.DataFrame): persisted sample results or None if the sample had no results
+        """
+        result = self.completed[key].get('result')
+        if result is None:
+            return None
+        return pd.read_pickle(os.path.join(self.checkpoint_dir, result))
+
+    def save(self, key: str, sample_name: str, df: Optional[pd.DataFrame]) -> None:
+        """Atomically persist a sample's results then record the sample as completed in the journal
+
+        Args:
+            key: Sample fingerprint
+            sample_name: Sample name
+            df: Sample results or None if there were no results
+        """
+        result = None
+        if df is not None:
+            result = key + '.pkl'
+            _atomic_write_pickle(df, os.path.join(self.checkpoint_dir, result))
+        entry = dict(key=key, sample=sample_name, result=result, time=time.time())
+        with self._lock:
+            with open(self.journal_path, 'a') as f:
+                f.write(json.dumps(entry) + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+            self.completed[key] = entry
+        logging.info('Checkpointed results for sample "%s" to "%s"', sample_name, self.checkpoint_dir)
+
+
+def checkpointed(journal: Optional[CheckpointJournal],
+                 sample_name: str,
+                 input_paths: List[str],
+                 func: Callable[[], Optional[pd.DataFrame]]) -> Optional[pd.DataFrame]:
+    """Get a sample's results from the checkpoint journal or compute and checkpoint them
+
+    Args:
+        journal: Checkpoint journal or None if checkpointing is disabled
+        sample_name: Sample name
+        input_paths: Sample input file paths
+        func: Function computing the sample's results
+
+    Returns:
+        (pd.DataFrame): sample results or None if there were no results
+    """
+    if journal is None:
+        return func()
+    key = journal.fingerprint(sample_name, input_paths)
+    if journal.is_completed(key):
+        logging.info('Sample "%s" already completed. Loading results from checkpoint.', sample_name)
+        return journal.load(key)
+    df = func()
+    journal.save(key, sample_name, df)
+    return df
@@ -8,16 +8,31 @@ sketch database of 54,925 genomes that were Mash sketched at k=16, s=400.
 
 import click
 import logging
+import tempfile
 from typing import List
 
 import pandas as pd
 
 import refseq_masher.mash.dist as mash_dist
 import refseq_masher.mash.screen as mash_screen
-from .const import MASH_DIST_ORDERED_COLUMNS, MASH_SCREEN_ORDERED_COLUMNS
-from .taxonomy import merge_ncbi_taxonomy_info
-from .utils import collect_inputs, init_console_logger, order_output_columns
-from .writers import write_dataframe, OUTPUT_TYPES
+import refseq_masher.mash.native_screen as native_screen
+import refseq_masher.mash.classify as mash_classify
+from .mash.native_dist import check_fast_rankings
+from .mash.parser import MASH_DIST_4_COLUMNS, MASH_SCREEN_COLUMNS, REFSEQ_INFO_COLUMNS
+from .mash.index import refseq_hash_index
+from .mash.cluster import DEFAULT_CLUSTER_MAX_DISTANCE, refseq_clusters
+from .mash.sketchdb import refseq_sketch_db
+from .mash.pairwise import PairwiseDist, sketch_samples
+from .checkpoint import CheckpointJournal, checkpointed
+from .watch import FolderWatcher, StreamingClassifier, WATCH_MODES, watch_updates
+from .const import MASH_DIST_ORDERED_COLUMNS, MASH_SCREEN_ORDERED_COLUMNS, CLASSIFY_ORDERED_COLUMNS
+from .taxonomy import merge_ncbi_taxonomy_info, ncbi_taxonomy_info, drop_na_taxonomy_columns, \
+    NCBI_TAXID_INFO_COLUMNS
+from .memory import available_memory, parse_memory_size
+from .store import STORE_TABLES, ResultsStore, store_results
+from .utils import bounded_imap, collect_inputs, concat_results, init_console_logger, order_output_columns, \
+    pipelined
+from .writers import write_dataframe, write_dataframe_chunks, OUTPUT_TYPES
 from .utils import exc_exists
 
 SCRIPT_NAME = 'refseq_masher'
@@ -33,6 +48,39 @@ def validate_mash_binary_exists(ctx, param, value):
                                  'Please install Mash to your $PATH'.format(value))
 
 
+def output_columns(command: str) -> List[str]:
+    """All output columns of the `matches` or `contains` command"""
+    mash_columns = MASH_DIST_4_COLUMNS if command == 'matches' else MASH_SCREEN_COLUMNS
+    columns = ['sample'] + mash_columns + REFSEQ_INFO_COLUMNS + NCBI_TAXID_INFO_COLUMNS
+    return [col for i, col in enumerate(columns) if col not in columns[:i]]
+
+
+def validate_columns(ctx, param, value):
+    if value is None:
+        return None
+    columns = [col.strip() for col in value.split(',') if col.strip()]
+    valid_columns = output_columns(ctx.command.name)
+    unknown = [col for col in columns if col not in valid_columns]
+    if not columns or unknown:
+        raise click.BadParameter('Unknown output columns {}. Expected any of: {}'.format(unknown,
+                                                                                         ','.join(valid_columns)))
+    return columns
+
+
+def validate_memory_size(ctx, param, value):
+    if value is None:
+        return None
+    if value == 'auto':
+        memory = available_memory()
+        if memory is None:
+            raise click.BadParameter('Could not determine the available memory. Please specify a memory size')
+        return memory
+    try:
+        return parse_memory_size(value)
+    except ValueError as ex:
+        raise click.BadParameter(str(ex))
+
+
 @click.group(context_settings=CONTEXT_SETTINGS)
 @click.version_option()
 @click.option('-v', '--verbose', count=True,
@@ -63,40 +111,144 @@ def cli(verbose):
               type=click.Path(exists=True, file_okay=False, dir_okay=True, writable=True),
               default='/tmp',
               help='Temporary analysis files path (where to save temp Mash sketch file) (default="/tmp")')
+@click.option('--engine', default='mash',
+              type=click.Choice(['mash', 'native']),
+              help='Distance engine: "mash" runs Mash dist for each sample; "native" only compares against '
+                   'RefSeq genomes sharing hashes with the sample using an inverted hash index (default="mash")')
+@click.option('--fast', is_flag=True,
+              help='Coarse-to-fine search (implies "--engine native"): score against bottom-50 downsampled RefSeq '
+                   'sketches first and only rescore the best candidates at full resolution')
+@click.option('--fast-candidates', default=300, type=int,
+              help='Fast mode: number of best coarse-scored RefSeq genomes to rescore at full resolution '
+                   '(default=300)')
+@click.option('--fast-tolerance', default=0.5, type=float,
+              help='Fast mode: warn if any reported match was ranked beyond this fraction of '
+                   '--fast-candidates by the coarse search (default=0.5)')
+@click.option('--clustered', is_flag=True,
+              help='Search RefSeq cluster representatives first (implies "--engine native") and only compute '
+                   'distances to the members of the best matching clusters')
+@click.option('--cluster-max-distance', default=DEFAULT_CLUSTER_MAX_DISTANCE, type=float,
+              help='Clustered mode: max Mash distance of cluster members to their representative '
+                   '(default={})'.format(DEFAULT_CLUSTER_MAX_DISTANCE))
+@click.option('--sketcher',
+              type=click.Choice(mash_dist.SKETCHERS),
+              help='Sample sketcher: "mash" runs Mash sketch; "native" sketches in-process without a Mash sketch '
+                   'file round-trip for the in-process engines (default="native" for in-process engines, '
+                   'otherwise "mash")')
+@click.option('--checkpoint-dir',
+              type=click.Path(exists=False, file_okay=False, dir_okay=True, writable=True),
+              help='Persist each finished sample\'s results to this directory so that a rerun with the '
+                   'same options skips completed samples')
+@click.option('--store',
+              type=click.Path(exists=False, dir_okay=False, writable=True),
+              help='Also append results to this SQLite results store (created if missing) for later lookups '
+                   'with "refseq_masher query"')
+@click.option('-q', '--queue-depth', default=2, type=int,
+              help='Max number of samples waiting between pipeline stages (sketch, dist, parse, taxonomy merge), '
+                   'which run concurrently on consecutive samples; 0 runs all stages of a sample before the next '
+                   'one (default=2)')
+@click.option('--columns',
+              callback=validate_columns,
+              help='Comma-separated output columns, e.g. "sample,top_taxonomy_name,distance,taxid"; only these are '
+                   'parsed, merged and written (default: all)')
 @click.argument('input', type=click.Path(exists=True), nargs=-1, required=True)
-def matches(mash_bin, output, output_type, top_n_results, min_kmer_threshold, tmp_dir, input):
+def matches(mash_bin, output, output_type, top_n_results, min_kmer_threshold, tmp_dir, engine, fast,
+            fast_candidates, fast_tolerance, clustered, cluster_max_distance, sketcher, checkpoint_dir, store,
+            queue_depth, columns, input):
     """Find NCBI RefSeq genome matches for an input genome fasta file
 
     Input is expected to be one or more FASTA/FASTQ files or one or more
     directories containing FASTA/FASTQ files. Files can be Gzipped.
     """
-    dfs = []  # type: List[pd.DataFrame]
     contigs, reads = collect_inputs(input)
     logging.debug('contigs: %s', contigs)
     logging.debug('reads: %s', reads)
-    for fasta_path, sample_name in contigs:
-        df = mash_dist.fasta_vs_refseq(fasta_path,
-                                       mash_bin=mash_bin,
+    if fast and clustered:
+        raise click.UsageError('--fast and --clustered cannot be used together')
+    engine_opts = {}
+    if clustered:
+        engine = 'clustered'
+        engine_opts['cluster_max_distance'] = cluster_max_distance
+        engine_opts['top_n'] = top_n_results if top_n_results > 0 else 5
+    if fast:
+        engine = 'fast'
+        engine_opts['fast_candidates'] = fast_candidates
+        if top_n_results <= 0 or top_n_results > fast_candidates:
+            logging.warning('Fast mode only reports the top %s coarse candidates rescored at full resolution',
+                            fast_candidates)
+    sketcher = sketcher or mash_dist.default_sketcher(engine)
+    journal = None
+    if checkpoint_dir:
+        options = dict(top_n_results=top_n_results,
+                       min_kmer_threshold=min_kmer_threshold,
+                       engine=engine,
+                       engine_opts=engine_opts,
+                       sketcher=sketcher)
+        if columns is not None:
+            # checkpointed results only have the requested columns
+            options['columns'] = columns
+        journal = CheckpointJournal(checkpoint_dir, 'matches', options)
+
+    def sketch(sample):
+        inputs, sample_name, is_reads = sample
+        key = None
+        if journal is not None:
+            key = journal.fingerprint(sample_name, inputs if is_reads else [inputs])
+            if journal.is_completed(key):
+                logging.info('Sample "%s" already completed. Loading results from checkpoint.', sample_name)
+                return sample_name, key, True, journal.load(key)
+        query = mash_dist.sketch_query(inputs,
+                                       reads=is_reads,
                                        sample_name=sample_name,
-                                       tmp_dir=tmp_dir)
-        if top_n_results > 0:
-            df = df.head(top_n_results)
-        dfs.append(df)
-    for fastq_paths, sample_name in reads:
-        df = mash_dist.fastq_vs_refseq(fastq_paths,
                                        mash_bin=mash_bin,
-                                       sample_name=sample_name,
+                                       # own directory per sample so that samples with the same name in
+                                       # flight at the same time do not share a sketch file
+                                       tmp_dir=tempfile.mkdtemp(dir=sketch_dir),
                                        m=min_kmer_threshold,
-                                       tmp_dir=tmp_dir)
+                                       engine=engine,
+                                       sketcher=sketcher)
+        return sample_name, key, False, query
+
+    def dist(job):
+        sample_name, key, done, query = job
+        if done:
+            return job
+        output = mash_dist.dist_query(query, mash_bin=mash_bin, engine=engine, engine_opts=engine_opts,
+                                      columns=columns)
+        return sample_name, key, False, output
+
+    def parse(job):
+        sample_name, key, done, output = job
+        if done:
+            return output
+        df = mash_dist.parse_dist_output(output, columns=columns)
+        df['sample'] = sample_name
+        logging.info('Parsed Mash dist output for sample "%s" into DataFrame with %s rows', sample_name, df.shape[0])
         if top_n_results > 0:
             df = df.head(top_n_results)
-        dfs.append(df)
-    logging.info('Ran Mash dist on all input. Merging NCBI taxonomic information into results output.')
-    dfout = merge_ncbi_taxonomy_info(pd.concat(dfs))
-    logging.info('Merged taxonomic info into results output')
+        if fast:
+            df = check_fast_rankings(df, fast_candidates, fast_tolerance)
+        if journal is not None:
+            journal.save(key, sample_name, df)
+        return df
+
+    def merge_taxonomy(df):
+        return merge_ncbi_taxonomy_info(df, ncbi_taxonomy_info(df.taxid, drop_na_columns=False, columns=columns),
+                                        columns=columns)
+
+    samples = [(fasta_path, sample_name, False) for fasta_path, sample_name in contigs]
+    samples += [(fastq_paths, sample_name, True) for fastq_paths, sample_name in reads]
+    # temporary sketch files of samples still in the pipeline are removed with this directory even if a stage fails
+    with tempfile.TemporaryDirectory(prefix='refseq_masher-', dir=tmp_dir) as sketch_dir:
+        dfs = list(pipelined(samples, [sketch, dist, parse, merge_taxonomy], queue_depth=queue_depth))
+    logging.info('Ran Mash dist on all input and merged NCBI taxonomic information into results output.')
+    dfout = drop_na_taxonomy_columns(concat_results(dfs))
     logging.info('Reordering output columns')
-    dfout = order_output_columns(dfout, MASH_DIST_ORDERED_COLUMNS)
+    dfout = order_output_columns(dfout, MASH_DIST_ORDERED_COLUMNS, columns)
     write_dataframe(dfout, output, output_type)
+    store_results(store, 'matches', dfout, dict(engine=engine, engine_opts=engine_opts, sketcher=sketcher,
+                                                top_n_results=top_n_results, min_kmer_threshold=min_kmer_threshold,
+                                                columns=columns))
 
 
 @cli.command()
@@ -117,8 +269,33 @@ def matches(mash_bin, output, output_type, top_n_results, min_kmer_threshold, tm
               help='Mash screen max p-value to report (default=0.01)')
 @click.option('-p', '--parallelism', default=1, type=int,
               help='Mash screen parallelism; number of threads to spawn (default=1)')
+@click.option('-j', '--jobs', default=1, type=int,
+              help='Number of samples screened concurrently (default=1)')
+@click.option('--max-memory',
+              callback=validate_memory_size,
+              help='Mash screen engine: only start a sample\'s Mash screen while the estimated memory use of all '
+                   'running Mash screen jobs fits this budget, e.g. "16G", or "auto" for the available memory; '
+                   'estimates are learned from the peak memory use of finished jobs and the budget is capped by '
+                   'the available memory and cgroup limit')
+@click.option('--engine', default='mash',
+              type=click.Choice(['mash', 'native']),
+              help='Screen engine: "mash" runs Mash screen for each sample; "native" screens all samples '
+                   'in-process against the RefSeq sketches loaded once (default="mash")')
+@click.option('--checkpoint-dir',
+              type=click.Path(exists=False, file_okay=False, dir_okay=True, writable=True),
+              help='Persist each finished sample\'s results to this directory so that a rerun with the '
+                   'same options skips completed samples')
+@click.option('--store',
+              type=click.Path(exists=False, dir_okay=False, writable=True),
+              help='Also append results to this SQLite results store (created if missing) for later lookups '
+                   'with "refseq_masher query"')
+@click.option('--columns',
+              callback=validate_columns,
+              help='Comma-separated output columns, e.g. "sample,top_taxonomy_name,identity,taxid"; only these are '
+                   'parsed, merged and written (default: all)')
 @click.argument('input', type=click.Path(exists=True), nargs=-1, required=True)
-def contains(mash_bin, output, output_type, top_n_results, min_identity, max_pvalue, parallelism, input):
+def contains(mash_bin, output, output_type, top_n_results, min_identity, max_pvalue, parallelism, jobs, max_memory,
+             engine, checkpoint_dir, store, columns, input):
     """Find the NCBI RefSeq genomes contained in your sequence files using Mash Screen
 
     Input is expected to be one or more FASTA/FASTQ files or one or more
@@ -126,29 +303,378 @@ def contains(mash_bin, output, output_type, top_n_results, min_identity, max_pva
     """
     dfs = []
     contigs, reads = collect_inputs(input)
+    journal = None
+    if checkpoint_dir:
+        options = dict(top_n_results=top_n_results,
+                       min_identity=min_identity,
+                       max_pvalue=max_pvalue,
+                       engine=engine)
+        if columns is not None:
+            # checkpointed results only have the requested columns
+            options['columns'] = columns
+        journal = CheckpointJournal(checkpoint_dir, 'contains', options)
+    screen_opts = {}
+    if engine == 'native':
+        if max_memory is not None:
+            raise click.UsageError('--max-memory only applies to the Mash screen engine ("--engine mash")')
+        screen_vs_refseq = native_screen.vs_refseq
+    else:
+        screen_vs_refseq = mash_screen.vs_refseq
+        if max_memory is not None:
+            screen_opts['admission'] = mash_screen.screen_memory_admission(max_memory)
+
+    def run_screen(input_paths, sample_name):
+        df = screen_vs_refseq(inputs=input_paths,
+                              mash_bin=mash_bin,
+                              sample_name=sample_name,
+                              max_pvalue=max_pvalue,
+                              min_identity=min_identity,
+                              parallelism=parallelism,
+                              columns=columns,
+                              **screen_opts)
+        if df is not None and top_n_results > 0:
+            df = df.head(top_n_results)
+        return df
 
-    for input_paths, sample_name in (contigs + reads):
-        df = mash_screen.vs_refseq(inputs=input_paths,
-                                   mash_bin=mash_bin,
-                                   sample_name=sample_name,
-                                   max_pvalue=max_pvalue,
-                                   min_identity=min_identity,
-                                   parallelism=parallelism)
+    def run_sample(sample):
+        input_paths, sample_name = sample
+        paths = input_paths if isinstance(input_paths, list) else [input_paths]
+        return checkpointed(journal, sample_name, paths,
+                            lambda: run_screen(input_paths, sample_name))
 
+    for df in bounded_imap(run_sample, contigs + reads, n_workers=jobs):
         if df is not None:
-            if top_n_results > 0:
-                df = df.head(top_n_results)
             dfs.append(df)
 
     logging.info('Ran Mash Screen on all input.')
 
     if len(dfs) > 0:
         logging.info('Merging NCBI taxonomic information into results output.')
-        dfout = merge_ncbi_taxonomy_info(pd.concat(dfs))
+        dfout = merge_ncbi_taxonomy_info(concat_results(dfs), columns=columns)
         logging.info('Merged taxonomic information into results output')
         logging.info('Reordering output columns')
-        dfout = order_output_columns(dfout, MASH_SCREEN_ORDERED_COLUMNS)
+        dfout = order_output_columns(dfout, MASH_SCREEN_ORDERED_COLUMNS, columns)
         write_dataframe(dfout, output_path=output, output_type=output_type)
 
     else:
         logging.info('There were no matches found.')
+        dfout = None
+    store_results(store, 'contains', dfout, dict(engine=engine, top_n_results=top_n_results,
+                                                 min_identity=min_identity, max_pvalue=max_pvalue,
+                                                 columns=columns))
+
+
+@cli.command()
+@click.option('--mash-bin', default='mash',
+              callback=validate_mash_binary_exists,
+              help='Mash binary path (default="mash")')
+@click.option('-o', '--output', default='-',
+              type=click.Path(exists=False, writable=True),
+              help='Output file path (default="-"/stdout)')
+@click.option('--output-type', default='tab',
+              type=click.Choice(OUTPUT_TYPES.keys()),
+              help='Output file type ({})'.format('|'.join(OUTPUT_TYPES.keys())))
+@click.option('-f', '--output-format', default='matrix',
+              type=click.Choice(['matrix', 'edges']),
+              help='"matrix": dense sample by sample distance matrix; "edges": sample pairs within --max-distance '
+                   '(default="matrix")')
+@click.option('-d', '--max-distance', default=0.05, type=float,
+              help='Edge list: max Mash distance of reported sample pairs (default=0.05)')
+@click.option('-b', '--block-size', default=500, type=int,
+              help='Number of samples per block of the distance matrix computed at once; bounds memory use '
+                   '(default=500)')
+@click.option('-m', '--min-kmer-threshold', type=int, default=8,
+              help='Mash sketch of reads: "Minimum copies of each k-mer '
+                   'required to pass noise filter for reads" (default=8)')
+@click.option('-T', '--tmp-dir',
+              type=click.Path(exists=True, file_okay=False, dir_okay=True, writable=True),
+              default='/tmp',
+              help='Temporary analysis files path (where to save temp Mash sketch file) (default="/tmp")')
+@click.option('-p', '--parallelism', default=1, type=int,
+              help='Number of samples sketched and distance matrix row blocks computed concurrently (default=1)')
+@click.option('--sketcher', default='native',
+              type=click.Choice(mash_dist.SKETCHERS),
+              help='Sample sketcher: "native" sketches in-process; "mash" runs Mash sketch (default="native")')
+@click.argument('input', type=click.Path(exists=True), nargs=-1, required=True)
+def pairwise(mash_bin, output, output_type, output_format, max_distance, block_size, min_kmer_threshold, tmp_dir,
+             parallelism, sketcher, input):
+    """Compute Mash distances between all pairs of input samples
+
+    Samples are Mash sketched as for "matches" and compared all-vs-all to
+    spot sample swaps and cross-contamination. Input is expected to be one
+    or more FASTA/FASTQ files or one or more directories containing
+    FASTA/FASTQ files. Files can be Gzipped.
+    """
+    contigs, reads = collect_inputs(input)
+    db = sketch_samples(contigs, reads,
+                        mash_bin=mash_bin,
+                        tmp_dir=tmp_dir,
+                        m=min_kmer_threshold,
+                        parallelism=parallelism,
+                        sketcher=sketcher)
+    dist = PairwiseDist(db, block_size=block_size, parallelism=parallelism)
+    if output_format == 'edges':
+        blocks = dist.edge_blocks(max_distance=max_distance)
+    else:
+        blocks = dist.matrix_blocks()
+    write_dataframe_chunks(blocks, output, output_type)
+
+
+@cli.command()
+@click.option('--mash-bin', default='mash',
+              callback=validate_mash_binary_exists,
+              help='Mash binary path (default="mash")')
+@click.option('--mode', default='matches',
+              type=click.Choice(WATCH_MODES),
+              help='"matches": closest RefSeq genomes to each sample\'s running Mash sketch; "contains": RefSeq '
+                   'genomes contained in each sample\'s reads so far (default="matches")')
+@click.option('-o', '--output', default='-',
+              type=click.Path(exists=False, writable=True),
+              help='Output file path (default="-"/stdout)')
+@click.option('--output-type', default='tab',
+              type=click.Choice(OUTPUT_TYPES.keys()),
+              help='Output file type ({})'.format('|'.join(OUTPUT_TYPES.keys())))
+@click.option('-n', '--top-n-results', default=5, type=int,
+              help='Output top N results of a sample after each new file (default=5)')
+@click.option('-m', '--min-kmer-threshold', type=int, default=8,
+              help='Matches: "Minimum copies of each k-mer required to pass noise filter for reads" (default=8)')
+@click.option('-i', '--min-identity', default=0.9, type=float,
+              help='Contains: Mash screen min identity to report (default=0.9)')
+@click.option('-v', '--max-pvalue', default=0.01, type=float,
+              help='Contains: Mash screen max p-value to report (default=0.01)')
+@click.option('-p', '--parallelism', default=1, type=int,
+              help='Number of k-mer hashing threads (default=1)')
+@click.option('--interval', default=10.0, type=float,
+              help='Seconds between checks for new FASTQ files (default=10)')
+@click.option('--idle-timeout', default=0.0, type=float,
+              help='Stop after this many seconds without new FASTQ files (default=0/watch until interrupted)')
+@click.argument('directory', type=click.Path(exists=True, file_okay=False, dir_okay=True))
+def watch(mash_bin, mode, output, output_type, top_n_results, min_kmer_threshold, min_identity, max_pvalue,
+          parallelism, interval, idle_timeout, directory):
+    """Classify reads of a live sequencing run as FASTQ files appear in a directory
+
+    Each new FASTQ file is folded into its sample's running state without
+    re-reading earlier files and the sample's updated top hits are output
+    with the number of files and bases seen so far. FASTQ files in a
+    subdirectory (e.g. "barcode01/") belong to the sample named after the
+    subdirectory. Uses the native in-process engines.
+    """
+    classifier = StreamingClassifier(mode=mode,
+                                     mash_bin=mash_bin,
+                                     top_n_results=top_n_results,
+                                     min_kmer_threshold=min_kmer_threshold,
+                                     min_identity=min_identity,
+                                     max_pvalue=max_pvalue,
+                                     parallelism=parallelism)
+    watcher = FolderWatcher(directory, interval=interval)
+    write_dataframe_chunks(watch_updates(watcher, classifier, idle_timeout=idle_timeout), output, output_type)
+
+
+@cli.command()
+@click.option('--mash-bin', default='mash',
+              callback=validate_mash_binary_exists,
+              help='Mash binary path (default="mash")')
+@click.option('-o', '--output',
+              type=click.Path(exists=False, writable=True),
+              help='Joined matches and contains report output file path (default="-"/stdout unless '
+                   '--matches-output or --contains-output are given)')
+@click.option('--matches-output',
+              type=click.Path(exists=False, writable=True),
+              help='Matches (Mash dist) results output file path')
+@click.option('--contains-output',
+              type=click.Path(exists=False, writable=True),
+              help='Contains (Mash screen) results output file path')
+@click.option('--output-type', default='tab',
+              type=click.Choice(OUTPUT_TYPES.keys()),
+              help='Output file type ({})'.format('|'.join(OUTPUT_TYPES.keys())))
+@click.option('-n', '--top-n-matches', default=5, type=int,
+              help='Output top N matches sorted by distance in ascending order (default=5)')
+@click.option('-N', '--top-n-contains', default=0, type=int,
+              help='Output top N contained genomes sorted by identity in descending order (default=0/all)')
+@click.option('-m', '--min-kmer-threshold', type=int, default=8,
+              help='Mash sketch of reads: "Minimum copies of each k-mer '
+                   'required to pass noise filter for reads" (default=8)')
+@click.option('-i', '--min-identity', default=0.9, type=float,
+              help='Mash screen min identity to report (default=0.9)')
+@click.option('-v', '--max-pvalue', default=0.01, type=float,
+              help='Mash screen max p-value to report (default=0.01)')
+@click.option('-p', '--parallelism', default=1, type=int,
+              help='Mash screen parallelism or number of native k-mer hashing threads (default=1)')
+@click.option('-T', '--tmp-dir',
+              type=click.Path(exists=True, file_okay=False, dir_okay=True, writable=True),
+              default='/tmp',
+              help='Temporary analysis files path (where to save temp Mash sketch file) (default="/tmp")')
+@click.option('--engine', default='mash',
+              type=click.Choice(mash_classify.CLASSIFY_ENGINES),
+              help='"mash" runs Mash sketch and Mash screen on one decompressed stream of each sample; "native" '
+                   'hashes each sample\'s k-mers once for the in-process dist and screen engines (default="mash")')
+@click.option('--store',
+              type=click.Path(exists=False, dir_okay=False, writable=True),
+              help='Also append the matches and contains results to this SQLite results store (created if '
+                   'missing) for later lookups with "refseq_masher query"')
+@click.argument('input', type=click.Path(exists=True), nargs=-1, required=True)
+def classify(mash_bin, output, matches_output, contains_output, output_type, top_n_matches, top_n_contains,
+             min_kmer_threshold, min_identity, max_pvalue, parallelism, tmp_dir, engine, store, input):
+    """Find both the closest matching and the contained NCBI RefSeq genomes reading each input once
+
+    Runs the equivalent of "matches" and "contains" while reading and
+    decompressing each input once and merging taxonomic information once.
+    Outputs a report joining both results on sample and RefSeq genome
+    and/or the separate matches and contains tables.
+
+    Input is expected to be one or more FASTA/FASTQ files or one or more
+    directories containing FASTA/FASTQ files. Files can be Gzipped.
+    """
+    if output is None and matches_output is None and contains_output is None:
+        output = '-'
+    contigs, reads = collect_inputs(input)
+    samples = [([fasta_path], sample_name, False) for fasta_path, sample_name in contigs] \
+        + [(fastq_paths, sample_name, True) for fastq_paths, sample_name in reads]
+    dfs_dist = []
+    dfs_screen = []
+    dfs_joined = []
+    for input_paths, sample_name, is_reads in samples:
+        if engine == 'native':
+            df_dist, df_screen = mash_classify.native_sketch_and_screen(input_paths, is_reads,
+                                                                        mash_bin=mash_bin,
+                                                                        sample_name=sample_name,
+                                                                        m=min_kmer_threshold,
+                                                                        max_pvalue=max_pvalue,
+                                                                        min_identity=min_identity,
+                                                                        parallelism=parallelism)
+        else:
+            df_dist, df_screen = mash_classify.mash_sketch_and_screen(input_paths, is_reads,
+                                                                      mash_bin=mash_bin,
+                                                                      sample_name=sample_name,
+                                                                      tmp_dir=tmp_dir,
+                                                                      m=min_kmer_threshold,
+                                                                      max_pvalue=max_pvalue,
+                                                                      min_identity=min_identity,
+                                                                      parallelism=parallelism)
+        df_dist['sample'] = sample_name
+        if top_n_matches > 0:
+            df_dist = df_dist.head(top_n_matches)
+        dfs_dist.append(df_dist)
+        if df_screen is not None:
+            df_screen['sample'] = sample_name
+            if top_n_contains > 0:
+                df_screen = df_screen.head(top_n_contains)
+            dfs_screen.append(df_screen)
+        dfs_joined.append(mash_classify.join_results(df_dist, df_screen))
+
+    logging.info('Ran Mash dist and Mash screen on all input. Merging NCBI taxonomic information into results.')
+    df_dist = concat_results(dfs_dist)
+    df_screen = concat_results(dfs_screen) if len(dfs_screen) > 0 else None
+    taxids = df_dist.taxid if df_screen is None else pd.concat([df_dist.taxid, df_screen.taxid])
+    df_tax_info = ncbi_taxonomy_info(taxids)
+    if matches_output or store:
+        dfout = order_output_columns(merge_ncbi_taxonomy_info(df_dist, df_tax_info), MASH_DIST_ORDERED_COLUMNS)
+        if matches_output:
+            write_dataframe(dfout, matches_output, output_type)
+        store_results(store, 'matches', dfout, dict(command='classify', engine=engine, top_n_results=top_n_matches,
+                                                    min_kmer_threshold=min_kmer_threshold))
+    if contains_output or store:
+        if df_screen is not None:
+            dfout = order_output_columns(merge_ncbi_taxonomy_info(df_screen, df_tax_info),
+                                         MASH_SCREEN_ORDERED_COLUMNS)
+            if contains_output:
+                write_dataframe(dfout, contains_output, output_type)
+        else:
+            logging.info('There were no Mash screen matches found.')
+            dfout = None
+        store_results(store, 'contains', dfout, dict(command='classify', engine=engine,
+                                                     top_n_results=top_n_contains, min_identity=min_identity,
+                                                     max_pvalue=max_pvalue))
+    if output:
+        dfout = merge_ncbi_taxonomy_info(concat_results(dfs_joined), df_tax_info)
+        write_dataframe(order_output_columns(dfout, CLASSIFY_ORDERED_COLUMNS), output, output_type)
+
+
+@cli.command()
+@click.option('-t', '--table', default='matches',
+              type=click.Choice(STORE_TABLES),
+              help='Results to query (default="matches")')
+@click.option('-s', '--sample', multiple=True,
+              help='Only results of this sample (may be given several times)')
+@click.option('--taxid', multiple=True, type=int,
+              help='Only results for this NCBI taxonomy UID (may be given several times)')
+@click.option('-a', '--assembly-accession', multiple=True,
+              help='Only results for this RefSeq assembly accession (may be given several times)')
+@click.option('--since',
+              help='Only results of runs at or after this UTC date/time, e.g. "2024-01-31" or "2024-01-31 12:00:00"')
+@click.option('--until',
+              help='Only results of runs at or before this UTC date/time (a date includes the whole day)')
+@click.option('-r', '--run-id', multiple=True, type=int,
+              help='Only results of this run (may be given several times)')
+@click.option('--runs', is_flag=True,
+              help='List the recorded runs instead of results')
+@click.option('-n', '--limit', default=0, type=int,
+              help='Max number of results to output (default=0/all)')
+@click.option('-o', '--output', default='-',
+              type=click.Path(exists=False, writable=True),
+              help='Output file path (default="-"/stdout)')
+@click.option('--output-type', default='tab',
+              type=click.Choice(OUTPUT_TYPES.keys()),
+              help='Output file type ({})'.format('|'.join(OUTPUT_TYPES.keys())))
+@click.argument('store', type=click.Path(exists=True, dir_okay=False))
+def query(table, sample, taxid, assembly_accession, since, until, run_id, runs, limit, output, output_type, store):
+    """Look up results stored with "--store" in a SQLite results store
+
+    Filters are combined, e.g. all samples that hit taxid 28901 since the
+    start of the month:
+
+    refseq_masher query --taxid 28901 --since 2024-01-01 results.db
+    """
+    with ResultsStore(store) as results_store:
+        if runs:
+            df = results_store.runs()
+        else:
+            df = results_store.query(table,
+                                     samples=sample,
+                                     taxids=taxid,
+                                     assembly_accessions=assembly_accession,
+                                     since=since,
+                                     until=until,
+                                     run_ids=run_id,
+                                     limit=limit)
+    logging.info('Found %s stored results', df.shape[0])
+    write_dataframe(df, output, output_type)
+
+
+@cli.command('build-index')
+@click.option('--mash-bin', default='mash',
+              callback=validate_mash_binary_exists,
+              help='Mash binary path (default="mash")')
+def build_index(mash_bin):
+    """Decode the RefSeq sketch database and build its inverted hash index for the native engines
+
+    The decoded sketches and index are cached under $REFSEQ_MASHER_CACHE_DIR
+    (default="~/.cache/refseq_masher") and memory-mapped by later runs.
+    """
+    index = refseq_hash_index(mash_bin)
+    logging.info('RefSeq inverted hash index ready with %s distinct hashes', index.hashes.size)
+
+
+@cli.command()
+@click.option('--mash-bin', default='mash',
+              callback=validate_mash_binary_exists,
+              help='Mash binary path (default="mash")')
+@click.option('-d', '--max-distance', default=DEFAULT_CLUSTER_MAX_DISTANCE, type=float,
+              help='Max Mash distance of cluster members to their representative '
+                   '(default={})'.format(DEFAULT_CLUSTER_MAX_DISTANCE))
+@click.option('-o', '--output', default='-',
+              type=click.Path(exists=False, writable=True),
+              help='Output file path (default="-"/stdout)')
+@click.option('--output-type', default='tab',
+              type=click.Choice(OUTPUT_TYPES.keys()),
+              help='Output file type ({})'.format('|'.join(OUTPUT_TYPES.keys())))
+def cluster(mash_bin, max_distance, output, output_type):
+    """Cluster near-identical RefSeq genome sketches for "matches --clustered"
+
+    The clusters are cached alongside the decoded RefSeq sketches. Outputs
+    the cluster, representative and distance to the representative of each
+    RefSeq genome.
+    """
+    clusters = refseq_clusters(mash_bin, max_distance)
+    logging.info('%s RefSeq genomes in %s clusters', clusters.assignments.size, len(clusters))
+    write_dataframe(clusters.to_dataframe(refseq_sketch_db(mash_bin)), output, output_type)
@@ -1,5 +1,6 @@
 # -*- coding: utf-8 -*-
 
+import os
 import re
 from pkg_resources import resource_filename
 
@@ -7,6 +8,16 @@ from . import program_name
 
 #: Mash sketch database with sketches from 54,925 RefSeq genomes package resource path
 MASH_REFSEQ_MSH = resource_filename(program_name, 'data/RefSeqSketches.msh')
+#: Directory for caching data derived from the bundled sketch database (decoded sketches, indexes)
+CACHE_DIR = os.environ.get('REFSEQ_MASHER_CACHE_DIR',
+                           os.path.join(os.path.expanduser('~'), '.cache', program_name))
+#: Compact dtypes of numeric Mash results and taxonomy info columns; all string columns are stored as categoricals.
+#: Distances and identities are written with 6 significant digits, which float32 represents exactly as text, but
+#: p-values can be far smaller than the smallest float32 and stay float64.
+RESULT_COLUMN_DTYPES = dict(taxid='int32',
+                            distance='float32',
+                            identity='float32',
+                            median_multiplicity='int32')
 #: Regex for matching FASTQ filenames with optional .gz
 REGEX_FASTQ = re.compile(r'^(.+)\.(fastq|fq)(\.gz)?$')
 #: Regex for matching FASTA filenames with optional .gz
@@ -64,3 +75,33 @@ taxid
 assembly_accession
 match_id
 '''.strip().split('\n')
+#: Ordered joined Mash dist, Mash screen and select taxonomy columns
+CLASSIFY_ORDERED_COLUMNS = '''
+sample
+top_taxonomy_name
+distance
+dist_pvalue
+matching
+identity
+shared_hashes
+median_multiplicity
+screen_pvalue
+full_taxonomy
+taxonomic_subspecies
+taxonomic_species
+taxonomic_genus
+taxonomic_family
+taxonomic_order
+taxonomic_class
+taxonomic_phylum
+taxonomic_kingdom
+taxonomic_superkingdom
+subspecies
+serovar
+plasmid
+bioproject
+biosample
+taxid
+assembly_accession
+match_id
+'''.strip().split('\n')
@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+
+"""Mash dist (matches) and Mash screen (contains) of a sample from a single pass over its input files
+
+Each input file is read and decompressed once:
+
+- "mash" engine: the decompressed stream is written to the stdin of both
+  `mash sketch` and `mash screen`, running concurrently
+- "native" engine: k-mers are hashed once and the hashes are folded into both
+  a running sketch (`SketchState`) and a screen state (`ScreenState`)
+"""
+
+import logging
+import os
+from typing import List, Optional, Tuple
+
+import pandas as pd
+
+from . import dist
+from .native_dist import refseq_dist_engine
+from .native_screen import refseq_screen_engine
+from .native_sketch import SketchState
+from .parser import mash_dist_table_to_dataframe, mash_screen_table_to_dataframe, mash_screen_output_to_dataframe
+from ..const import MASH_REFSEQ_MSH
+from ..seqio import iter_sequences, batch_sequences, iter_decompressed_chunks
+from ..utils import run_commands_teed, bounded_imap
+
+#: Classify engines
+CLASSIFY_ENGINES = ['mash', 'native']
+
+
+def mash_sketch_and_screen(inputs: List[str],
+                           is_reads: bool,
+                           mash_bin: str = 'mash',
+                           sample_name: str = None,
+                           tmp_dir: str = '/tmp',
+                           k: int = 16,
+                           s: int = 400,
+                           m: int = 8,
+                           max_pvalue: float = 0.01,
+                           min_identity: float = 0.9,
+                           parallelism: int = 1) -> Tuple[pd.DataFrame, Optional[pd.DataFrame]]:
+    """Run Mash sketch and Mash screen on one decompressed stream of the inputs, then Mash dist of the sketch
+
+    Args:
+        inputs: Input sequence files
+        is_reads: Whether inputs are reads (apply the Mash sketch `-m` k-mer filter)
+        mash_bin: Mash binary path
+        sample_name: Sample name
+        tmp_dir: Temporary working directory
+        k: Mash kmer size
+        s: Mash number of min-hashes
+        m: Mash number of times a k-mer needs to be observed in order to be considered for Mash sketch DB (reads)
+        max_pvalue: Mash screen max p-value to report
+        min_identity: Mash screen min identity to report
+        parallelism: Mash screen number of parallel threads to spawn
+
+    Returns:
+        (pd.DataFrame, pd.DataFrame): Mash dist results ordered by ascending distance and Mash screen results or None
+            if there were no Mash screen results
+    """
+    msh_path = os.path.join(tmp_dir, sample_name + '.msh')
+    sketch_cmd = [mash_bin, 'sketch', '-k', str(k), '-s', str(s)]
+    if is_reads:
+        sketch_cmd += ['-m', str(m)]
+    sketch_cmd += ['-o', msh_path, '-']
+    screen_cmd = [mash_bin, 'screen',
+                  '-v', str(max_pvalue),
+                  '-p', str(parallelism),
+                  '-i', str(min_identity),
+                  MASH_REFSEQ_MSH, '-']
+    logging.info('Running Mash sketch and Mash screen on a single pass over inputs of sample "%s": %s',
+                 sample_name, inputs)
+    try:
+        (sketch_exit_code, sketch_stdout, sketch_stderr), (screen_exit_code, screen_stdout, screen_stderr) = \
+            run_commands_teed([sketch_cmd, screen_cmd], iter_decompressed_chunks(inputs), decode_stdout=False)
+        if sketch_exit_code != 0:
+            raise Exception('Could not create Mash sketch. EXITCODE={} STDERR="{}" STDOUT="{}"'.format(
+                sketch_exit_code, sketch_stderr, sketch_stdout.decode(errors='replace')))
+        if screen_exit_code != 0:
+            raise Exception('Could not run Mash screen. EXITCODE={} STDERR="{}"'.format(screen_exit_code,
+                                                                                     screen_stderr))
+        df_dist = dist.sketch_vs_refseq(msh_path, mash_bin=mash_bin)
+    finally:
+        if os.path.exists(msh_path):
+            os.remove(msh_path)
+    df_screen = mash_screen_output_to_dataframe(screen_stdout)
+    return df_dist, df_screen
+
+
+def native_sketch_and_screen(inputs: List[str],
+                             is_reads: bool,
+                             mash_bin: str = 'mash',
+                             sample_name: str = None,
+                             m: int = 8,
+                             max_pvalue: float = 0.01,
+                             min_identity: float = 0.9,
+                             parallelism: int = 1) -> Tuple[pd.DataFrame, Optional[pd.DataFrame]]:
+    """Hash the k-mers of the inputs once and compute both native dist and native screen results
+
+    Args:
+        inputs: Input sequence files
+        is_reads: Whether inputs are reads (apply the Mash sketch `-m` k-mer filter)
+        mash_bin: Mash binary path (only used to decode the RefSeq sketch database on first use)
+        sample_name: Sample name
+        m: Mash number of times a k-mer needs to be observed in order to be considered for Mash sketch DB (reads)
+        max_pvalue: Mash screen max p-value to report
+        min_identity: Mash screen min identity to report
+        parallelism: Number of k-mer hashing threads
+
+    Returns:
+        (pd.DataFrame, pd.DataFrame): Mash dist results ordered by ascending distance and Mash screen results or None
+            if there were no Mash screen results
+    """
+    dist_engine = refseq_dist_engine(mash_bin)
+    screen_engine = refseq_screen_engine(mash_bin)
+    db = dist_engine.db
+    sketch = SketchState(kmer_size=db.kmer_size,
+                         sketch_size=db.sketch_size,
+                         min_copies=m if is_reads else 1,
+                         hash_seed=db.hash_seed)
+    screen_state = screen_engine.new_state()
+    logging.info('Running native sketch and screen on a single pass over inputs of sample "%s": %s',
+                 sample_name, inputs)
+    seqs = (seq for path in inputs for seq in iter_sequences(path))
+
+    def hash_batch(batch):
+        return sum(len(seq) for seq in batch), sketch.hash_sequences(batch)
+
+    for n_bases, hashes in bounded_imap(hash_batch, batch_sequences(seqs), n_workers=parallelism):
+        sketch.bases += n_bases
+        sketch.add_hashes(hashes)
+        screen_engine.add_hashes(screen_state, hashes)
+    length = sketch.estimated_length() if is_reads else sketch.bases
+    df_dist = mash_dist_table_to_dataframe(dist_engine.dist_table(sketch.hashes, length))
+    df_screen = screen_engine.results(screen_state, min_identity=min_identity, max_pvalue=max_pvalue)
+    if df_screen is not None:
+        df_screen = mash_screen_table_to_dataframe(df_screen)
+    return df_dist, df_screen
+
+
+def join_results(df_dist: pd.DataFrame, df_screen: Optional[pd.DataFrame]) -> pd.DataFrame:
+    """Outer join of a sample's Mash dist and Mash screen results on `sample` and `match_id`
+
+    The Mash dist and Mash screen p-values are renamed to `dist_pvalue` and `screen_pvalue`.
+
+    Args:
+        df_dist: Mash dist results with RefSeq info
+        df_screen: Mash screen results with RefSeq info or None
+
+    Returns:
+        (pd.DataFrame): joined results ordered by ascending distance then descending identity
+    """
+    df_dist = df_dist.rename(columns={'pvalue': 'dist_pvalue'})
+    if df_screen is None:
+        return df_dist
+    df_screen = df_screen.rename(columns={'pvalue': 'screen_pvalue'})
+    info_columns = [c for c in df_screen.columns if c in df_dist.columns and c not in ('sample', 'match_id')]
+    dfjoin = pd.merge(df_dist, df_screen, how='outer', on=['sample', 'match_id'], suffixes=('', '_screen'))
+    for c in info_columns:
+        screen_values = dfjoin.pop(c + '_screen')
+        if isinstance(df_dist[c].dtype, pd.CategoricalDtype):
+            # categories differ between the dist and screen results
+            dfjoin[c] = dfjoin[c].astype(object).combine_first(screen_values.astype(object))
+        else:
+            dfjoin[c] = dfjoin[c].combine_first(screen_values).astype(df_dist[c].dtype)
+    # keep integer multiplicities for matches without screen results
+    dfjoin['median_multiplicity'] = dfjoin.median_multiplicity.astype('Int32')
+    return dfjoin.sort_values(by=['distance', 'identity'], ascending=[True, False], na_position='last',
+                              kind='stable')
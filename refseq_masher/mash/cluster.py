@@ -0,0 +1,235 @@
+# -*- coding: utf-8 -*-
+
+"""Redundancy-collapsed reference: clustering of near-identical sketches into representatives
+
+Sketches are greedily clustered by Mash distance: in database order, each
+sketch not yet in a cluster becomes the representative of a new cluster with
+all unclustered sketches within `max_distance` of it as members. Searches
+then compare a query against the representatives only and expand the
+best-matching clusters to their members, which are scored exactly, so results
+are still reported for every member genome.
+"""
+
+import json
+import logging
+import os
+from typing import Optional
+
+import numpy as np
+import pandas as pd
+
+from .index import HashIndex, load_hash_index, ragged_positions, refseq_hash_index
+from .native_dist import NativeDist, exact_common_and_denom
+from .parser import MASH_DIST_4_COLUMNS
+from .sketchdb import SketchDB, refseq_sketch_db, save_to_cache
+from .stats import mash_distance, dist_pvalue, round_like_mash
+from ..utils import load_once
+
+#: Default max Mash distance of cluster members to their representative
+DEFAULT_CLUSTER_MAX_DISTANCE = 0.01
+
+
+class SketchClusters:
+    """Clusters of sketches with a representative each
+
+    Args:
+        max_distance: max Mash distance of members to their representative
+        representatives: representative sketch row of each cluster
+        assignments: cluster of each sketch row
+        rep_distances: Mash distance of each sketch to its cluster representative
+    """
+
+    def __init__(self,
+                 max_distance: float,
+                 representatives: np.ndarray,
+                 assignments: np.ndarray,
+                 rep_distances: np.ndarray):
+        self.max_distance = max_distance
+        self.representatives = representatives
+        self.assignments = assignments
+        self.rep_distances = rep_distances
+        #: sketch rows of cluster members, CSR-style with cluster boundaries in `member_offsets`
+        self.members = np.argsort(assignments, kind='stable')
+        self.member_offsets = np.searchsorted(assignments[self.members], np.arange(representatives.size + 1))
+
+    def __len__(self) -> int:
+        return self.representatives.size
+
+    @property
+    def sizes(self) -> np.ndarray:
+        return np.diff(self.member_offsets)
+
+    def member_rows(self, clusters: np.ndarray) -> np.ndarray:
+        """Sketch rows of all members of the given clusters"""
+        starts = self.member_offsets[clusters]
+        return self.members[ragged_positions(starts, self.member_offsets[clusters + 1] - starts)]
+
+    def save(self, dirpath: str) -> None:
+        os.makedirs(dirpath, exist_ok=True)
+        for attr in ['representatives', 'assignments', 'rep_distances']:
+            np.save(os.path.join(dirpath, attr + '.npy'), getattr(self, attr))
+        with open(os.path.join(dirpath, 'meta.json'), 'w') as f:
+            json.dump(dict(max_distance=self.max_distance), f)
+
+    @classmethod
+    def load(cls, dirpath: str) -> 'SketchClusters':
+        with open(os.path.join(dirpath, 'meta.json')) as f:
+            meta = json.load(f)
+        return cls(max_distance=meta['max_distance'],
+                   **{attr: np.load(os.path.join(dirpath, attr + '.npy'))
+                      for attr in ['representatives', 'assignments', 'rep_distances']})
+
+    def to_dataframe(self, db: SketchDB) -> pd.DataFrame:
+        """Table of each sketch's cluster, representative and distance to the representative"""
+        return pd.DataFrame(dict(cluster=self.assignments,
+                                 representative=db.names[self.representatives[self.assignments]],
+                                 match_id=db.names,
+                                 distance=round_like_mash(self.rep_distances)))
+
+
+def cluster_sketches(db: SketchDB,
+                     index: Optional[HashIndex] = None,
+                     max_distance: float = DEFAULT_CLUSTER_MAX_DISTANCE) -> SketchClusters:
+    """Greedily cluster sketches so that every member is within `max_distance` of its cluster representative
+
+    Args:
+        db: Sketches
+        index: Inverted hash index of the sketches (built if not provided)
+        max_distance: Max Mash distance of members to their representative
+
+    Returns:
+        (SketchClusters): sketch clusters
+    """
+    dist = NativeDist(db, index)
+    assignments = np.full(len(db), -1, dtype=np.int64)
+    rep_distances = np.zeros(len(db), dtype=np.float64)
+    representatives = []
+    for row in range(len(db)):
+        if assignments[row] >= 0:
+            continue
+        cluster = len(representatives)
+        representatives.append(row)
+        common, denom = dist.common_and_denom(db.row_hashes(row))
+        distance = mash_distance(common, denom, db.kmer_size)
+        new_members = (distance <= max_distance) & (assignments < 0)
+        new_members[row] = True
+        assignments[new_members] = cluster
+        rep_distances[new_members] = distance[new_members]
+        rep_distances[row] = 0.0
+        if len(representatives) % 1000 == 0:
+            logging.info('Clustered %s of %s sketches into %s clusters', np.count_nonzero(assignments >= 0),
+                         len(db), len(representatives))
+    logging.info('Clustered %s sketches into %s clusters (max distance=%s)', len(db), len(representatives),
+                 max_distance)
+    return SketchClusters(max_distance=max_distance,
+                          representatives=np.array(representatives, dtype=np.int64),
+                          assignments=assignments,
+                          rep_distances=rep_distances)
+
+
+class ClusteredNativeDist:
+    """Mash distances against cluster representatives first, then exactly against members of the best clusters
+
+    A member is within `max_distance` of its representative, so clusters whose representative is within
+    2 * `max_distance` of the closest representative are expanded, plus as many next closest clusters as needed
+    to report at least `min_members` genomes.
+
+    Args:
+        db: Reference sketches
+        clusters: Clusters of the reference sketches
+        rep_db: Cluster representatives' sketches (subset of `db` if not provided)
+        rep_index: Inverted hash index of the cluster representatives' sketches (built if not provided)
+    """
+
+    def __init__(self,
+                 db: SketchDB,
+                 clusters: SketchClusters,
+                 rep_db: Optional[SketchDB] = None,
+                 rep_index: Optional[HashIndex] = None):
+        self.db = db
+        self.clusters = clusters
+        if rep_db is None:
+            rep_db = db.subset(clusters.representatives)
+        self.reps = NativeDist(rep_db, rep_index)
+
+    def check_compatible(self, query: SketchDB) -> None:
+        self.reps.check_compatible(query)
+
+    def dist_table(self, query_hashes: np.ndarray, query_length: int, min_members: int = 5) -> pd.DataFrame:
+        """Mash dist table of a query sketch against the members of the best matching clusters
+
+        Args:
+            query_hashes: query sketch min-hashes
+            query_length: query genome length (Mash sketch length)
+            min_members: min number of member genomes to score
+
+        Returns:
+            (pd.DataFrame): table with `MASH_DIST_4_COLUMNS` columns
+        """
+        k = self.db.kmer_size
+        q = np.unique(query_hashes)
+        rep_common, rep_denom = self.reps.common_and_denom(q)
+        rep_distance = mash_distance(rep_common, rep_denom, k)
+        order = np.argsort(rep_distance, kind='stable')
+        order = order[rep_common[order] > 0]
+        if order.size == 0:
+            logging.warning('No RefSeq cluster representatives share any hashes with the query')
+            return pd.DataFrame(columns=MASH_DIST_4_COLUMNS)
+        sizes = self.clusters.sizes[order]
+        members_before = np.cumsum(sizes) - sizes
+        expand = (rep_distance[order] <= rep_distance[order[0]] + 2 * self.clusters.max_distance) \
+            | (members_before < min_members)
+        rows = self.clusters.member_rows(order[expand])
+        logging.info('Expanding %s of %s clusters to %s member genomes', np.count_nonzero(expand),
+                     len(self.clusters), rows.size)
+        common, denom = exact_common_and_denom(q, self.db, rows)
+        distance = mash_distance(common, denom, k)
+        pvalue = np.ones(rows.size, dtype=np.float64)
+        shared = common > 0
+        pvalue[shared] = dist_pvalue(common[shared], self.db.lengths[rows[shared]], query_length,
+                                     denom[shared], k)
+        return pd.DataFrame(dict(match_id=self.db.names[rows],
+                                 distance=round_like_mash(distance),
+                                 pvalue=round_like_mash(pvalue),
+                                 matching=['{}/{}'.format(x, y) for x, y in zip(common, denom)]),
+                            columns=MASH_DIST_4_COLUMNS)
+
+
+def load_sketch_clusters(db: SketchDB,
+                         index: Optional[HashIndex] = None,
+                         max_distance: float = DEFAULT_CLUSTER_MAX_DISTANCE) -> SketchClusters:
+    """Load cached clusters of a sketch database, clustering and caching them on first use"""
+    if db.cache_path is None:
+        return cluster_sketches(db, index, max_distance)
+    clusters_path = os.path.join(db.cache_path, 'clusters-d{}'.format(max_distance))
+    if os.path.exists(os.path.join(clusters_path, 'meta.json')):
+        logging.info('Loading cached sketch clusters from "%s"', clusters_path)
+        return SketchClusters.load(clusters_path)
+    logging.info('Clustering %s sketches at max distance %s. This only needs to be done once.', len(db),
+                 max_distance)
+    clusters = cluster_sketches(db, index, max_distance)
+    save_to_cache(clusters, clusters_path)
+    logging.info('Cached sketch clusters at "%s"', clusters_path)
+    return clusters
+
+
+@load_once
+def refseq_clusters(mash_bin: str = 'mash', max_distance: float = DEFAULT_CLUSTER_MAX_DISTANCE) -> SketchClusters:
+    """Clusters of the bundled RefSeq sketch database, loaded once per process"""
+    return load_sketch_clusters(refseq_sketch_db(mash_bin=mash_bin), refseq_hash_index(mash_bin=mash_bin),
+                                max_distance)
+
+
+@load_once
+def refseq_clustered_dist_engine(mash_bin: str = 'mash',
+                                 max_distance: float = DEFAULT_CLUSTER_MAX_DISTANCE) -> ClusteredNativeDist:
+    """Clustered dist engine for the bundled RefSeq sketch database, loaded once per process"""
+    db = refseq_sketch_db(mash_bin=mash_bin)
+    clusters = refseq_clusters(mash_bin, max_distance)
+    if db.cache_path is None:
+        return ClusteredNativeDist(db, clusters)
+    rep_db_path = os.path.join(db.cache_path, 'clusters-d{}'.format(max_distance), 'representatives')
+    if not os.path.exists(os.path.join(rep_db_path, 'meta.json')):
+        save_to_cache(db.subset(clusters.representatives), rep_db_path)
+    rep_db = SketchDB.load(rep_db_path)
+    return ClusteredNativeDist(db, clusters, rep_db, load_hash_index(rep_db))
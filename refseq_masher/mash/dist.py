@@ -1,16 +1,30 @@
 import logging
 import os
-from typing import Optional, List
+from typing import Optional, List, Tuple, Union
 
 import pandas as pd
 
 from .sketch import sketch_fasta, sketch_fastqs
 from .parser import mash_dist_output_to_dataframe
-from ..utils import run_command
+from . import native_dist, native_sketch, cluster
+from .sketchdb import SketchDB
+from ..utils import run_command, sample_name_from_fasta_path, sample_name_from_fastq_paths
 from ..const import MASH_REFSEQ_MSH
 
+#: Mash dist engines (see `sketch_vs_refseq`)
+DIST_ENGINES = ['mash', 'native', 'fast', 'clustered']
+#: Mash dist engines that run in-process
+IN_PROCESS_DIST_ENGINES = ['native', 'fast', 'clustered']
+#: Query sketchers: "mash" runs Mash sketch; "native" sketches in-process (see `native_sketch`)
+SKETCHERS = ['mash', 'native']
 
-def mash_dist_refseq(sketch_path: str, mash_bin: str = "mash") -> str:
+
+def default_sketcher(engine: str) -> str:
+    """In-process engines sketch queries in-process by default, avoiding the Mash sketch file round-trip"""
+    return 'native' if engine in IN_PROCESS_DIST_ENGINES else 'mash'
+
+
+def mash_dist_refseq(sketch_path: str, mash_bin: str = "mash") -> bytes:
     """Compute Mash distances of sketch file of genome fasta to RefSeq sketch DB.
 
     Args:
@@ -18,27 +32,165 @@ def mash_dist_refseq(sketch_path: str, mash_bin: str = "mash") -> str:
         sketch_path (str): Mash sketch file path or genome fasta file path
 
     Returns:
-        (str): Mash STDOUT string
+        (bytes): Mash STDOUT bytes (see `parser.read_mash_table`)
     """
     assert os.path.exists(sketch_path)
     cmd_list = [mash_bin,
                 'dist',
                 MASH_REFSEQ_MSH,
                 sketch_path]
-    exit_code, stdout, stderr = run_command(cmd_list)
+    exit_code, stdout, stderr = run_command(cmd_list, decode_stdout=False)
     if exit_code != 0:
         raise Exception(
-            'Could not run Mash dist. EXITCODE="{}" STDERR="{}" STDOUT="{}"'.format(exit_code, stderr, stdout))
+            'Could not run Mash dist. EXITCODE="{}" STDERR="{}" STDOUT="{}"'.format(exit_code, stderr,
+                                                                                  stdout.decode(errors='replace')))
 
     return stdout
 
 
+def in_process_engine(engine: str, mash_bin: str = 'mash', engine_opts: Optional[dict] = None) -> Tuple[object, dict]:
+    """In-process RefSeq dist engine and the extra arguments to its `dist_table` method (see `sketch_vs_refseq`)"""
+    engine_opts = engine_opts or {}
+    if engine == 'fast':
+        return (native_dist.refseq_fast_dist_engine(mash_bin),
+                dict(n_candidates=engine_opts.get('fast_candidates', 300)))
+    if engine == 'clustered':
+        max_distance = engine_opts.get('cluster_max_distance', cluster.DEFAULT_CLUSTER_MAX_DISTANCE)
+        return (cluster.refseq_clustered_dist_engine(mash_bin, max_distance),
+                dict(min_members=engine_opts.get('top_n', 5)))
+    return native_dist.refseq_dist_engine(mash_bin), {}
+
+
+def sketch_vs_refseq(sketch_path: str,
+                     mash_bin: str = 'mash',
+                     engine: str = 'mash',
+                     engine_opts: Optional[dict] = None,
+                     columns: Optional[List[str]] = None) -> pd.DataFrame:
+    """Compute and parse Mash distances of a sketch file to all RefSeq genome sketches
+
+    Engines (see `DIST_ENGINES`):
+
+    - "mash": run Mash dist
+    - "native": search the RefSeq inverted hash index in-process
+    - "fast": coarse-to-fine in-process search rescoring only the best `fast_candidates` coarse-scored genomes;
+      results have a `coarse_rank` column (see `native_dist.check_fast_rankings`)
+    - "clustered": in-process search against RefSeq cluster representatives (clustered at `cluster_max_distance`)
+      that only scores the members of the best clusters, at least `top_n` of them
+
+    Args:
+        sketch_path: Mash sketch file path
+        mash_bin: Mash binary path
+        engine: Distance engine
+        engine_opts: Engine options (fast engine: `fast_candidates`; clustered engine: `cluster_max_distance`, `top_n`)
+        columns: Output columns to keep and parse (default: all)
+
+    Returns:
+        (pd.DataFrame): Mash dist results ordered by ascending distance
+    """
+    if engine in IN_PROCESS_DIST_ENGINES:
+        dist_engine, kwargs = in_process_engine(engine, mash_bin=mash_bin, engine_opts=engine_opts)
+        return native_dist.sketch_vs_refseq(sketch_path, dist_engine, mash_bin=mash_bin, columns=columns, **kwargs)
+    mashout = mash_dist_refseq(sketch_path, mash_bin=mash_bin)
+    logging.info('Ran Mash dist successfully (output length=%s). Parsing Mash dist output', len(mashout))
+    return mash_dist_output_to_dataframe(mashout, columns=columns)
+
+
+def sketch_query(inputs: Union[str, List[str]],
+                 reads: bool = False,
+                 sample_name: Optional[str] = None,
+                 mash_bin: str = 'mash',
+                 tmp_dir: str = '/tmp',
+                 k: int = 16,
+                 s: int = 400,
+                 m: int = 8,
+                 engine: str = 'mash',
+                 sketcher: Optional[str] = None) -> Union[str, SketchDB]:
+    """Sketch a sample for `dist_query`
+
+    In-process sketches are kept in memory for the in-process engines and written to a temporary Mash sketch file for
+    the "mash" engine.
+
+    Args:
+        inputs: FASTA path or FASTQ paths
+        reads: Whether `inputs` are FASTQ paths
+        sample_name: Sample name
+        mash_bin: Mash binary path
+        tmp_dir: Temporary working directory
+        k: Mash kmer size
+        s: Mash number of min-hashes
+        m: Mash number of times a k-mer needs to be observed in order to be considered for Mash sketch DB (reads)
+        engine: Distance engine (see `sketch_vs_refseq`)
+        sketcher: Query sketcher (see `SKETCHERS`; default: "native" for in-process engines, otherwise "mash")
+
+    Returns:
+        (str|SketchDB): temporary Mash sketch file path or in-process sketch
+    """
+    if (sketcher or default_sketcher(engine)) == 'mash':
+        if reads:
+            return sketch_fastqs(inputs, mash_bin=mash_bin, tmp_dir=tmp_dir, sample_name=sample_name, k=k, s=s, m=m)
+        return sketch_fasta(inputs, mash_bin=mash_bin, tmp_dir=tmp_dir, sample_name=sample_name, k=k, s=s)
+    if reads:
+        state = native_sketch.sketch_fastqs(inputs, k=k, s=s, m=m)
+        sample_name = sample_name or sample_name_from_fastq_paths(inputs)
+    else:
+        state = native_sketch.sketch_fasta(inputs, k=k, s=s)
+        sample_name = sample_name or sample_name_from_fasta_path(inputs)
+    if engine in IN_PROCESS_DIST_ENGINES:
+        return state.to_sketch_db(sample_name, reads=reads)
+    return state.write_msh(os.path.join(tmp_dir, sample_name + '.msh'), sample_name, reads=reads)
+
+
+def dist_query(query: Union[str, SketchDB],
+               mash_bin: str = 'mash',
+               engine: str = 'mash',
+               engine_opts: Optional[dict] = None,
+               columns: Optional[List[str]] = None) -> Union[bytes, pd.DataFrame]:
+    """Compute Mash distances of a sketch from `sketch_query` to all RefSeq genome sketches
+
+    Temporary sketch files are deleted afterwards.
+
+    Args:
+        query: Temporary Mash sketch file path or in-process sketch
+        mash_bin: Mash binary path
+        engine: Distance engine (see `sketch_vs_refseq`)
+        engine_opts: Distance engine options (see `sketch_vs_refseq`)
+        columns: Output columns to keep and parse for in-process engines (default: all)
+
+    Returns:
+        (bytes|pd.DataFrame): Mash dist STDOUT for the "mash" engine, otherwise Mash dist results (see
+            `parse_dist_output`)
+    """
+    if isinstance(query, SketchDB):
+        dist_engine, kwargs = in_process_engine(engine, mash_bin=mash_bin, engine_opts=engine_opts)
+        return native_dist.query_vs_refseq(query, dist_engine, columns=columns, **kwargs)
+    try:
+        logging.info('Querying Mash sketches "%s" against RefSeq sketch database', query)
+        if engine in IN_PROCESS_DIST_ENGINES:
+            return sketch_vs_refseq(query, mash_bin=mash_bin, engine=engine, engine_opts=engine_opts, columns=columns)
+        return mash_dist_refseq(query, mash_bin=mash_bin)
+    finally:
+        if os.path.exists(query):
+            logging.info('Deleting temporary sketch file "%s"', query)
+            os.remove(query)
+
+
+def parse_dist_output(output: Union[bytes, str, pd.DataFrame], columns: Optional[List[str]] = None) -> pd.DataFrame:
+    """Parse `dist_query` output into Mash dist results ordered by ascending distance, parsing only `columns`"""
+    if isinstance(output, pd.DataFrame):
+        return output
+    logging.info('Ran Mash dist successfully (output length=%s). Parsing Mash dist output', len(output))
+    return mash_dist_output_to_dataframe(output, columns=columns)
+
+
 def fasta_vs_refseq(fasta_path: str,
                     mash_bin: str = "mash",
                     sample_name: Optional[str] = None,
                     tmp_dir: str = "/tmp",
                     k: int = 16,
-                    s: int = 400) -> pd.DataFrame:
+                    s: int = 400,
+                    engine: str = 'mash',
+                    engine_opts: Optional[dict] = None,
+                    sketcher: Optional[str] = None) -> pd.DataFrame:
     """Compute Mash distances between input FASTA against all RefSeq genomes
 
     Args:
@@ -48,30 +200,26 @@ def fasta_vs_refseq(fasta_path: str,
         tmp_dir: Temporary working directory
         k: Mash kmer size
         s: Mash number of min-hashes
+        engine: Distance engine (see `sketch_vs_refseq`)
+        engine_opts: Distance engine options (see `sketch_vs_refseq`)
+        sketcher: Query sketcher (see `SKETCHERS`; default: "native" for in-process engines, otherwise "mash")
 
     Returns:
         (pd.DataFrame): Mash genomic distance results ordered by ascending distance
     """
-    sketch_path = None
-    try:
-        sketch_path = sketch_fasta(fasta_path,
-                                   mash_bin=mash_bin,
-                                   tmp_dir=tmp_dir,
-                                   sample_name=sample_name,
-                                   k=k,
-                                   s=s)
-        mashout = mash_dist_refseq(sketch_path, mash_bin=mash_bin)
-        logging.info('Ran Mash dist successfully (output length=%s). Parsing Mash dist output', len(mashout))
-        df_mash = mash_dist_output_to_dataframe(mashout)
-        df_mash['sample'] = sample_name
-        logging.info('Parsed Mash dist output into Pandas DataFrame with %s rows', df_mash.shape[0])
-        logging.debug('df_mash: %s', df_mash.head(5))
-        return df_mash
-    finally:
-        if sketch_path and os.path.exists(sketch_path):
-            logging.info('Deleting temporary sketch file "%s"', sketch_path)
-            os.remove(sketch_path)
-            logging.info('Sketch file "%s" deleted!', sketch_path)
+    query = sketch_query(fasta_path,
+                         sample_name=sample_name,
+                         mash_bin=mash_bin,
+                         tmp_dir=tmp_dir,
+                         k=k,
+                         s=s,
+                         engine=engine,
+                         sketcher=sketcher)
+    df_mash = parse_dist_output(dist_query(query, mash_bin=mash_bin, engine=engine, engine_opts=engine_opts))
+    df_mash['sample'] = sample_name
+    logging.info('Parsed Mash dist output into Pandas DataFrame with %s rows', df_mash.shape[0])
+    logging.debug('df_mash: %s', df_mash.head(5))
+    return df_mash
 
 
 def fastq_vs_refseq(fastqs: List[str],
@@ -80,7 +228,10 @@ def fastq_vs_refseq(fastqs: List[str],
                     tmp_dir: str = '/tmp',
                     k: int = 16,
                     s: int = 400,
-                    m: int = 8) -> pd.DataFrame:
+                    m: int = 8,
+                    engine: str = 'mash',
+                    engine_opts: Optional[dict] = None,
+                    sketcher: Optional[str] = None) -> pd.DataFrame:
     """Compute Mash distances between input reads against all RefSeq genomes
 
     Args:
@@ -91,32 +242,27 @@ def fastq_vs_refseq(fastqs: List[str],
         k: Mash kmer size
         s: Mash number of min-hashes
         m: Mash number of times a k-mer needs to be observed in order to be considered for Mash sketch DB
+        engine: Distance engine (see `sketch_vs_refseq`)
+        engine_opts: Distance engine options (see `sketch_vs_refseq`)
+        sketcher: Query sketcher (see `SKETCHERS`; default: "native" for in-process engines, otherwise "mash")
 
     Returns:
         (pd.DataFrame): Mash genomic distance results ordered by ascending distance
     """
 
     assert len(fastqs) > 0, "Must supply one or more FASTQ paths"
-    sketch_path = None
-    try:
-        sketch_path = sketch_fastqs(fastqs,
-                                    mash_bin=mash_bin,
-                                    tmp_dir=tmp_dir,
-                                    sample_name=sample_name,
-                                    k=k,
-                                    s=s,
-                                    m=m)
-        logging.info('Mash sketch database created for "%s" at "%s"', fastqs, sketch_path)
-        logging.info('Querying Mash sketches "%s" against RefSeq sketch database', sketch_path)
-        mashout = mash_dist_refseq(sketch_path, mash_bin=mash_bin)
-        logging.info('Queried "%s" against RefSeq sketch database. Parsing into Pandas DataFrame', sketch_path)
-        df_mash = mash_dist_output_to_dataframe(mashout)
-        df_mash['sample'] = sample_name
-        logging.info('Parsed Mash distance results into DataFrame with %s entries', df_mash.shape[0])
-        logging.debug('df_mash %s', df_mash.head(5))
-        return df_mash
-    finally:
-        if sketch_path and os.path.exists(sketch_path):
-            logging.info('Deleting temporary sketch file "%s"', sketch_path)
-            os.remove(sketch_path)
-            logging.info('Sketch file "%s" deleted!', sketch_path)
+    query = sketch_query(fastqs,
+                         reads=True,
+                         sample_name=sample_name,
+                         mash_bin=mash_bin,
+                         tmp_dir=tmp_dir,
+                         k=k,
+                         s=s,
+                         m=m,
+                         engine=engine,
+                         sketcher=sketcher)
+    df_mash = parse_dist_output(dist_query(query, mash_bin=mash_bin, engine=engine, engine_opts=engine_opts))
+    df_mash['sample'] = sample_name
+    logging.info('Parsed Mash distance results into DataFrame with %s entries', df_mash.shape[0])
+    logging.debug('df_mash %s', df_mash.head(5))
+    return df_mash
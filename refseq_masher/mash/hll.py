@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+
+"""HyperLogLog distinct k-mer count estimation over Mash k-mer hashes"""
+
+import numpy as np
+
+
+class HyperLogLog:
+    """HyperLogLog cardinality estimator for uniformly distributed 32-bit or 64-bit hashes
+
+    Args:
+        p: number of register index bits (2^p registers)
+        hash_bits: hash width in bits (32 or 64)
+    """
+
+    def __init__(self, p: int = 14, hash_bits: int = 32):
+        assert 4 <= p <= 18, 'HyperLogLog precision must be between 4 and 18'
+        self.p = p
+        self.hash_bits = hash_bits
+        self.m = 1 << p
+        self.registers = np.zeros(self.m, dtype=np.uint8)
+
+    def add(self, hashes: np.ndarray) -> None:
+        """Add hashes to the estimator"""
+        if hashes.size == 0:
+            return
+        h = hashes.astype(np.uint64, copy=False)
+        q = self.hash_bits - self.p
+        idx = (h >> np.uint64(q)).astype(np.intp)
+        w = h & np.uint64((1 << q) - 1)
+        rank = np.full(h.size, q + 1, dtype=np.uint8)
+        nonzero = w > 0
+        # w < 2^50 is exactly representable as float64 so floor(log2(w)) is exact
+        rank[nonzero] = q - np.floor(np.log2(w[nonzero].astype(np.float64))).astype(np.uint8)
+        np.maximum.at(self.registers, idx, rank)
+
+    def merge(self, other: 'HyperLogLog') -> None:
+        """Merge another estimator with the same precision into this one"""
+        assert self.p == other.p and self.hash_bits == other.hash_bits
+        np.maximum(self.registers, other.registers, out=self.registers)
+
+    def cardinality(self) -> float:
+        """Estimated number of distinct hashes added"""
+        alpha = 0.7213 / (1.0 + 1.079 / self.m)
+        estimate = alpha * self.m * self.m / np.sum(np.power(2.0, -self.registers.astype(np.float64)))
+        zeros = int(np.count_nonzero(self.registers == 0))
+        if estimate <= 2.5 * self.m and zeros > 0:
+            return self.m * np.log(self.m / zeros)
+        space = 2.0 ** self.hash_bits
+        if self.hash_bits == 32 and estimate > space / 30.0:
+            return -space * np.log(1.0 - estimate / space)
+        return float(estimate)
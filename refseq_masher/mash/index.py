@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+
+"""Inverted min-hash to sketch index over a Mash sketch database
+
+The index maps each distinct min-hash in the database to the rows (sketches)
+containing it, stored CSR-style as NumPy arrays that are memory-mapped when
+loaded from the cache:
+
+- `hashes`: sorted distinct min-hashes
+- `offsets`: start of each distinct hash's postings in `rows` and `ranks`
+- `rows`: sketch rows containing each hash
+- `ranks`: position of the hash within each row's sorted sketch
+
+Probing only a query's own hashes yields the candidate sketches and their
+exact shared-hash counts, so query cost is proportional to the number of
+hits rather than to the size of the database.
+"""
+
+import json
+import logging
+import os
+from typing import Tuple
+
+import numpy as np
+
+from .sketchdb import SketchDB, refseq_sketch_db, save_to_cache
+from ..utils import load_once
+
+#: Hash index cache format version; bump to invalidate caches when the cached layout changes
+HASH_INDEX_CACHE_VERSION = 1
+
+
+def ragged_positions(starts: np.ndarray, lengths: np.ndarray) -> np.ndarray:
+    """Concatenated `arange(start, start + length)` for each start and length"""
+    lengths = np.asarray(lengths, dtype=np.int64)
+    total = int(lengths.sum())
+    if total == 0:
+        return np.empty(0, dtype=np.int64)
+    ends = np.cumsum(lengths)
+    shifts = np.repeat(np.asarray(starts, dtype=np.int64) - (ends - lengths), lengths)
+    return np.arange(total, dtype=np.int64) + shifts
+
+
+class HashIndex:
+    """Inverted index from min-hash to the sketch rows containing it
+
+    Args:
+        hashes: sorted distinct min-hashes
+        offsets: int64 array of length len(hashes) + 1 with each hash's postings start
+        rows: int32 sketch row of each posting
+        ranks: int32 position of the hash within each posting's sorted sketch
+        n_rows: number of sketches in the database
+    """
+
+    def __init__(self, hashes: np.ndarray, offsets: np.ndarray, rows: np.ndarray, ranks: np.ndarray, n_rows: int):
+        self.hashes = hashes
+        self.offsets = offsets
+        self.rows = rows
+        self.ranks = ranks
+        self.n_rows = n_rows
+
+    @classmethod
+    def build(cls, db: SketchDB) -> 'HashIndex':
+        """Build the inverted index of a sketch database"""
+        logging.info('Building inverted hash index over %s sketches (%s hashes)', len(db), db.hashes.size)
+        sizes = db.sizes
+        row_of = np.repeat(np.arange(len(db), dtype=np.int32), sizes)
+        rank_of = (np.arange(db.hashes.size, dtype=np.int64) - np.repeat(db.offsets[:-1], sizes)).astype(np.int32)
+        order = np.argsort(db.hashes, kind='stable')
+        sorted_hashes = np.asarray(db.hashes)[order]
+        hashes, starts = np.unique(sorted_hashes, return_index=True)
+        offsets = np.append(starts, sorted_hashes.size).astype(np.int64)
+        logging.info('Built inverted hash index with %s distinct hashes', hashes.size)
+        return cls(hashes=hashes, offsets=offsets, rows=row_of[order], ranks=rank_of[order], n_rows=len(db))
+
+    def save(self, dirpath: str) -> None:
+        os.makedirs(dirpath, exist_ok=True)
+        for attr in ['hashes', 'offsets', 'rows', 'ranks']:
+            np.save(os.path.join(dirpath, attr + '.npy'), getattr(self, attr))
+        with open(os.path.join(dirpath, 'meta.json'), 'w') as f:
+            json.dump(dict(version=HASH_INDEX_CACHE_VERSION, n_rows=self.n_rows), f)
+
+    @classmethod
+    def load(cls, dirpath: str) -> 'HashIndex':
+        """Load an index saved with `save`, memory-mapping its arrays"""
+        with open(os.path.join(dirpath, 'meta.json')) as f:
+            meta = json.load(f)
+        arrays = {attr: np.load(os.path.join(dirpath, attr + '.npy'), mmap_mode='r')
+                  for attr in ['hashes', 'offsets', 'rows', 'ranks']}
+        return cls(n_rows=meta['n_rows'], **arrays)
+
+    def lookup(self, query_hashes: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """Positions in `hashes` of the query hashes found in the index
+
+        Args:
+            query_hashes: query hashes
+
+        Returns:
+            (np.ndarray, np.ndarray): indices into `query_hashes` of found hashes and their positions in `hashes`
+        """
+        pos = np.searchsorted(self.hashes, query_hashes)
+        pos[pos == self.hashes.size] = 0
+        found = np.flatnonzero(self.hashes[pos] == query_hashes)
+        return found, pos[found]
+
+    def postings(self, hash_positions: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """All postings of the distinct hashes at `hash_positions`
+
+        Returns:
+            (np.ndarray, np.ndarray, np.ndarray): index into `hash_positions`, sketch row and rank within the row
+                of each posting
+        """
+        starts = self.offsets[hash_positions]
+        lengths = self.offsets[hash_positions + 1] - starts
+        positions = ragged_positions(starts, lengths)
+        which = np.repeat(np.arange(hash_positions.size), lengths)
+        return which, np.asarray(self.rows[positions]), np.asarray(self.ranks[positions])
+
+    def shared_hash_counts(self, query_hashes: np.ndarray) -> np.ndarray:
+        """Exact number of distinct query hashes shared with each sketch in the database
+
+        Args:
+            query_hashes: distinct query hashes
+
+        Returns:
+            (np.ndarray): shared hash count for each sketch row
+        """
+        _, hash_positions = self.lookup(query_hashes)
+        _, rows, _ = self.postings(hash_positions)
+        return np.bincount(rows, minlength=self.n_rows)
+
+
+def load_hash_index(db: SketchDB) -> HashIndex:
+    """Load the cached inverted index of a sketch database, building and caching it on first use"""
+    if db.cache_path is None:
+        return HashIndex.build(db)
+    index_path = os.path.join(db.cache_path, 'index-v{}'.format(HASH_INDEX_CACHE_VERSION))
+    if os.path.exists(os.path.join(index_path, 'meta.json')):
+        logging.info('Loading cached inverted hash index from "%s"', index_path)
+        return HashIndex.load(index_path)
+    index = HashIndex.build(db)
+    save_to_cache(index, index_path)
+    logging.info('Cached inverted hash index at "%s"', index_path)
+    return HashIndex.load(index_path)
+
+
+@load_once
+def refseq_hash_index(mash_bin: str = 'mash') -> HashIndex:
+    """Inverted hash index of the bundled RefSeq sketch database, loaded once per process"""
+    return load_hash_index(refseq_sketch_db(mash_bin=mash_bin))
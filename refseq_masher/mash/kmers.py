@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+
+"""Vectorized canonical k-mer extraction and Mash-compatible k-mer hashing
+
+Like Mash, sequences are uppercased, k-mers containing characters other than
+A, C, G or T are skipped and each k-mer is hashed in its canonical form, i.e.
+the lexicographically smaller of the k-mer and its reverse complement. Mash
+keeps the first 64-bit half of MurmurHash3_x64_128 as the k-mer hash or, for
+k <= 16, the lower 32 bits of it.
+"""
+
+from typing import List
+
+import numpy as np
+
+from .murmur import murmurhash3_x64_128
+
+#: Max k-mer size that can be 2-bit packed into a uint64 for canonical k-mer comparisons
+MAX_KMER_SIZE = 32
+#: Nucleotide 2-bit codes (A=0, C=1, G=2, T=3) with any other character coded as 4.
+#: Packed 2-bit codes compare in the same order as the ASCII k-mers they encode.
+_NT_CODES = np.full(256, 4, dtype=np.uint8)
+for _i, _nt in enumerate(b'ACGT'):
+    _NT_CODES[_nt] = _i
+    _NT_CODES[ord(chr(_nt).lower())] = _i
+_CODE_ASCII = np.frombuffer(b'ACGT', dtype=np.uint8).astype(np.uint64)
+
+
+def hash_bits_for_kmer_size(k: int) -> int:
+    """Mash uses 32-bit hashes for k <= 16 and 64-bit hashes otherwise"""
+    return 32 if k <= 16 else 64
+
+
+def canonical_kmers(seq: bytes, k: int = 16) -> np.ndarray:
+    """2-bit packed canonical k-mers of a sequence, skipping k-mers with non-ACGT characters
+
+    Args:
+        seq: nucleotide sequence
+        k: k-mer size (<= 32)
+
+    Returns:
+        (np.ndarray): uint64 2-bit packed canonical k-mers in sequence order
+    """
+    if k > MAX_KMER_SIZE:
+        raise ValueError('k-mer size {} is greater than max supported k-mer size of {}'.format(k, MAX_KMER_SIZE))
+    codes = _NT_CODES[np.frombuffer(seq, dtype=np.uint8)]
+    n = codes.size - k + 1
+    if n <= 0:
+        return np.empty(0, dtype=np.uint64)
+    invalid = np.concatenate(([0], np.cumsum(codes == 4)))
+    valid = (invalid[k:] - invalid[:-k]) == 0
+    c = np.where(codes == 4, 0, codes).astype(np.uint64)
+    rc = np.uint64(3) - c
+    fwd = np.zeros(n, dtype=np.uint64)
+    rev = np.zeros(n, dtype=np.uint64)
+    two = np.uint64(2)
+    for j in range(k):
+        fwd = (fwd << two) | c[j:j + n]
+        rev = (rev << two) | rc[k - 1 - j:k - 1 - j + n]
+    return np.minimum(fwd, rev)[valid]
+
+
+def hash_packed_kmers(kmers: np.ndarray, k: int = 16, seed: int = 42) -> np.ndarray:
+    """Mash hashes of 2-bit packed k-mers
+
+    Args:
+        kmers: uint64 2-bit packed k-mers
+        k: k-mer size
+        seed: Mash hash seed
+
+    Returns:
+        (np.ndarray): uint32 hashes if k <= 16 else uint64 hashes
+    """
+    nwords = (k + 7) // 8
+    words = np.zeros((kmers.size, nwords), dtype=np.uint64)
+    for j in range(k):
+        nt = _CODE_ASCII[(kmers >> np.uint64(2 * (k - 1 - j))) & np.uint64(3)]
+        words[:, j // 8] |= nt << np.uint64(8 * (j % 8))
+    h1, _ = murmurhash3_x64_128(words, k, seed)
+    if hash_bits_for_kmer_size(k) == 32:
+        return (h1 & np.uint64(0xffffffff)).astype(np.uint32)
+    return h1
+
+
+def kmer_hashes(seqs: List[bytes], k: int = 16, seed: int = 42) -> np.ndarray:
+    """Mash hashes of all canonical k-mers in one or more sequences
+
+    Sequences are joined with an "N" so that no k-mer spans two sequences.
+
+    Args:
+        seqs: nucleotide sequences
+        k: k-mer size
+        seed: Mash hash seed
+
+    Returns:
+        (np.ndarray): hash of each valid k-mer (uint32 if k <= 16 else uint64), duplicates included
+    """
+    return hash_packed_kmers(canonical_kmers(b'N'.join(seqs), k=k), k=k, seed=seed)
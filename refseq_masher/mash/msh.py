@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+
+"""Writing Mash sketch (`.msh`) files without Mash or a Cap'n Proto library
+
+A `.msh` file is an unpacked, single segment Cap'n Proto message of Mash's
+`MinHash` schema. The message is laid out the way Mash's `writeToCapnp`
+allocates it (root struct, reference list, references with their name,
+comment, hashes and counts, empty locus list, alphabet) so that sketches
+written here can be read by `mash dist`, `mash screen` and `mash info`.
+
+Cap'n Proto layout of the `MinHash` schema fields used:
+
+- `MinHash` struct (3 data words, 4 pointers): `kmerSize` (u32 @ byte 0),
+  `windowSize` (u32 @ 4), `minHashesPerWindow` (u32 @ 8), `concatenated`
+  (bit 96), `noncanonical` (bit 97), `preserveCase` (bit 98), `error`
+  (f32 @ 16), `hashSeed` (u32 @ 20); pointers `referenceListOld` (0),
+  `locusList` (1), `referenceList` (2), `alphabet` (3)
+- `ReferenceList` struct (0 data words, 1 pointer): `references` (0)
+- `Reference` struct (2 data words, 7 pointers): `length` (u32 @ 0),
+  `counts32Sorted` (bit 32), `length64` (u64 @ 8); pointers `sequence` (0),
+  `quality` (1), `name` (2), `comment` (3), `hashes32` (4), `hashes64` (5),
+  `counts32` (6)
+- `LocusList` struct (0 data words, 1 pointer): `loci` (0) of `Locus`
+  structs (3 data words, 0 pointers)
+"""
+
+import struct
+from typing import List, Optional
+
+import numpy as np
+
+from .sketchdb import SketchDB
+
+#: Cap'n Proto list element size codes
+LIST_BYTE = 2
+LIST_FOUR_BYTES = 4
+LIST_EIGHT_BYTES = 5
+LIST_COMPOSITE = 7
+
+
+class SegmentBuilder:
+    """Word-aligned Cap'n Proto message segment that objects are allocated in, root pointer first"""
+
+    def __init__(self):
+        self.buf = bytearray(8)
+
+    @property
+    def n_words(self) -> int:
+        return len(self.buf) // 8
+
+    def alloc(self, n_words: int) -> int:
+        """Allocate zeroed words at the end of the segment and return the first word's index"""
+        start = self.n_words
+        self.buf.extend(bytes(8 * n_words))
+        return start
+
+    def set_struct_pointer(self, ptr_word: int, target_word: int, data_words: int, ptr_count: int) -> None:
+        offset = target_word - ptr_word - 1
+        struct.pack_into('<IHH', self.buf, 8 * ptr_word, (offset << 2) & 0xffffffff, data_words, ptr_count)
+
+    def set_list_pointer(self, ptr_word: int, target_word: int, element_size: int, count: int) -> None:
+        offset = target_word - ptr_word - 1
+        struct.pack_into('<II', self.buf, 8 * ptr_word, ((offset << 2) | 1) & 0xffffffff,
+                         (count << 3) | element_size)
+
+    def init_struct(self, ptr_word: int, data_words: int, ptr_count: int) -> int:
+        """Allocate a struct, point `ptr_word` at it and return the struct's first word"""
+        start = self.alloc(data_words + ptr_count)
+        self.set_struct_pointer(ptr_word, start, data_words, ptr_count)
+        return start
+
+    def init_struct_list(self, ptr_word: int, n: int, data_words: int, ptr_count: int) -> int:
+        """Allocate a composite list of `n` structs and return the first struct's first word"""
+        words = n * (data_words + ptr_count)
+        tag = self.alloc(1 + words)
+        self.set_list_pointer(ptr_word, tag, LIST_COMPOSITE, words)
+        struct.pack_into('<IHH', self.buf, 8 * tag, n << 2, data_words, ptr_count)
+        return tag + 1
+
+    def set_data(self, ptr_word: int, data: bytes, element_size: int, count: int) -> None:
+        """Allocate a list of primitive values with the given raw little-endian bytes"""
+        start = self.alloc((len(data) + 7) // 8)
+        self.buf[8 * start:8 * start + len(data)] = data
+        self.set_list_pointer(ptr_word, start, element_size, count)
+
+    def set_text(self, ptr_word: int, text: str) -> None:
+        data = text.encode('utf-8') + b'\0'
+        self.set_data(ptr_word, data, LIST_BYTE, len(data))
+
+    def to_bytes(self) -> bytes:
+        """Message with its segment table (single segment)"""
+        return struct.pack('<II', 0, self.n_words) + bytes(self.buf)
+
+
+def msh_bytes(db: SketchDB,
+              counts: Optional[List[np.ndarray]] = None,
+              alphabet: str = 'ACGT',
+              window_size: int = 0,
+              concatenated: bool = True,
+              noncanonical: bool = False,
+              preserve_case: bool = False,
+              error: float = 0.0) -> bytes:
+    """Encode sketches as a Mash sketch file
+
+    Args:
+        db: Sketches to encode
+        counts: Multiplicity of each sketch's min-hashes (written for read sketches like `mash sketch -m` does)
+        alphabet: Sketch alphabet
+        window_size: Mash window size header field
+        concatenated: Whether each sketch is of all sequences of a file concatenated (i.e. no `mash sketch -i`)
+        noncanonical: Whether non-canonical k-mers were hashed
+        preserve_case: Whether sequence case was preserved
+        error: Mash error header field
+
+    Returns:
+        (bytes): `.msh` file contents
+    """
+    seg = SegmentBuilder()
+    root = seg.init_struct(0, 3, 4)
+    ref_list = seg.init_struct(root + 3 + 2, 0, 1)
+    first_ref = seg.init_struct_list(ref_list, len(db), 2, 7)
+    hashes_ptr, hashes_size = (4, LIST_FOUR_BYTES) if db.hash_bits == 32 else (5, LIST_EIGHT_BYTES)
+    for i in range(len(db)):
+        ref = first_ref + 9 * i
+        ptrs = ref + 2
+        seg.set_text(ptrs + 2, str(db.names[i]))
+        seg.set_text(ptrs + 3, str(db.comments[i]))
+        struct.pack_into('<Q', seg.buf, 8 * (ref + 1), int(db.lengths[i]))
+        hashes = db.row_hashes(i)
+        if hashes.size > 0:
+            data = np.asarray(hashes, dtype=db.hash_dtype.newbyteorder('<')).tobytes()
+            seg.set_data(ptrs + hashes_ptr, data, hashes_size, hashes.size)
+        if counts is not None and counts[i].size > 0:
+            seg.set_data(ptrs + 6, np.asarray(counts[i], dtype='<u4').tobytes(), LIST_FOUR_BYTES, counts[i].size)
+            seg.buf[8 * ref + 4] |= 1
+    locus_list = seg.init_struct(root + 3 + 1, 0, 1)
+    seg.init_struct_list(locus_list, 0, 3, 0)
+    struct.pack_into('<IIIxxxxfI', seg.buf, 8 * root, db.kmer_size, window_size, db.sketch_size, error,
+                     db.hash_seed)
+    seg.buf[8 * root + 12] = concatenated | (noncanonical << 1) | (preserve_case << 2)
+    seg.set_text(root + 3 + 3, alphabet)
+    return seg.to_bytes()
+
+
+def write_msh(db: SketchDB, path: str, counts: Optional[List[np.ndarray]] = None, **kwargs) -> str:
+    """Write sketches to a Mash sketch file
+
+    Args:
+        db: Sketches to write
+        path: Output `.msh` path
+        counts: Multiplicity of each sketch's min-hashes (read sketches)
+        **kwargs: Extra Mash header fields (see `msh_bytes`)
+
+    Returns:
+        (str): Output `.msh` path
+    """
+    with open(path, 'wb') as f:
+        f.write(msh_bytes(db, counts=counts, **kwargs))
+    return path
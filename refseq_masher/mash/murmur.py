@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+
+"""Vectorized MurmurHash3_x64_128 as used by Mash for hashing k-mers
+
+Mash hashes each canonical k-mer with MurmurHash3_x64_128 and keeps the first
+64-bit half of the digest (or the lower 32 bits of it for k <= 16). Here many
+equal-length keys are hashed at once, with each key given as little-endian
+64-bit words (zero-padded past the key length).
+"""
+
+from typing import Tuple
+
+import numpy as np
+
+_C1 = np.uint64(0x87c37b91114253d5)
+_C2 = np.uint64(0x4cf5ad432745937f)
+_FMIX1 = np.uint64(0xff51afd7ed558ccd)
+_FMIX2 = np.uint64(0xc4ceb9fe1a85ec53)
+
+
+def _rotl64(x: np.ndarray, r: int) -> np.ndarray:
+    return (x << np.uint64(r)) | (x >> np.uint64(64 - r))
+
+
+def _fmix64(k: np.ndarray) -> np.ndarray:
+    k = k ^ (k >> np.uint64(33))
+    k = k * _FMIX1
+    k = k ^ (k >> np.uint64(33))
+    k = k * _FMIX2
+    return k ^ (k >> np.uint64(33))
+
+
+def _mix_k1(k1: np.ndarray) -> np.ndarray:
+    return _rotl64(k1 * _C1, 31) * _C2
+
+
+def _mix_k2(k2: np.ndarray) -> np.ndarray:
+    return _rotl64(k2 * _C2, 33) * _C1
+
+
+def murmurhash3_x64_128(words: np.ndarray, length: int, seed: int = 42) -> Tuple[np.ndarray, np.ndarray]:
+    """MurmurHash3_x64_128 of many equal-length keys
+
+    Args:
+        words: uint64 array of shape (n keys, ceil(length / 8)) with each key's bytes packed little-endian
+            and zero-padded past `length`
+        length: Key length in bytes
+        seed: Hash seed (Mash default is 42)
+
+    Returns:
+        (np.ndarray, np.ndarray): first and second 64-bit halves of the 128-bit digest of each key
+    """
+    words = np.asarray(words, dtype=np.uint64)
+    if words.ndim == 1:
+        words = words[:, np.newaxis]
+    n = words.shape[0]
+    assert words.shape[1] * 8 >= length, 'Need ceil(length / 8) words per key'
+    h1 = np.full(n, seed & 0xffffffff, dtype=np.uint64)
+    h2 = h1.copy()
+    nblocks = length // 16
+    for i in range(nblocks):
+        h1 ^= _mix_k1(words[:, 2 * i])
+        h1 = _rotl64(h1, 27)
+        h1 += h2
+        h1 = h1 * np.uint64(5) + np.uint64(0x52dce729)
+        h2 ^= _mix_k2(words[:, 2 * i + 1])
+        h2 = _rotl64(h2, 31)
+        h2 += h1
+        h2 = h2 * np.uint64(5) + np.uint64(0x38495ab5)
+    tail = length & 15
+    if tail > 8:
+        h2 ^= _mix_k2(words[:, 2 * nblocks + 1])
+    if tail > 0:
+        h1 ^= _mix_k1(words[:, 2 * nblocks])
+    h1 ^= np.uint64(length)
+    h2 ^= np.uint64(length)
+    h1 += h2
+    h2 += h1
+    h1 = _fmix64(h1)
+    h2 = _fmix64(h2)
+    h1 += h2
+    h2 += h1
+    return h1, h2
+
+
+def pack_bytes(keys: np.ndarray) -> np.ndarray:
+    """Pack equal-length byte keys into little-endian uint64 words for `murmurhash3_x64_128`
+
+    Args:
+        keys: uint8 array of shape (n keys, key length)
+
+    Returns:
+        (np.ndarray): uint64 array of shape (n keys, ceil(key length / 8))
+    """
+    n, length = keys.shape
+    nwords = (length + 7) // 8
+    padded = np.zeros((n, nwords * 8), dtype=np.uint8)
+    padded[:, :length] = keys
+    return padded.view('<u8').astype(np.uint64, copy=False)
@@ -0,0 +1,270 @@
+# -*- coding: utf-8 -*-
+
+"""In-process Mash dist of query sketches against a sketch database using the inverted hash index
+
+Only reference sketches sharing at least one hash with the query are found
+through the inverted hash index. For those candidates, the Mash Jaccard
+estimate (shared hashes among the bottom-s hashes of the union of both
+sketches) is computed from each shared hash's rank in the query and in the
+reference sketch, without merging the sketches. All other references get the
+Mash dist values for no shared hashes (distance=1, p-value=1).
+
+In the coarse-to-fine (fast) mode, queries are first scored against a
+bottom-50 downsampled copy of the database and only the best candidates are
+rescored at full sketch resolution.
+"""
+
+import logging
+from typing import List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+from .index import HashIndex, refseq_hash_index, load_hash_index
+from .parser import MASH_DIST_4_COLUMNS, mash_dist_table_to_dataframe
+from .sketchdb import SketchDB, refseq_sketch_db, mash_info_dump, load_downsampled_sketch_db
+from .stats import mash_distance, dist_pvalue, round_like_mash
+from ..utils import load_once
+
+#: Sketch size of the downsampled reference used for coarse scoring in fast mode
+COARSE_SKETCH_SIZE = 50
+
+
+def exact_common_and_denom(query_hashes: np.ndarray, db: SketchDB, rows: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Mash dist shared hash count and denominator of a query sketch with selected reference sketches
+
+    Args:
+        query_hashes: sorted distinct query sketch min-hashes
+        db: Reference sketches
+        rows: Reference sketch rows to compare against
+
+    Returns:
+        (np.ndarray, np.ndarray): shared hashes among the bottom-s union hashes and the bottom-s union size
+    """
+    s = db.sketch_size
+    common = np.zeros(rows.size, dtype=np.int64)
+    denom = np.zeros(rows.size, dtype=np.int64)
+    for i, row in enumerate(rows):
+        ref_hashes = db.row_hashes(row)
+        union = np.union1d(ref_hashes, query_hashes)
+        shared = np.intersect1d(ref_hashes, query_hashes, assume_unique=True)
+        if union.size > s:
+            shared = shared[shared <= union[s - 1]]
+        common[i] = shared.size
+        denom[i] = min(union.size, s)
+    return common, denom
+
+
+class NativeDist:
+    """Mash distances of query sketches to all sketches of a database
+
+    Args:
+        db: Reference sketches
+        index: Inverted hash index of the reference sketches (built if not provided)
+    """
+
+    def __init__(self, db: SketchDB, index: Optional[HashIndex] = None):
+        self.db = db
+        self.index = index if index is not None else HashIndex.build(db)
+        self.sketch_sizes = db.sizes
+
+    def check_compatible(self, query: SketchDB) -> None:
+        if query.kmer_size != self.db.kmer_size or query.hash_seed != self.db.hash_seed:
+            raise ValueError('Query sketch parameters (k={}, seed={}) differ from the reference sketch database '
+                             '(k={}, seed={})'.format(query.kmer_size, query.hash_seed,
+                                                      self.db.kmer_size, self.db.hash_seed))
+
+    def common_and_denom(self, query_hashes: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """Mash dist shared hash count and denominator of a query sketch with every reference sketch
+
+        Args:
+            query_hashes: query sketch min-hashes
+
+        Returns:
+            (np.ndarray, np.ndarray): number of shared hashes among the bottom-s union hashes and the size of the
+                bottom-s union (Mash dist "matching" numerator and denominator) for each reference sketch
+        """
+        q = np.unique(query_hashes)
+        s = self.db.sketch_size
+        found, hash_positions = self.index.lookup(q)
+        which, rows, ref_ranks = self.index.postings(hash_positions)
+        query_ranks = found[which]
+        # postings are in ascending hash order; group them by reference row keeping that order
+        order = np.argsort(rows, kind='stable')
+        rows, query_ranks, ref_ranks = rows[order], query_ranks[order], ref_ranks[order]
+        _, starts, nshared = np.unique(rows, return_index=True, return_counts=True)
+        shared_ranks = np.arange(rows.size) - np.repeat(starts, nshared)
+        # 0-based position of each shared hash in the sorted union of query and reference hashes
+        union_ranks = ref_ranks + query_ranks - shared_ranks
+        common = np.bincount(rows[union_ranks < s], minlength=len(self.db))
+        shared_total = np.bincount(rows, minlength=len(self.db))
+        denom = np.minimum(self.sketch_sizes + q.size - shared_total, s)
+        return common, denom
+
+    def dist_table(self, query_hashes: np.ndarray, query_length: int) -> pd.DataFrame:
+        """Mash dist table of a query sketch against all reference sketches
+
+        Args:
+            query_hashes: query sketch min-hashes
+            query_length: query genome length (Mash sketch length)
+
+        Returns:
+            (pd.DataFrame): table with `MASH_DIST_4_COLUMNS` columns in reference order
+        """
+        k = self.db.kmer_size
+        common, denom = self.common_and_denom(query_hashes)
+        distance = mash_distance(common, denom, k)
+        pvalue = np.ones(common.size, dtype=np.float64)
+        candidates = np.flatnonzero(common > 0)
+        logging.info('Computing Mash distances for %s of %s reference sketches sharing hashes with the query',
+                     candidates.size, len(self.db))
+        pvalue[candidates] = dist_pvalue(common[candidates], self.db.lengths[candidates], query_length,
+                                         denom[candidates], k)
+        return pd.DataFrame(dict(match_id=self.db.names,
+                                 distance=round_like_mash(distance),
+                                 pvalue=round_like_mash(pvalue),
+                                 matching=['{}/{}'.format(x, y) for x, y in zip(common, denom)]),
+                            columns=MASH_DIST_4_COLUMNS)
+
+
+class FastNativeDist:
+    """Coarse-to-fine Mash distances: coarse scoring on downsampled sketches, exact rescoring of the best candidates
+
+    Args:
+        db: Reference sketches
+        coarse_db: Downsampled reference sketches
+        coarse_index: Inverted hash index of the downsampled reference sketches
+    """
+
+    def __init__(self, db: SketchDB, coarse_db: SketchDB, coarse_index: Optional[HashIndex] = None):
+        self.db = db
+        self.coarse = NativeDist(coarse_db, coarse_index)
+
+    def check_compatible(self, query: SketchDB) -> None:
+        self.coarse.check_compatible(query)
+
+    def dist_table(self, query_hashes: np.ndarray, query_length: int, n_candidates: int = 300) -> pd.DataFrame:
+        """Mash dist table of a query sketch against the best coarse-scored reference sketches
+
+        Candidates tied with the `n_candidates`-th best coarse score are all rescored, since with few coarse hashes
+        many closely related genomes (e.g. of one species) can have the same coarse score.
+
+        Args:
+            query_hashes: query sketch min-hashes
+            query_length: query genome length (Mash sketch length)
+            n_candidates: number of best coarse-scored reference sketches to rescore at full resolution
+
+        Returns:
+            (pd.DataFrame): table with `MASH_DIST_4_COLUMNS` columns and the `coarse_rank` of each candidate (genomes
+                with the same coarse score have the same rank)
+        """
+        k = self.db.kmer_size
+        q = np.unique(query_hashes)
+        coarse_common, coarse_denom = self.coarse.common_and_denom(q[:self.coarse.db.sketch_size])
+        coarse_distance = mash_distance(coarse_common, coarse_denom, k)
+        order = np.lexsort((-coarse_common, coarse_distance))
+        order = order[coarse_common[order] > 0]
+        sorted_distance = coarse_distance[order]
+        sorted_common = coarse_common[order]
+        # genomes with the same coarse score are ranked the same (rank of the first of them)
+        new_score = np.ones(order.size, dtype=bool)
+        new_score[1:] = (sorted_distance[1:] != sorted_distance[:-1]) | (sorted_common[1:] != sorted_common[:-1])
+        coarse_rank = np.maximum.accumulate(np.where(new_score, np.arange(order.size), 0)) + 1
+        n = min(n_candidates, order.size)
+        if n < order.size and not new_score[n]:
+            # rescore all genomes tied with the last candidate rather than an arbitrary slice of them
+            n_tied = int(np.argmax(new_score[n:])) if new_score[n:].any() else order.size - n
+            logging.info('%s reference sketches have the same coarse score as the last of the %s best '
+                         'coarse-scored candidates; rescoring all of them at full resolution', n_tied + 1, n)
+            n += n_tied
+        rows = order[:n]
+        coarse_rank = coarse_rank[:n]
+        logging.info('Rescoring %s best of %s coarse-scored reference sketches at full resolution',
+                     rows.size, len(self.db))
+        common, denom = exact_common_and_denom(q, self.db, rows)
+        distance = mash_distance(common, denom, k)
+        pvalue = np.ones(rows.size, dtype=np.float64)
+        shared = common > 0
+        pvalue[shared] = dist_pvalue(common[shared], self.db.lengths[rows[shared]], query_length,
+                                     denom[shared], k)
+        return pd.DataFrame(dict(match_id=self.db.names[rows],
+                                 distance=round_like_mash(distance),
+                                 pvalue=round_like_mash(pvalue),
+                                 matching=['{}/{}'.format(x, y) for x, y in zip(common, denom)],
+                                 coarse_rank=coarse_rank),
+                            columns=MASH_DIST_4_COLUMNS + ['coarse_rank'])
+
+
+def check_fast_rankings(df: pd.DataFrame, n_candidates: int, tolerance: float = 0.5) -> pd.DataFrame:
+    """Warn if top fast mode results were ranked poorly by the coarse stage and drop the `coarse_rank` column
+
+    If a reported result was ranked near the end of the coarse candidates, other true hits may have been ranked
+    just outside of them, so the fast mode results may differ from a full resolution search.
+
+    Args:
+        df: Top fast mode results with a `coarse_rank` column
+        n_candidates: Number of coarse candidates rescored at full resolution
+        tolerance: Max coarse rank of any reported result as a fraction of `n_candidates`
+
+    Returns:
+        (pd.DataFrame): results without the `coarse_rank` column
+    """
+    if df.shape[0] > 0:
+        max_rank = int(df.coarse_rank.max())
+        if max_rank > tolerance * n_candidates:
+            logging.warning('Coarse and fine rankings disagree for sample "%s": a reported match was ranked %s of '
+                            '%s by the coarse search (tolerance=%s). Consider increasing --fast-candidates.',
+                            df['sample'].iloc[0], max_rank, n_candidates, tolerance)
+    return df.drop(columns=['coarse_rank'])
+
+
+@load_once
+def refseq_fast_dist_engine(mash_bin: str = 'mash', coarse_sketch_size: int = COARSE_SKETCH_SIZE) -> FastNativeDist:
+    """Coarse-to-fine dist engine for the bundled RefSeq sketch database, loaded once per process"""
+    db = refseq_sketch_db(mash_bin=mash_bin)
+    coarse_db = load_downsampled_sketch_db(db, coarse_sketch_size)
+    return FastNativeDist(db, coarse_db, load_hash_index(coarse_db))
+
+
+@load_once
+def refseq_dist_engine(mash_bin: str = 'mash') -> NativeDist:
+    """Native dist engine for the bundled RefSeq sketch database, loaded once per process"""
+    return NativeDist(refseq_sketch_db(mash_bin=mash_bin), refseq_hash_index(mash_bin=mash_bin))
+
+
+def sketch_vs_refseq(sketch_path: str,
+                     engine,
+                     mash_bin: str = 'mash',
+                     columns: Optional[List[str]] = None,
+                     **kwargs) -> pd.DataFrame:
+    """Compute Mash distances of a sketch file to reference genome sketches in-process
+
+    Args:
+        sketch_path: Mash sketch file path with a single sketch
+        engine: In-process dist engine (e.g. `NativeDist`, `FastNativeDist`)
+        mash_bin: Mash binary path (used to decode the sketch file)
+        columns: Output columns to keep and parse (default: all)
+        **kwargs: extra arguments to the engine's `dist_table` method
+
+    Returns:
+        (pd.DataFrame): Mash dist results ordered by ascending distance
+    """
+    query = SketchDB.from_mash_info_json(mash_info_dump(sketch_path, mash_bin=mash_bin))
+    return query_vs_refseq(query, engine, columns=columns, **kwargs)
+
+
+def query_vs_refseq(query: SketchDB, engine, columns: Optional[List[str]] = None, **kwargs) -> pd.DataFrame:
+    """Compute Mash distances of an in-memory query sketch to reference genome sketches in-process
+
+    Args:
+        query: Query sketch database with a single sketch (e.g. sketched with `native_sketch`)
+        engine: In-process dist engine (e.g. `NativeDist`, `FastNativeDist`)
+        columns: Output columns to keep and parse (default: all)
+        **kwargs: extra arguments to the engine's `dist_table` method
+
+    Returns:
+        (pd.DataFrame): Mash dist results ordered by ascending distance
+    """
+    engine.check_compatible(query)
+    df = engine.dist_table(query.row_hashes(0), int(query.lengths[0]), **kwargs)
+    return mash_dist_table_to_dataframe(df, columns=columns)
@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+
+"""In-process NumPy containment screen engine with `mash screen` semantics
+
+The reference sketches are loaded once per process. For each sample, all
+canonical k-mers of the inputs are hashed at the reference's k-mer size and
+seed and the multiplicity of each observed hash of the union of the reference
+sketches' min-hashes is counted. Only the references containing an observed
+hash are found through the inverted hash index and their shared hashes,
+identity, median multiplicity and p-value are computed as `mash screen` does,
+so many samples can be screened against one loaded reference.
+"""
+
+import logging
+from typing import List, Optional, Union
+
+import numpy as np
+import pandas as pd
+
+from .hll import HyperLogLog
+from .index import HashIndex, refseq_hash_index
+from .kmers import kmer_hashes
+from .parser import MASH_SCREEN_COLUMNS, mash_screen_table_to_dataframe
+from .sketchdb import SketchDB, refseq_sketch_db
+from .stats import screen_identity, screen_pvalue, round_like_mash
+from ..seqio import iter_sequences, batch_sequences
+from ..utils import bounded_imap, load_once
+
+
+class ScreenState:
+    """Running per-sample screen state: multiplicity of each observed reference union hash and distinct k-mer estimate
+
+    Only the observed reference hashes are kept so that the state's size and the cost of folding in and scoring new
+    k-mers grow with the sample's hits rather than with the reference database.
+    """
+
+    def __init__(self, hash_bits: int):
+        #: sorted positions of the observed hashes in the reference union hashes and their multiplicities
+        self.positions = np.empty(0, dtype=np.int64)
+        self.counts = np.empty(0, dtype=np.int64)
+        self.hll = HyperLogLog(hash_bits=hash_bits)
+
+
+class NativeScreen:
+    """Containment screen of samples against a set of reference Mash sketches
+
+    Args:
+        db: Reference sketches
+        index: Inverted hash index of the reference sketches (built if not provided)
+    """
+
+    def __init__(self, db: SketchDB, index: Optional[HashIndex] = None):
+        self.db = db
+        self.index = index if index is not None else HashIndex.build(db)
+        #: sorted distinct hashes across all reference sketches
+        self.union_hashes = self.index.hashes
+        self.sketch_sizes = db.sizes
+        logging.info('%s distinct reference hashes', self.union_hashes.size)
+
+    def new_state(self) -> ScreenState:
+        return ScreenState(self.db.hash_bits)
+
+    def hash_sequences(self, seqs: List[bytes]) -> np.ndarray:
+        """Mash hashes of all canonical k-mers in `seqs` at the reference k-mer size and seed"""
+        return kmer_hashes(seqs, k=self.db.kmer_size, seed=self.db.hash_seed)
+
+    def add_hashes(self, state: ScreenState, hashes: np.ndarray) -> None:
+        """Fold k-mer hashes into a screen state"""
+        state.hll.add(hashes)
+        _, idx = self.index.lookup(hashes)
+        new_positions, new_counts = np.unique(idx, return_counts=True)
+        all_positions = np.concatenate((state.positions, new_positions))
+        all_counts = np.concatenate((state.counts, new_counts))
+        state.positions, inverse = np.unique(all_positions, return_inverse=True)
+        state.counts = np.bincount(inverse, weights=all_counts).astype(np.int64)
+
+    def add_files(self, state: ScreenState, inputs: List[str], parallelism: int = 1) -> None:
+        """Hash all k-mers in the sequence files and fold them into a screen state"""
+        seqs = (seq for path in inputs for seq in iter_sequences(path))
+        for hashes in bounded_imap(self.hash_sequences, batch_sequences(seqs), n_workers=parallelism):
+            self.add_hashes(state, hashes)
+
+    def results(self,
+                state: ScreenState,
+                min_identity: float = 0.9,
+                max_pvalue: float = 0.01) -> Optional[pd.DataFrame]:
+        """Mash screen results table for a screen state
+
+        Args:
+            state: Screen state
+            min_identity: Min identity to report
+            max_pvalue: Max p-value to report
+
+        Returns:
+            (pd.DataFrame): table with `MASH_SCREEN_COLUMNS` columns in reference order or None if nothing passed
+                the identity and p-value thresholds
+        """
+        which, hit_rows, _ = self.index.postings(state.positions)
+        # only the references sharing an observed hash are scored
+        rows, shared = np.unique(hit_rows, return_counts=True)
+        identity = screen_identity(shared, self.sketch_sizes[rows], self.db.kmer_size)
+        keep = identity >= min_identity
+        rows, shared, identity = rows[keep], shared[keep], identity[keep]
+        set_size = state.hll.cardinality()
+        pvalue = screen_pvalue(shared, self.sketch_sizes[rows], set_size, self.db.kmer_size)
+        keep = pvalue <= max_pvalue
+        rows, shared, identity, pvalue = rows[keep], shared[keep], identity[keep], pvalue[keep]
+        if rows.size == 0:
+            return None
+        # median multiplicity of each reported reference's shared hashes
+        reported = np.isin(hit_rows, rows)
+        depth_rows = hit_rows[reported]
+        depths = state.counts[which[reported]]
+        order = np.lexsort((depths, depth_rows))
+        depth_rows, depths = depth_rows[order], depths[order]
+        _, starts, nshared = np.unique(depth_rows, return_index=True, return_counts=True)
+        median_multiplicity = depths[starts + nshared // 2].astype(np.int64)
+        return pd.DataFrame(dict(identity=round_like_mash(identity),
+                                 shared_hashes=['{}/{}'.format(x, y) for x, y in
+                                                zip(shared, self.sketch_sizes[rows])],
+                                 median_multiplicity=median_multiplicity,
+                                 pvalue=round_like_mash(pvalue),
+                                 match_id=self.db.names[rows],
+                                 match_comment=self.db.comments[rows]),
+                            columns=MASH_SCREEN_COLUMNS)
+
+    def screen(self,
+               inputs: List[str],
+               min_identity: float = 0.9,
+               max_pvalue: float = 0.01,
+               parallelism: int = 1) -> Optional[pd.DataFrame]:
+        """Screen sequence files against the reference sketches
+
+        Returns:
+            (pd.DataFrame): table with `MASH_SCREEN_COLUMNS` columns or None if nothing passed the thresholds
+        """
+        state = self.new_state()
+        self.add_files(state, inputs, parallelism=parallelism)
+        logging.info('Estimated distinct k-mers in pool: %s', int(state.hll.cardinality()))
+        return self.results(state, min_identity=min_identity, max_pvalue=max_pvalue)
+
+
+@load_once
+def refseq_screen_engine(mash_bin: str = 'mash') -> NativeScreen:
+    """Native screen engine for the bundled RefSeq sketch database, loaded once per process"""
+    return NativeScreen(refseq_sketch_db(mash_bin=mash_bin), refseq_hash_index(mash_bin=mash_bin))
+
+
+def vs_refseq(inputs: Union[str, List[str]],
+              mash_bin: str = 'mash',
+              sample_name: str = None,
+              max_pvalue: float = 0.01,
+              min_identity: float = 0.9,
+              parallelism: int = 1,
+              columns: Optional[List[str]] = None) -> Optional[pd.DataFrame]:
+    """Screen input sequence files against the RefSeq genomes sketch database in-process
+
+    Drop-in alternative to `refseq_masher.mash.screen.vs_refseq` that does not run `mash screen`.
+
+    Args:
+        inputs: Input sequence files
+        mash_bin: Mash binary path (only used to decode the RefSeq sketch database on first use)
+        sample_name: Sample name
+        max_pvalue: Max p-value to report
+        min_identity: Min identity to report
+        parallelism: Number of k-mer hashing threads
+        columns: Output columns to keep and parse (default: all)
+
+    Returns:
+        (pd.DataFrame): Parsed screen results dataframe or None if there were no results
+    """
+    if isinstance(inputs, str):
+        inputs = [inputs]
+    elif not isinstance(inputs, list):
+        raise TypeError('Unexpected type "{}" for "inputs": {}'.format(type(inputs), inputs))
+    engine = refseq_screen_engine(mash_bin)
+    logging.info('Running native screen with NCBI RefSeq sketch database '
+                 'against sample "%s" with inputs: %s', sample_name, inputs)
+    df = engine.screen(inputs, min_identity=min_identity, max_pvalue=max_pvalue, parallelism=parallelism)
+    if df is None:
+        return None
+    df = mash_screen_table_to_dataframe(df, columns=columns)
+    df['sample'] = sample_name
+    return df
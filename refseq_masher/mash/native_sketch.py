@@ -0,0 +1,198 @@
+# -*- coding: utf-8 -*-
+
+"""Running Mash sketches of streamed sequences with the `mash sketch -m` k-mer multiplicity filter
+
+Like Mash's min-hash heap, a sketch keeps the bottom-s hashes seen at least
+`min_copies` times and counts hashes that have not reached `min_copies` yet
+only while they are below the largest hash of a full sketch. The sketch's
+largest hash only decreases as sequences are added, so folding sequences in
+batch by batch yields the same sketch as sketching all sequences at once.
+
+`sketch_fasta` and `sketch_fastqs` are in-process equivalents of the Mash
+sketch calls in `refseq_masher.mash.sketch`; sketches can be queried directly
+by the in-process engines or written as Mash sketch files (see `msh`).
+"""
+
+import logging
+from typing import Iterable, List, Optional
+
+import numpy as np
+
+from .kmers import kmer_hashes, hash_bits_for_kmer_size
+from .msh import write_msh
+from .sketchdb import SketchDB
+from ..seqio import iter_sequences, batch_sequences
+from ..utils import bounded_imap
+
+
+class SketchState:
+    """Running bottom-s min-hash sketch
+
+    Args:
+        kmer_size: k-mer size
+        sketch_size: max number of min-hashes (Mash `-s`)
+        min_copies: min times a k-mer needs to be observed to be added to the sketch (Mash `-m`)
+        hash_seed: Mash hash seed
+    """
+
+    def __init__(self, kmer_size: int = 16, sketch_size: int = 400, min_copies: int = 1, hash_seed: int = 42):
+        self.kmer_size = kmer_size
+        self.sketch_size = sketch_size
+        self.min_copies = min_copies
+        self.hash_seed = hash_seed
+        self.hash_bits = hash_bits_for_kmer_size(kmer_size)
+        dtype = np.uint32 if self.hash_bits == 32 else np.uint64
+        #: sorted sketch min-hashes and the number of times each was seen
+        self.hashes = np.empty(0, dtype=dtype)
+        self.counts = np.empty(0, dtype=np.int64)
+        #: sorted hashes below the sketch's largest hash seen fewer than `min_copies` times and their counts
+        self.pending = np.empty(0, dtype=dtype)
+        self.pending_counts = np.empty(0, dtype=np.int64)
+        #: number of sequence bases added
+        self.bases = 0
+
+    @property
+    def is_full(self) -> bool:
+        return self.hashes.size >= self.sketch_size
+
+    def add_hashes(self, hashes: np.ndarray) -> None:
+        """Fold k-mer hashes into the sketch"""
+        if self.is_full:
+            hashes = hashes[hashes <= self.hashes[-1]]
+        new_hashes, new_counts = np.unique(hashes, return_counts=True)
+        all_hashes = np.concatenate((self.hashes, self.pending, new_hashes))
+        all_counts = np.concatenate((self.counts, self.pending_counts, new_counts))
+        uniq, inverse = np.unique(all_hashes, return_inverse=True)
+        counts = np.bincount(inverse, weights=all_counts).astype(np.int64)
+        passed = counts >= self.min_copies
+        sketch = np.flatnonzero(passed)[:self.sketch_size]
+        self.hashes, self.counts = uniq[sketch], counts[sketch]
+        pending = ~passed
+        if self.is_full:
+            pending &= uniq < self.hashes[-1]
+        self.pending, self.pending_counts = uniq[pending], counts[pending]
+
+    def hash_sequences(self, seqs: List[bytes]) -> np.ndarray:
+        """Mash hashes of all canonical k-mers in `seqs` at the sketch's k-mer size and seed"""
+        return kmer_hashes(seqs, k=self.kmer_size, seed=self.hash_seed)
+
+    def add_sequences(self, seqs: List[bytes]) -> None:
+        """Hash all canonical k-mers of the sequences and fold them into the sketch"""
+        self.bases += sum(len(seq) for seq in seqs)
+        self.add_hashes(self.hash_sequences(seqs))
+
+    def estimated_length(self) -> int:
+        """Genome size estimated from the sketch's k-mer content as Mash does for reads sketches
+
+        Like Mash's `estimateSetSize`, the estimate is `2^bits * size / max_hash` also for sketches with fewer than
+        `sketch_size` hashes, so that native and Mash sketches of the same reads get the same length and p-values.
+        """
+        if self.hashes.size == 0:
+            return 0
+        return int(2.0 ** self.hash_bits * self.hashes.size / float(self.hashes[-1]))
+
+    def to_sketch_db(self, name: str, comment: str = '', reads: bool = False) -> SketchDB:
+        """Single sketch database of this sketch
+
+        Args:
+            name: sketch name
+            comment: sketch comment
+            reads: whether reads were sketched, in which case the sketch length is the genome size estimated from
+                the sketch rather than the number of bases like Mash does
+
+        Returns:
+            (SketchDB): sketch database with one sketch
+        """
+        length = self.estimated_length() if reads else self.bases
+        return SketchDB(kmer_size=self.kmer_size,
+                        hash_seed=self.hash_seed,
+                        hash_bits=self.hash_bits,
+                        sketch_size=self.sketch_size,
+                        names=np.array([name]),
+                        comments=np.array([comment]),
+                        lengths=np.array([length], dtype=np.int64),
+                        offsets=np.array([0, self.hashes.size], dtype=np.int64),
+                        hashes=self.hashes.copy())
+
+    def write_msh(self, path: str, name: str, comment: str = '', reads: bool = False) -> str:
+        """Write this sketch to a Mash sketch file like `mash sketch` (with `-m` for reads) would
+
+        Args:
+            path: Output `.msh` path
+            name: sketch name
+            comment: sketch comment
+            reads: whether reads were sketched (see `to_sketch_db`); hash counts are written for reads
+
+        Returns:
+            (str): Output `.msh` path
+        """
+        return write_msh(self.to_sketch_db(name, comment, reads=reads), path,
+                         counts=[self.counts] if reads else None)
+
+
+def sketch_sequences(seqs: Iterable[bytes],
+                     kmer_size: int = 16,
+                     sketch_size: int = 400,
+                     min_copies: int = 1,
+                     hash_seed: int = 42,
+                     parallelism: int = 1,
+                     state: Optional[SketchState] = None) -> SketchState:
+    """Mash sketch of sequences, e.g. read from files or any in-memory stream
+
+    Args:
+        seqs: nucleotide sequences
+        kmer_size: k-mer size
+        sketch_size: max number of min-hashes (Mash `-s`)
+        min_copies: min times a k-mer needs to be observed to be added to the sketch (Mash `-m`)
+        hash_seed: Mash hash seed
+        parallelism: number of k-mer hashing threads
+        state: running sketch to add the sequences to (default: new sketch)
+
+    Returns:
+        (SketchState): sketch of the sequences
+    """
+    if state is None:
+        state = SketchState(kmer_size=kmer_size, sketch_size=sketch_size, min_copies=min_copies,
+                            hash_seed=hash_seed)
+
+    def hash_batch(batch):
+        return sum(len(seq) for seq in batch), state.hash_sequences(batch)
+
+    for n_bases, hashes in bounded_imap(hash_batch, batch_sequences(seqs), n_workers=parallelism):
+        state.bases += n_bases
+        state.add_hashes(hashes)
+    return state
+
+
+def sketch_fasta(fasta_path: str, k: int = 16, s: int = 400, parallelism: int = 1) -> SketchState:
+    """In-process equivalent of `mash sketch` of a genome FASTA file
+
+    Args:
+        fasta_path: FASTA file path (may be gzipped)
+        k: Mash kmer size
+        s: Mash number of min-hashes
+        parallelism: Number of k-mer hashing threads
+
+    Returns:
+        (SketchState): sketch of the genome
+    """
+    logging.info('Sketching "%s" in-process (k=%s, s=%s)', fasta_path, k, s)
+    return sketch_sequences(iter_sequences(fasta_path), kmer_size=k, sketch_size=s, parallelism=parallelism)
+
+
+def sketch_fastqs(fastqs: List[str], k: int = 16, s: int = 400, m: int = 8, parallelism: int = 1) -> SketchState:
+    """In-process equivalent of `mash sketch -m` of one or more FASTQ files
+
+    Args:
+        fastqs: FASTQ paths (may be gzipped)
+        k: Mash kmer size
+        s: Mash number of min-hashes
+        m: Mash number of times a k-mer needs to be observed in order to be considered for Mash sketch DB
+        parallelism: Number of k-mer hashing threads
+
+    Returns:
+        (SketchState): sketch of the reads
+    """
+    logging.info('Sketching "%s" in-process (k=%s, s=%s, m=%s)', fastqs, k, s, m)
+    seqs = (seq for path in fastqs for seq in iter_sequences(path))
+    return sketch_sequences(seqs, kmer_size=k, sketch_size=s, min_copies=m, parallelism=parallelism)
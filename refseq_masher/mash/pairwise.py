@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+
+"""All-vs-all Mash distances among sample sketches computed block by block
+
+Sample sketches are combined into one in-memory `SketchDB`. The distance
+matrix is computed for one block of `block_size` x `block_size` sample
+pairs at a time: the column block's sketches are indexed with an inverted
+`HashIndex` and all row block sketches are probed at once, so the Mash
+"matching" numerator and denominator of every pair in the block are
+computed with vectorized NumPy operations. Only one block of results is held
+in memory at a time.
+"""
+
+import logging
+import os
+from typing import Iterator, List, Tuple
+
+import numpy as np
+import pandas as pd
+
+from . import native_sketch
+from .index import HashIndex, ragged_positions
+from .sketch import sketch_fasta, sketch_fastqs
+from .sketchdb import SketchDB, mash_info_dump
+from .stats import mash_distance, dist_pvalue, round_like_mash
+from ..utils import bounded_imap
+
+#: Columns of the pairwise distance edge list output
+PAIRWISE_EDGE_COLUMNS = ['sample1', 'sample2', 'distance', 'pvalue', 'matching']
+
+
+def block_common_and_denom(db: SketchDB,
+                           rows: np.ndarray,
+                           cols: np.ndarray,
+                           col_index: HashIndex) -> Tuple[np.ndarray, np.ndarray]:
+    """Mash dist shared hash counts and denominators of all pairs of sketches in a block
+
+    Args:
+        db: Sample sketches
+        rows: Sketch rows of the block
+        cols: Sketch rows of the block columns
+        col_index: Inverted hash index of the sketches at `cols`
+
+    Returns:
+        (np.ndarray, np.ndarray): `len(rows)` x `len(cols)` arrays of shared hashes among the bottom-s union hashes
+            and bottom-s union sizes
+    """
+    s = db.sketch_size
+    n_rows, n_cols = rows.size, cols.size
+    row_sizes = db.sizes[rows]
+    starts = db.offsets[rows]
+    positions = ragged_positions(starts, row_sizes)
+    row_of = np.repeat(np.arange(n_rows), row_sizes)
+    row_ranks = positions - np.repeat(starts, row_sizes)
+    found, hash_positions = col_index.lookup(np.asarray(db.hashes[positions]))
+    which, col_of, col_ranks = col_index.postings(hash_positions)
+    row_of, row_ranks = row_of[found[which]], row_ranks[found[which]]
+    # postings are in ascending hash order within each row sketch; group them by pair keeping that order
+    pairs = row_of * n_cols + col_of
+    order = np.argsort(pairs, kind='stable')
+    pairs, row_ranks, col_ranks = pairs[order], row_ranks[order], col_ranks[order]
+    _, pair_starts, nshared = np.unique(pairs, return_index=True, return_counts=True)
+    shared_ranks = np.arange(pairs.size) - np.repeat(pair_starts, nshared)
+    # 0-based position of each shared hash in the sorted union of both sketches
+    union_ranks = row_ranks + col_ranks - shared_ranks
+    common = np.bincount(pairs[union_ranks < s], minlength=n_rows * n_cols).reshape(n_rows, n_cols)
+    shared_total = np.bincount(pairs, minlength=n_rows * n_cols).reshape(n_rows, n_cols)
+    denom = np.minimum(row_sizes[:, np.newaxis] + db.sizes[cols][np.newaxis, :] - shared_total, s)
+    return common, denom
+
+
+class PairwiseDist:
+    """Blockwise all-vs-all Mash distances among sketches
+
+    Args:
+        db: Sample sketches
+        block_size: Number of sketches per row and column block
+        parallelism: Number of row blocks computed concurrently
+    """
+
+    def __init__(self, db: SketchDB, block_size: int = 500, parallelism: int = 1):
+        self.db = db
+        self.block_size = max(block_size, 1)
+        self.parallelism = parallelism
+        self.blocks = [np.arange(start, min(start + self.block_size, len(db)))
+                       for start in range(0, len(db), self.block_size)]
+        self.block_indexes = [HashIndex.build(db.subset(cols)) for cols in self.blocks]
+
+    def block_dist(self, i: int, j: int) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        """Mash distances, p-values, shared hashes and denominators of the pairs in row block i and column block j"""
+        rows, cols = self.blocks[i], self.blocks[j]
+        k = self.db.kmer_size
+        common, denom = block_common_and_denom(self.db, rows, cols, self.block_indexes[j])
+        distance = mash_distance(common, denom, k)
+        pvalue = np.ones(common.shape, dtype=np.float64)
+        shared = common > 0
+        query_lengths = np.broadcast_to(self.db.lengths[rows][:, np.newaxis], common.shape)
+        ref_lengths = np.broadcast_to(self.db.lengths[cols][np.newaxis, :], common.shape)
+        pvalue[shared] = dist_pvalue(common[shared], ref_lengths[shared], query_lengths[shared], denom[shared], k)
+        return distance, pvalue, common, denom
+
+    def matrix_blocks(self) -> Iterator[pd.DataFrame]:
+        """Rows of the dense distance matrix, one row block at a time
+
+        Yields:
+            (pd.DataFrame): `sample` column and one distance column per sample for each row block
+        """
+        def row_block(i):
+            distance = np.hstack([self.block_dist(i, j)[0] for j in range(len(self.blocks))])
+            df = pd.DataFrame(round_like_mash(distance.ravel()).reshape(distance.shape),
+                              columns=self.db.names)
+            df.insert(0, 'sample', self.db.names[self.blocks[i]])
+            return df
+
+        for i, df in enumerate(bounded_imap(row_block, range(len(self.blocks)), n_workers=self.parallelism)):
+            logging.info('Computed distance matrix row block %s of %s', i + 1, len(self.blocks))
+            yield df
+
+    def edge_blocks(self, max_distance: float = 0.05) -> Iterator[pd.DataFrame]:
+        """Sample pairs within `max_distance` of each other, one row block at a time
+
+        Only the upper triangle of the symmetric distance matrix is computed and each pair is reported once.
+
+        Yields:
+            (pd.DataFrame): table with `PAIRWISE_EDGE_COLUMNS` columns for each row block
+        """
+        def row_block(i):
+            dfs = []
+            for j in range(i, len(self.blocks)):
+                distance, pvalue, common, denom = self.block_dist(i, j)
+                keep = distance <= max_distance
+                if i == j:
+                    keep &= np.triu(np.ones(keep.shape, dtype=bool), k=1)
+                r, c = np.nonzero(keep)
+                dfs.append(pd.DataFrame(dict(sample1=self.db.names[self.blocks[i][r]],
+                                             sample2=self.db.names[self.blocks[j][c]],
+                                             distance=round_like_mash(distance[r, c]),
+                                             pvalue=round_like_mash(pvalue[r, c]),
+                                             matching=['{}/{}'.format(x, y) for x, y in
+                                                       zip(common[r, c], denom[r, c])]),
+                                        columns=PAIRWISE_EDGE_COLUMNS))
+            return pd.concat(dfs, ignore_index=True)
+
+        for i, df in enumerate(bounded_imap(row_block, range(len(self.blocks)), n_workers=self.parallelism)):
+            logging.info('Computed distances of row block %s of %s: %s pairs within distance %s',
+                         i + 1, len(self.blocks), df.shape[0], max_distance)
+            yield df
+
+
+def sketch_samples(contigs: List[Tuple[str, str]],
+                   reads: List[Tuple[List[str], str]],
+                   mash_bin: str = 'mash',
+                   tmp_dir: str = '/tmp',
+                   k: int = 16,
+                   s: int = 400,
+                   m: int = 8,
+                   parallelism: int = 1,
+                   sketcher: str = 'native') -> SketchDB:
+    """Mash sketch each sample as `matches` does and combine the decoded sketches named by sample
+
+    Args:
+        contigs: FASTA paths and sample names
+        reads: FASTQ paths and sample names
+        mash_bin: Mash binary path
+        tmp_dir: Temporary working directory
+        k: Mash kmer size
+        s: Mash number of min-hashes
+        m: Mash number of times a k-mer needs to be observed in order to be considered for Mash sketch DB (reads)
+        parallelism: Number of samples sketched concurrently
+        sketcher: "native" sketches in-process; "mash" runs Mash sketch and decodes the sketch with Mash info
+
+    Returns:
+        (SketchDB): one sketch per sample in input order
+    """
+    def sketch(sample):
+        is_reads, paths, sample_name = sample
+        if sketcher == 'native':
+            if is_reads:
+                state = native_sketch.sketch_fastqs(paths, k=k, s=s, m=m)
+            else:
+                state = native_sketch.sketch_fasta(paths, k=k, s=s)
+            return state.to_sketch_db(sample_name, reads=is_reads)
+        sketch_path = None
+        try:
+            if is_reads:
+                sketch_path = sketch_fastqs(paths, mash_bin=mash_bin, tmp_dir=tmp_dir, sample_name=sample_name,
+                                            k=k, s=s, m=m)
+            else:
+                sketch_path = sketch_fasta(paths, mash_bin=mash_bin, tmp_dir=tmp_dir, sample_name=sample_name,
+                                           k=k, s=s)
+            db = SketchDB.from_mash_info_json(mash_info_dump(sketch_path, mash_bin=mash_bin))
+            db.names = np.array([sample_name])
+            return db
+        finally:
+            if sketch_path and os.path.exists(sketch_path):
+                os.remove(sketch_path)
+
+    samples = [(False, path, name) for path, name in contigs] + [(True, paths, name) for paths, name in reads]
+    dbs = list(bounded_imap(sketch, samples, n_workers=parallelism))
+    logging.info('Sketched %s samples', len(dbs))
+    return SketchDB.concat(dbs)
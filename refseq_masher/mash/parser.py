@@ -1,9 +1,12 @@
+import csv
 import logging
-from io import StringIO
-from typing import Optional
+from io import BytesIO
+from typing import Optional, List, Tuple, Union
 
+import numpy as np
 import pandas as pd
 
+
 #: Sometimes Mash dist outputs 4 columns other times it outputs 5 columns
 MASH_DIST_4_COLUMNS = """
 match_id
@@ -27,13 +30,34 @@ pvalue
 match_id
 match_comment
 """.strip().split('\n')
+#: Fixed dtypes of numeric Mash dist and screen output columns; all other columns are strings
+MASH_OUTPUT_DTYPES = dict(distance=np.float64,
+                          pvalue=np.float64,
+                          identity=np.float64,
+                          median_multiplicity=np.int64)
+#: Max width in bytes of a numeric Mash output field parsed by `read_mash_table`
+MAX_NUMERIC_FIELD_WIDTH = 64
+#: RefSeq info fields parsed from each Mash `match_id` by `parse_refseq_info`
+REFSEQ_INFO_COLUMNS = """
+match_id
+taxid
+biosample
+bioproject
+assembly_accession
+plasmid
+serovar
+subspecies
+""".strip().split('\n')
+#: Mash dist and screen columns always parsed, since results are sorted by them
+MASH_DIST_SORT_COLUMNS = ['match_id', 'distance']
+MASH_SCREEN_SORT_COLUMNS = ['match_id', 'identity', 'median_multiplicity']
 
 
 def _no_periods(s: str) -> Optional[str]:
     return s if s != '.' else None
 
 
-def parse_refseq_info(match_id: str) -> dict:
+def parse_refseq_info(match_id: str, columns: Optional[List[str]] = None) -> dict:
     """Parse a RefSeq Mash match_id
 
     For example from the following `match_id`:
@@ -56,6 +80,8 @@ def parse_refseq_info(match_id: str) -> dict:
 
     Args:
         match_id (str): Mash RefSeq match_id with taxid, bioproject, full strain name, etc delimited by '-'
+        columns: Output columns to parse (default: all `REFSEQ_INFO_COLUMNS`); `match_id` and `taxid` (needed for
+            merging taxonomy info) are always returned
 
     Returns:
         (dict): parsed NCBI accession and other info
@@ -63,53 +89,198 @@ def parse_refseq_info(match_id: str) -> dict:
     logging.debug('Parsing RefSeq info from "%s"', match_id)
     sp = match_id.split('-')
     _, prefix, taxid_str, bioproject, biosample, assembly_acc, plasmid, fullname = sp
-    taxid = int(taxid_str)
-    fullname = fullname.replace('.fna', '')
-    serovar = None
-    subsp = None
-    if 'Salmonella' in fullname:
-        if '_serovar_' in fullname:
-            serovar = fullname.split('_serovar_')[-1].split('_str.')[0]
-        if '_subsp._' in fullname:
-            subsp = fullname.split('_subsp._')[-1].split('_')[0]
-
-    return dict(match_id=match_id,
-                taxid=taxid,
-                biosample=_no_periods(biosample),
-                bioproject=_no_periods(bioproject),
-                assembly_accession=_no_periods(assembly_acc),
-                plasmid=_no_periods(plasmid),
-                serovar=serovar,
-                subspecies=subsp)
-
-
-def mash_dist_output_to_dataframe(mash_out: str) -> pd.DataFrame:
+    info = dict(match_id=match_id, taxid=int(taxid_str))
+    if columns is None or 'biosample' in columns:
+        info['biosample'] = _no_periods(biosample)
+    if columns is None or 'bioproject' in columns:
+        info['bioproject'] = _no_periods(bioproject)
+    if columns is None or 'assembly_accession' in columns:
+        info['assembly_accession'] = _no_periods(assembly_acc)
+    if columns is None or 'plasmid' in columns:
+        info['plasmid'] = _no_periods(plasmid)
+    parse_serovar = columns is None or 'serovar' in columns
+    parse_subsp = columns is None or 'subspecies' in columns
+    if parse_serovar or parse_subsp:
+        fullname = fullname.replace('.fna', '')
+        serovar = None
+        subsp = None
+        if 'Salmonella' in fullname:
+            if parse_serovar and '_serovar_' in fullname:
+                serovar = fullname.split('_serovar_')[-1].split('_str.')[0]
+            if parse_subsp and '_subsp._' in fullname:
+                subsp = fullname.split('_subsp._')[-1].split('_')[0]
+        if parse_serovar:
+            info['serovar'] = serovar
+        if parse_subsp:
+            info['subspecies'] = subsp
+    return info
+
+
+def projected_columns(columns: List[str], output_columns: Optional[List[str]], required: List[str]) -> List[str]:
+    """Mash output `columns` needed for the requested `output_columns` (default: all) and the `required` ones"""
+    if output_columns is None:
+        return columns
+    return [col for col in columns if col in output_columns or col in required]
+
+
+def refseq_info_dataframe(df: pd.DataFrame,
+                          mash_columns: List[str],
+                          required: List[str],
+                          columns: Optional[List[str]] = None) -> pd.DataFrame:
+    """Merge RefSeq info parsed from each `match_id` into a sorted Mash results table
+
+    Args:
+        df: Sorted Mash results table
+        mash_columns: All Mash output columns of the table
+        required: Mash output columns kept even if not requested
+        columns: Output columns to keep and parse (default: all)
+
+    Returns:
+        (pd.DataFrame): Mash results with RefSeq info; string columns are left as objects so that results can be
+            cut to their top N before compacting them (see `utils.compact_dtypes`)
+    """
+    if columns is not None:
+        df = df.drop(columns=[col for col in mash_columns if col in df.columns and col not in columns
+                              and col not in required])
+    dfmatch = pd.DataFrame([parse_refseq_info(match_id=match_id, columns=columns) for match_id in df.match_id],
+                           columns=projected_columns(REFSEQ_INFO_COLUMNS, columns, ['match_id', 'taxid']))
+    return pd.merge(dfmatch, df, on='match_id')
+
+
+def field_bounds(mash_out: bytes) -> Tuple[np.ndarray, np.ndarray]:
+    """Start and end byte offsets of all fields of tab-delimited Mash output lines
+
+    Args:
+        mash_out: Mash stdout
+
+    Returns:
+        (np.ndarray, np.ndarray): start and end offsets of each field, both of shape (number of lines, fields per line)
+
+    Raises:
+        ValueError: if lines have different numbers of fields
+    """
+    buf = np.frombuffer(mash_out, dtype=np.uint8)
+    delims = np.flatnonzero((buf == ord('\t')) | (buf == ord('\n')))
+    is_eol = buf[delims] == ord('\n')
+    if buf.size > 0 and buf[-1] != ord('\n'):
+        delims = np.append(delims, buf.size)
+        is_eol = np.append(is_eol, True)
+    n_lines = int(is_eol.sum())
+    if n_lines == 0:
+        return np.empty((0, 0), dtype=np.int64), np.empty((0, 0), dtype=np.int64)
+    n_fields = int(np.argmax(is_eol)) + 1
+    if delims.size != n_lines * n_fields or not is_eol[n_fields - 1::n_fields].all():
+        raise ValueError('Mash output lines have different numbers of fields')
+    starts = np.concatenate(([0], delims[:-1] + 1))
+    return starts.reshape(n_lines, n_fields), delims.reshape(n_lines, n_fields)
+
+
+def parse_numeric_fields(mash_out: bytes, starts: np.ndarray, ends: np.ndarray, dtype) -> np.ndarray:
+    """Parse numeric fields by gathering their bytes into a fixed width bytes array and casting it to `dtype`"""
+    lengths = ends - starts
+    width = int(lengths.max()) if lengths.size > 0 else 1
+    if width == 0 or width > MAX_NUMERIC_FIELD_WIDTH:
+        raise ValueError('Unexpected numeric Mash output field width {}'.format(width))
+    buf = np.frombuffer(mash_out, dtype=np.uint8)
+    offsets = np.arange(width)
+    chars = buf[np.minimum(starts[:, None] + offsets, buf.size - 1)]
+    chars[offsets >= lengths[:, None]] = 0
+    return chars.view('S{}'.format(width)).ravel().astype(dtype)
+
+
+def read_mash_table(mash_out: Union[bytes, str],
+                    columns: List[str],
+                    usecols: Optional[List[str]] = None) -> pd.DataFrame:
+    """Read tab-delimited Mash output without a header into a typed dataframe
+
+    The raw stdout bytes are parsed with NumPy without decoding the whole output or copying it into a text buffer:
+    field offsets are found from the tab and newline positions, numeric columns (see `MASH_OUTPUT_DTYPES`) are cast
+    directly from their bytes and only string columns become Python strings. Output that does not fit this layout
+    (e.g. lines with different numbers of fields) is read with pandas instead.
+
+    Args:
+        mash_out: Mash stdout
+        columns: Names of all output columns in order
+        usecols: Columns to return (default: all)
+
+    Returns:
+        (pd.DataFrame): Mash output table
+    """
+    if isinstance(mash_out, str):
+        mash_out = mash_out.encode()
+    usecols = columns if usecols is None else usecols
+    try:
+        starts, ends = field_bounds(mash_out)
+        if starts.size == 0:
+            return pd.DataFrame({col: pd.Series(dtype=MASH_OUTPUT_DTYPES.get(col, object)) for col in usecols})
+        if starts.shape[1] != len(columns):
+            raise ValueError('Expected {} Mash output fields, found {}'.format(len(columns), starts.shape[1]))
+        data = {}
+        for col in usecols:
+            i = columns.index(col)
+            if col in MASH_OUTPUT_DTYPES:
+                data[col] = parse_numeric_fields(mash_out, starts[:, i], ends[:, i], MASH_OUTPUT_DTYPES[col])
+            else:
+                # empty fields are null like pandas reads them
+                data[col] = pd.Series([mash_out[start:end].decode() or None
+                                       for start, end in zip(starts[:, i].tolist(), ends[:, i].tolist())],
+                                      dtype=object)
+        return pd.DataFrame(data, columns=usecols)
+    except ValueError as ex:
+        logging.debug('Reading Mash output with pandas: %s', ex)
+        return pd.read_csv(BytesIO(mash_out),
+                           sep='\t',
+                           header=None,
+                           names=columns,
+                           usecols=usecols,
+                           dtype={col: MASH_OUTPUT_DTYPES.get(col, object) for col in usecols},
+                           quoting=csv.QUOTE_NONE)[usecols]
+
+
+def n_mash_output_fields(mash_out: Union[bytes, str]) -> int:
+    """Number of fields in the first line of tab-delimited Mash output"""
+    if isinstance(mash_out, str):
+        mash_out = mash_out.encode()
+    end = mash_out.find(b'\n')
+    return mash_out.count(b'\t', 0, len(mash_out) if end < 0 else end) + 1
+
+
+def mash_dist_output_to_dataframe(mash_out: Union[bytes, str], columns: Optional[List[str]] = None) -> pd.DataFrame:
     """Mash dist stdout to Pandas DataFrame
 
     Args:
-        mash_out (str): Mash dist stdout
+        mash_out: Mash dist stdout
+        columns: Output columns to parse (default: all)
+
+    Returns:
+        (pd.DataFrame): Mash dist table ordered by ascending distance
+    """
+    mash_columns = MASH_DIST_5_COLUMNS if n_mash_output_fields(mash_out) == 5 else MASH_DIST_4_COLUMNS
+    df = read_mash_table(mash_out, mash_columns,
+                         usecols=projected_columns(MASH_DIST_4_COLUMNS, columns, MASH_DIST_SORT_COLUMNS))
+    return mash_dist_table_to_dataframe(df, columns=columns)
+
+
+def mash_dist_table_to_dataframe(df: pd.DataFrame, columns: Optional[List[str]] = None) -> pd.DataFrame:
+    """Sort a Mash dist results table and merge in RefSeq info parsed from each `match_id`
+
+    Args:
+        df: Mash dist results table with `MASH_DIST_4_COLUMNS` columns
+        columns: Output columns to keep and parse (default: all)
 
     Returns:
         (pd.DataFrame): Mash dist table ordered by ascending distance
     """
-    df = pd.read_table(StringIO(mash_out))
-    ncols = df.shape[1]
-    if ncols == 5:
-        df.columns = MASH_DIST_5_COLUMNS
-        df = df[MASH_DIST_4_COLUMNS]
-    if ncols == 4:
-        df.columns = MASH_DIST_4_COLUMNS
     df.sort_values(by='distance', ascending=True, inplace=True)
-    match_ids = df.match_id
-    dfmatch = pd.DataFrame([parse_refseq_info(match_id=match_id) for match_id in match_ids])
-    return pd.merge(dfmatch, df, on='match_id')
+    return refseq_info_dataframe(df, MASH_DIST_4_COLUMNS, MASH_DIST_SORT_COLUMNS, columns=columns)
 
 
-def mash_screen_output_to_dataframe(mash_out: str) -> pd.DataFrame:
+def mash_screen_output_to_dataframe(mash_out: Union[bytes, str], columns: Optional[List[str]] = None) -> pd.DataFrame:
     """Mash screen stdout to Pandas DataFrame
 
     Args:
         mash_out: Mash screen stdout
+        columns: Output columns to parse (default: all)
 
     Returns:
         (pd.DataFrame): Mash screen output table ordered by `identity` and `median_multiplicity` columns in descending
@@ -119,13 +290,24 @@ def mash_screen_output_to_dataframe(mash_out: str) -> pd.DataFrame:
     dfmerge = None
 
     if len(mash_out) > 0:
-        df = pd.read_table(StringIO(mash_out))
-        ncols = df.shape[1]
-        df.columns = MASH_SCREEN_COLUMNS[:ncols]
-        df.sort_values(by=['identity', 'median_multiplicity'], ascending=[False, False], inplace=True)
-        match_ids = df.match_id
-        refseq_matches = [parse_refseq_info(match_id=match_id) for match_id in match_ids]
-        dfmatch = pd.DataFrame(refseq_matches)
-        dfmerge = pd.merge(dfmatch, df, on='match_id')
+        mash_columns = MASH_SCREEN_COLUMNS[:n_mash_output_fields(mash_out)]
+        df = read_mash_table(mash_out, mash_columns,
+                             usecols=projected_columns(mash_columns, columns, MASH_SCREEN_SORT_COLUMNS))
+        dfmerge = mash_screen_table_to_dataframe(df, columns=columns)
 
     return dfmerge
+
+
+def mash_screen_table_to_dataframe(df: pd.DataFrame, columns: Optional[List[str]] = None) -> pd.DataFrame:
+    """Sort a Mash screen results table and merge in RefSeq info parsed from each `match_id`
+
+    Args:
+        df: Mash screen results table with `MASH_SCREEN_COLUMNS` columns
+        columns: Output columns to keep and parse (default: all)
+
+    Returns:
+        (pd.DataFrame): Mash screen results ordered by `identity` and `median_multiplicity` columns in descending
+            order
+    """
+    df.sort_values(by=['identity', 'median_multiplicity'], ascending=[False, False], inplace=True)
+    return refseq_info_dataframe(df, MASH_SCREEN_COLUMNS, MASH_SCREEN_SORT_COLUMNS, columns=columns)
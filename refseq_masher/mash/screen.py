@@ -1,13 +1,37 @@
 # -*- coding: utf-8 -*-
 
 import logging
-from typing import Union, List
+import os
+from typing import Union, List, Optional
 
 import pandas as pd
 
 from .parser import mash_screen_output_to_dataframe
 from ..const import MASH_REFSEQ_MSH
-from ..utils import run_command
+from ..memory import MemoryAdmission
+from ..utils import run_command, run_command_peak_rss
+
+#: Prior estimate of Mash screen peak memory use per byte of the sketch database (reference hash tables)
+SCREEN_MEMORY_PER_DB_BYTE = 8.0
+#: Prior estimate of Mash screen peak memory use per byte of input sequence files
+SCREEN_MEMORY_PER_INPUT_BYTE = 0.05
+#: Prior estimate of Mash screen memory use independent of the sketch database and inputs
+SCREEN_MEMORY_BASE = 64 << 20
+
+
+def screen_memory_admission(max_memory: int, db_path: str = MASH_REFSEQ_MSH) -> MemoryAdmission:
+    """Admission control for concurrent Mash screen jobs against a sketch database within a memory budget
+
+    Args:
+        max_memory: Memory budget in bytes
+        db_path: Mash sketch database path
+
+    Returns:
+        (MemoryAdmission): admission control with Mash screen prior memory estimates for the sketch database
+    """
+    return MemoryAdmission(max_memory,
+                           fixed_bytes=int(SCREEN_MEMORY_BASE + SCREEN_MEMORY_PER_DB_BYTE * os.path.getsize(db_path)),
+                           bytes_per_input_byte=SCREEN_MEMORY_PER_INPUT_BYTE)
 
 
 def vs_refseq(inputs: Union[str, List[str]],
@@ -15,7 +39,9 @@ def vs_refseq(inputs: Union[str, List[str]],
               sample_name: str = None,
               max_pvalue: float = 0.01,
               min_identity: float = 0.9,
-              parallelism: int = 1) -> pd.DataFrame:
+              parallelism: int = 1,
+              admission: Optional[MemoryAdmission] = None,
+              columns: Optional[List[str]] = None) -> pd.DataFrame:
     """Run Mash screen with the RefSeq genomes sketch database against some input sequence files
 
     Args:
@@ -25,6 +51,8 @@ def vs_refseq(inputs: Union[str, List[str]],
         max_pvalue: Mash screen max p-value to report
         min_identity: Mash screen min identity to report
         parallelism: Mash screen number of parallel threads to spawn
+        admission: Memory admission control to wait for before running Mash screen (see `screen_memory_admission`)
+        columns: Output columns to parse (default: all)
 
     Returns:
         (pd.DataFrame): Parsed Mash screen results dataframe or None if the output of Mash was empty
@@ -43,9 +71,16 @@ def vs_refseq(inputs: Union[str, List[str]],
 
     logging.info('Running Mash Screen with NCBI RefSeq sketch database '
                  'against sample "%s" with inputs: %s', sample_name, inputs)
-    exit_code, stdout, stderr = run_command(cmd_list, stderr=None)
+    if admission is None:
+        exit_code, stdout, stderr = run_command(cmd_list, stderr=None, decode_stdout=False)
+    else:
+        input_paths = inputs if isinstance(inputs, list) else [inputs]
+        input_bytes = sum(os.path.getsize(path) for path in input_paths)
+        with admission.admitted(input_bytes):
+            exit_code, stdout, stderr, peak_rss = run_command_peak_rss(cmd_list, stderr=None, decode_stdout=False)
+            admission.observe(input_bytes, peak_rss)
 
-    df = mash_screen_output_to_dataframe(stdout)
+    df = mash_screen_output_to_dataframe(stdout, columns=columns)
 
     if df is not None:
         df['sample'] = sample_name
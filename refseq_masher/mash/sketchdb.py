@@ -0,0 +1,268 @@
+# -*- coding: utf-8 -*-
+
+"""In-memory Mash sketch databases for in-process search engines
+
+Mash `.msh` files are Cap'n Proto messages. Rather than depending on a Cap'n
+Proto library, a sketch file is decoded once with `mash info -d` (JSON dump)
+and the decoded min-hashes are cached as NumPy `.npy` arrays that are
+memory-mapped on subsequent loads. Sketch hashes are stored CSR-style: all
+sketches' sorted hashes concatenated into `hashes` with row boundaries in
+`offsets`.
+"""
+
+import json
+import logging
+import os
+import shutil
+from typing import List, Optional
+
+import numpy as np
+
+from ..const import MASH_REFSEQ_MSH, CACHE_DIR
+from ..utils import run_command, load_once
+
+#: Sketch DB cache format version; bump to invalidate caches when the cached layout changes
+SKETCH_DB_CACHE_VERSION = 1
+
+
+class SketchDB:
+    """Mash sketches with their parameters and CSR-style sorted min-hash arrays
+
+    Attributes:
+        kmer_size: k-mer size
+        hash_seed: MurmurHash3 seed
+        hash_bits: hash width (32 or 64)
+        sketch_size: max number of min-hashes per sketch (Mash `-s`)
+        names: sketch names (Mash match/query IDs)
+        comments: sketch comments
+        lengths: total sequence length of each sketched genome
+        offsets: int64 array of length n + 1 with the start of each sketch's hashes in `hashes`
+        hashes: all sketches' min-hashes, each sketch's hashes sorted ascending
+        cache_path: directory the sketches were loaded from or None if not cached
+    """
+
+    def __init__(self,
+                 kmer_size: int,
+                 hash_seed: int,
+                 hash_bits: int,
+                 sketch_size: int,
+                 names: np.ndarray,
+                 comments: np.ndarray,
+                 lengths: np.ndarray,
+                 offsets: np.ndarray,
+                 hashes: np.ndarray,
+                 cache_path: Optional[str] = None):
+        self.kmer_size = kmer_size
+        self.hash_seed = hash_seed
+        self.hash_bits = hash_bits
+        self.sketch_size = sketch_size
+        self.names = names
+        self.comments = comments
+        self.lengths = lengths
+        self.offsets = offsets
+        self.hashes = hashes
+        self.cache_path = cache_path
+
+    def __len__(self) -> int:
+        return self.names.size
+
+    @property
+    def hash_dtype(self) -> np.dtype:
+        return np.dtype(np.uint32 if self.hash_bits == 32 else np.uint64)
+
+    @property
+    def sizes(self) -> np.ndarray:
+        """Number of min-hashes in each sketch"""
+        return np.diff(self.offsets)
+
+    def row_hashes(self, i: int) -> np.ndarray:
+        """Sorted min-hashes of the i-th sketch"""
+        return self.hashes[self.offsets[i]:self.offsets[i + 1]]
+
+    def subset(self, rows: np.ndarray) -> 'SketchDB':
+        """Sketches at `rows` as a new database"""
+        sizes = self.sizes[rows]
+        offsets = np.concatenate(([0], np.cumsum(sizes))).astype(np.int64)
+        positions = np.repeat(self.offsets[rows] - offsets[:-1], sizes) + np.arange(offsets[-1])
+        return SketchDB(kmer_size=self.kmer_size,
+                        hash_seed=self.hash_seed,
+                        hash_bits=self.hash_bits,
+                        sketch_size=self.sketch_size,
+                        names=self.names[rows],
+                        comments=self.comments[rows],
+                        lengths=self.lengths[rows],
+                        offsets=offsets,
+                        hashes=np.asarray(self.hashes[positions]))
+
+    def downsample(self, sketch_size: int) -> 'SketchDB':
+        """Bottom-`sketch_size` sketches, i.e. what Mash would produce with a smaller `-s`"""
+        sizes = np.minimum(self.sizes, sketch_size)
+        offsets = np.concatenate(([0], np.cumsum(sizes))).astype(np.int64)
+        positions = np.repeat(self.offsets[:-1] - offsets[:-1], sizes) + np.arange(offsets[-1])
+        return SketchDB(kmer_size=self.kmer_size,
+                        hash_seed=self.hash_seed,
+                        hash_bits=self.hash_bits,
+                        sketch_size=sketch_size,
+                        names=self.names,
+                        comments=self.comments,
+                        lengths=self.lengths,
+                        offsets=offsets,
+                        hashes=np.asarray(self.hashes[positions]))
+
+    @classmethod
+    def concat(cls, dbs: List['SketchDB']) -> 'SketchDB':
+        """Concatenate sketch databases with the same sketch parameters"""
+        first = dbs[0]
+        for db in dbs[1:]:
+            if (db.kmer_size, db.hash_seed, db.hash_bits) != (first.kmer_size, first.hash_seed, first.hash_bits):
+                raise ValueError('Cannot combine sketches with different parameters (k={}, seed={}, bits={} vs '
+                                 'k={}, seed={}, bits={})'.format(db.kmer_size, db.hash_seed, db.hash_bits,
+                                                                  first.kmer_size, first.hash_seed, first.hash_bits))
+        sizes = np.concatenate([db.sizes for db in dbs])
+        return cls(kmer_size=first.kmer_size,
+                   hash_seed=first.hash_seed,
+                   hash_bits=first.hash_bits,
+                   sketch_size=max(db.sketch_size for db in dbs),
+                   names=np.concatenate([db.names for db in dbs]),
+                   comments=np.concatenate([db.comments for db in dbs]),
+                   lengths=np.concatenate([db.lengths for db in dbs]),
+                   offsets=np.concatenate(([0], np.cumsum(sizes))).astype(np.int64),
+                   hashes=np.concatenate([np.asarray(db.hashes) for db in dbs]))
+
+    @classmethod
+    def from_mash_info_json(cls, info: dict) -> 'SketchDB':
+        """Build from the parsed JSON output of `mash info -d`"""
+        sketches = info['sketches']
+        hash_bits = int(info.get('hashBits', 64))
+        dtype = np.uint32 if hash_bits == 32 else np.uint64
+        sizes = np.array([len(x['hashes']) for x in sketches], dtype=np.int64)
+        offsets = np.concatenate(([0], np.cumsum(sizes))).astype(np.int64)
+        hashes = np.empty(offsets[-1], dtype=dtype)
+        for i, x in enumerate(sketches):
+            hashes[offsets[i]:offsets[i + 1]] = np.sort(np.array(x['hashes'], dtype=dtype))
+        return cls(kmer_size=int(info['kmer']),
+                   hash_seed=int(info.get('hashSeed', 42)),
+                   hash_bits=hash_bits,
+                   sketch_size=int(info['sketchSize']),
+                   names=np.array([x['name'] for x in sketches], dtype=str),
+                   comments=np.array([x.get('comment', '') for x in sketches], dtype=str),
+                   lengths=np.array([x.get('length', 0) for x in sketches], dtype=np.int64),
+                   offsets=offsets,
+                   hashes=hashes)
+
+    def save(self, dirpath: str) -> None:
+        """Save to a directory of `.npy` arrays and a `meta.json` of sketch parameters"""
+        os.makedirs(dirpath, exist_ok=True)
+        for attr in ['names', 'comments', 'lengths', 'offsets', 'hashes']:
+            np.save(os.path.join(dirpath, attr + '.npy'), getattr(self, attr))
+        with open(os.path.join(dirpath, 'meta.json'), 'w') as f:
+            json.dump(dict(version=SKETCH_DB_CACHE_VERSION,
+                           kmer_size=self.kmer_size,
+                           hash_seed=self.hash_seed,
+                           hash_bits=self.hash_bits,
+                           sketch_size=self.sketch_size), f)
+
+    @classmethod
+    def load(cls, dirpath: str, mmap: bool = True) -> 'SketchDB':
+        """Load from a directory written by `save`, memory-mapping the hash arrays"""
+        with open(os.path.join(dirpath, 'meta.json')) as f:
+            meta = json.load(f)
+        mmap_mode = 'r' if mmap else None
+        return cls(kmer_size=meta['kmer_size'],
+                   hash_seed=meta['hash_seed'],
+                   hash_bits=meta['hash_bits'],
+                   sketch_size=meta['sketch_size'],
+                   names=np.load(os.path.join(dirpath, 'names.npy')),
+                   comments=np.load(os.path.join(dirpath, 'comments.npy')),
+                   lengths=np.load(os.path.join(dirpath, 'lengths.npy')),
+                   offsets=np.load(os.path.join(dirpath, 'offsets.npy')),
+                   hashes=np.load(os.path.join(dirpath, 'hashes.npy'), mmap_mode=mmap_mode),
+                   cache_path=dirpath)
+
+
+def save_to_cache(obj, cache_path: str) -> None:
+    """Atomically save an object with a `save(dirpath)` method to a cache directory
+
+    The object is saved to a temporary directory that is then renamed so that concurrent processes never see a
+    partially written cache. If another process created the cache first, its cache is kept.
+    """
+    tmp_path = '{}.tmp-{}'.format(cache_path, os.getpid())
+    obj.save(tmp_path)
+    try:
+        os.replace(tmp_path, cache_path)
+    except OSError:
+        shutil.rmtree(tmp_path)
+
+
+def mash_info_dump(msh_path: str, mash_bin: str = 'mash') -> dict:
+    """Decode a Mash sketch file with `mash info -d`
+
+    Args:
+        msh_path: Mash sketch file path
+        mash_bin: Mash binary path
+
+    Returns:
+        (dict): parsed JSON dump of the sketch file
+    """
+    exit_code, stdout, stderr = run_command([mash_bin, 'info', '-d', msh_path])
+    if exit_code != 0:
+        raise Exception(
+            'Could not run Mash info. EXITCODE="{}" STDERR="{}"'.format(exit_code, stderr))
+    return json.loads(stdout)
+
+
+def sketch_db_cache_path(msh_path: str, cache_dir: str = CACHE_DIR) -> str:
+    """Cache directory for the decoded sketches of a Mash sketch file
+
+    The cache is keyed on the sketch file's name, size and modification time.
+    """
+    st = os.stat(msh_path)
+    stem = os.path.splitext(os.path.basename(msh_path))[0]
+    return os.path.join(cache_dir, '{}-{}-{}-v{}'.format(stem, st.st_size, int(st.st_mtime),
+                                                          SKETCH_DB_CACHE_VERSION))
+
+
+def load_sketch_db(msh_path: str,
+                   mash_bin: str = 'mash',
+                   cache_dir: Optional[str] = CACHE_DIR) -> SketchDB:
+    """Load a Mash sketch file as a `SketchDB`, decoding it with Mash and caching it on first use
+
+    Args:
+        msh_path: Mash sketch file path
+        mash_bin: Mash binary path
+        cache_dir: Directory to cache decoded sketches in or None to not cache
+
+    Returns:
+        (SketchDB): decoded sketches
+    """
+    cache_path = sketch_db_cache_path(msh_path, cache_dir) if cache_dir else None
+    if cache_path and os.path.exists(os.path.join(cache_path, 'meta.json')):
+        logging.info('Loading cached sketches for "%s" from "%s"', msh_path, cache_path)
+        return SketchDB.load(cache_path)
+    logging.info('Decoding Mash sketch file "%s" with "mash info -d"', msh_path)
+    db = SketchDB.from_mash_info_json(mash_info_dump(msh_path, mash_bin=mash_bin))
+    logging.info('Decoded %s sketches (k=%s, s=%s, %s-bit hashes)', len(db), db.kmer_size, db.sketch_size,
+                 db.hash_bits)
+    if cache_path:
+        save_to_cache(db, cache_path)
+        logging.info('Cached decoded sketches at "%s"', cache_path)
+        return SketchDB.load(cache_path)
+    return db
+
+
+def load_downsampled_sketch_db(db: SketchDB, sketch_size: int) -> SketchDB:
+    """Bottom-`sketch_size` copy of a sketch database, cached next to the database's own cache on first use"""
+    if db.cache_path is None:
+        return db.downsample(sketch_size)
+    cache_path = os.path.join(db.cache_path, 'downsampled-s{}'.format(sketch_size))
+    if not os.path.exists(os.path.join(cache_path, 'meta.json')):
+        logging.info('Creating bottom-%s downsampled copy of %s sketches', sketch_size, len(db))
+        save_to_cache(db.downsample(sketch_size), cache_path)
+        logging.info('Cached downsampled sketches at "%s"', cache_path)
+    return SketchDB.load(cache_path)
+
+
+@load_once
+def refseq_sketch_db(mash_bin: str = 'mash') -> SketchDB:
+    """The bundled RefSeq genomes sketch database, loaded once per process"""
+    return load_sketch_db(MASH_REFSEQ_MSH, mash_bin=mash_bin)
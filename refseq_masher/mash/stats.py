@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+
+"""Mash statistics: k-mer identity estimates and binomial p-values
+
+Vectorized equivalents of the formulas Mash uses to report identity and
+p-values so that in-process engines produce the same values as the `mash`
+binary.
+"""
+
+import math
+from typing import Union
+
+import numpy as np
+
+
+def kmer_space(k: int, alphabet_size: int = 4) -> float:
+    """Number of possible k-mers"""
+    return float(alphabet_size) ** k
+
+
+def round_like_mash(x: np.ndarray) -> np.ndarray:
+    """Round values to the 6 significant digits that Mash writes to stdout"""
+    return np.array(['%.6g' % v for v in np.asarray(x, dtype=np.float64)], dtype=np.float64)
+
+
+def binomial_sf(x: np.ndarray, n: np.ndarray, r: np.ndarray, chunk_size: int = 4096) -> np.ndarray:
+    """P(X >= x) for X ~ Binomial(n, r), i.e. GSL's `gsl_cdf_binomial_Q(x - 1, r, n)`
+
+    Args:
+        x: numbers of successes
+        n: numbers of trials
+        r: success probabilities
+        chunk_size: number of values to compute at once to bound memory use
+
+    Returns:
+        (np.ndarray): upper tail probabilities
+    """
+    x, n, r = np.broadcast_arrays(np.asarray(x, dtype=np.int64),
+                                  np.asarray(n, dtype=np.int64),
+                                  np.asarray(r, dtype=np.float64))
+    out = np.ones(x.shape, dtype=np.float64)
+    todo = np.flatnonzero(x > 0)
+    if todo.size == 0:
+        return out
+    max_n = int(n.flat[todo].max())
+    log_fact = np.array([math.lgamma(i + 1) for i in range(max_n + 1)])
+    j = np.arange(max_n + 1)
+    for start in range(0, todo.size, chunk_size):
+        idx = todo[start:start + chunk_size]
+        x_, r_ = x.flat[idx][:, np.newaxis], r.flat[idx][:, np.newaxis]
+        n_ = n.flat[idx][:, np.newaxis]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            log_pmf = (log_fact[n_] - log_fact[j] - log_fact[np.clip(n_ - j, 0, None)]
+                       + j * np.log(r_)
+                       + (n_ - j) * np.log1p(-r_))
+        log_pmf[(j < x_) | (j > n_)] = -np.inf
+        log_max = log_pmf.max(axis=1)
+        finite = np.isfinite(log_max)
+        tail = np.zeros(idx.size, dtype=np.float64)
+        tail[finite] = np.exp(log_max[finite]) * np.exp(log_pmf[finite] - log_max[finite, np.newaxis]).sum(axis=1)
+        out.flat[idx] = np.minimum(tail, 1.0)
+    return out
+
+
+def mash_distance(common: np.ndarray, denom: np.ndarray, k: int) -> np.ndarray:
+    """Mash distance from the Jaccard index estimate `common / denom`: -1/k * ln(2j / (1 + j))"""
+    common = np.asarray(common, dtype=np.float64)
+    denom = np.asarray(denom, dtype=np.float64)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        jaccard = common / denom
+        distance = -np.log(2.0 * jaccard / (1.0 + jaccard)) / k
+    distance[common == denom] = 0.0
+    distance[common == 0] = 1.0
+    return np.minimum(distance, 1.0)
+
+
+def dist_pvalue(common: np.ndarray,
+                ref_lengths: np.ndarray,
+                query_length: Union[float, np.ndarray],
+                denom: np.ndarray,
+                k: int) -> np.ndarray:
+    """Mash dist p-value of observing `common` shared hashes out of `denom` by chance given genome lengths"""
+    space = kmer_space(k)
+    p_ref = 1.0 / (1.0 + space / np.maximum(np.asarray(ref_lengths, dtype=np.float64), 1.0))
+    p_query = 1.0 / (1.0 + space / np.maximum(np.asarray(query_length, dtype=np.float64), 1.0))
+    r = p_ref * p_query / (p_ref + p_query - p_ref * p_query)
+    return binomial_sf(common, denom, r)
+
+
+def screen_identity(shared: np.ndarray, sketch_sizes: np.ndarray, k: int) -> np.ndarray:
+    """Mash screen containment identity estimate: (shared / sketch size) ^ (1 / k)"""
+    shared = np.asarray(shared, dtype=np.float64)
+    sketch_sizes = np.asarray(sketch_sizes, dtype=np.float64)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        identity = np.power(shared / sketch_sizes, 1.0 / k)
+    identity[shared == sketch_sizes] = 1.0
+    identity[shared == 0] = 0.0
+    return identity
+
+
+def screen_pvalue(shared: np.ndarray, sketch_sizes: np.ndarray, set_size: float, k: int) -> np.ndarray:
+    """Mash screen p-value of observing `shared` hashes of a reference sketch within a k-mer set of `set_size`"""
+    r = 1.0 / (1.0 + kmer_space(k) / max(set_size, 1.0))
+    return binomial_sf(shared, sketch_sizes, r)
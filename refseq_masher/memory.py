@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+
+"""Memory-aware admission control for concurrent external jobs (e.g. `mash screen`)
+
+Each job's peak memory use is estimated from a fixed part (e.g. proportional
+to the size of the sketch database the job loads) and a part proportional to
+the size of its inputs. A job is only started while the estimates of all
+running jobs plus its own fit within the memory budget, which is capped by
+the memory available on the host and the cgroup (container) memory limit.
+The estimates are scaled by the largest ratio of observed peak resident set
+size to prior estimate of finished jobs, so they quickly adapt to the real
+footprint of the jobs.
+"""
+
+import logging
+import os
+import re
+import threading
+from contextlib import contextmanager
+from typing import Optional
+
+#: Memory size units accepted by `parse_memory_size`
+MEMORY_UNITS = {'': 1, 'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30, 'T': 1 << 40}
+#: cgroup v2 and v1 memory limit and usage files
+CGROUP_MEMORY_FILES = [('/sys/fs/cgroup/memory.max', '/sys/fs/cgroup/memory.current'),
+                       ('/sys/fs/cgroup/memory/memory.limit_in_bytes', '/sys/fs/cgroup/memory/memory.usage_in_bytes')]
+
+
+def parse_memory_size(value: str) -> int:
+    """Parse a memory size such as "512M", "16G" or "1.5T" (binary units) into bytes"""
+    m = re.match(r'^\s*(\d+(?:\.\d+)?)\s*([KMGT]?)i?B?\s*$', value, re.IGNORECASE)
+    if m is None:
+        raise ValueError('Invalid memory size "{}". Expected e.g. "512M", "16G"'.format(value))
+    number, unit = m.groups()
+    return int(float(number) * MEMORY_UNITS[unit.upper()])
+
+
+def format_memory_size(nbytes: float) -> str:
+    for unit in ['T', 'G', 'M', 'K']:
+        if nbytes >= MEMORY_UNITS[unit]:
+            return '{:.1f}{}'.format(nbytes / MEMORY_UNITS[unit], unit)
+    return '{}B'.format(int(nbytes))
+
+
+def _read_int(path: str) -> Optional[int]:
+    try:
+        with open(path) as f:
+            value = f.read().strip()
+    except OSError:
+        return None
+    return int(value) if value.isdigit() else None
+
+
+def host_available_memory() -> Optional[int]:
+    """Memory available for new processes without swapping (`MemAvailable` in /proc/meminfo) or None if unknown"""
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def cgroup_available_memory() -> Optional[int]:
+    """Memory left under this process's cgroup memory limit or None if there is no limit"""
+    for limit_path, usage_path in CGROUP_MEMORY_FILES:
+        limit = _read_int(limit_path)
+        usage = _read_int(usage_path)
+        # cgroup v1 reports no limit as a huge number
+        if limit is not None and usage is not None and limit < (1 << 60):
+            return max(limit - usage, 0)
+    return None
+
+
+def available_memory() -> Optional[int]:
+    """Memory available to new processes on this host and within the cgroup memory limit or None if unknown"""
+    values = [x for x in [host_available_memory(), cgroup_available_memory()] if x is not None]
+    return min(values) if values else None
+
+
+class MemoryAdmission:
+    """Admit concurrent jobs while the sum of their estimated peak memory use fits a memory budget
+
+    A job estimated to need more than the whole budget is still run, but only when no other job is running.
+
+    Args:
+        max_memory: Memory budget in bytes (capped by `available_memory` at creation)
+        fixed_bytes: Prior estimate of each job's memory use independent of its inputs
+        bytes_per_input_byte: Prior estimate of each job's memory use per byte of input
+    """
+
+    def __init__(self, max_memory: int, fixed_bytes: int, bytes_per_input_byte: float = 0.0):
+        available = available_memory()
+        self.budget = max_memory if available is None else min(max_memory, available)
+        self.fixed_bytes = fixed_bytes
+        self.bytes_per_input_byte = bytes_per_input_byte
+        #: largest observed ratio of peak RSS to prior estimate of finished jobs or None if none finished yet
+        self.correction = None  # type: Optional[float]
+        self.reserved = 0
+        self.running = 0
+        self._cond = threading.Condition()
+        logging.info('Memory budget for concurrent jobs: %s (requested %s, available %s)',
+                     format_memory_size(self.budget), format_memory_size(max_memory),
+                     'unknown' if available is None else format_memory_size(available))
+
+    def prior_estimate(self, input_bytes: int) -> float:
+        return self.fixed_bytes + self.bytes_per_input_byte * input_bytes
+
+    def estimate(self, input_bytes: int) -> int:
+        """Estimated peak memory use of a job with `input_bytes` of input"""
+        return int(self.prior_estimate(input_bytes) * (self.correction or 1.0))
+
+    def observe(self, input_bytes: int, peak_rss: int) -> None:
+        """Learn from the observed peak resident set size of a finished job"""
+        ratio = peak_rss / max(self.prior_estimate(input_bytes), 1.0)
+        with self._cond:
+            self.correction = ratio if self.correction is None else max(self.correction, ratio)
+        logging.info('Job with %s of input peaked at %s of memory (estimate scale=%.3g)',
+                     format_memory_size(input_bytes), format_memory_size(peak_rss), self.correction)
+
+    @contextmanager
+    def admitted(self, input_bytes: int):
+        """Context in which a job with `input_bytes` of input may run, waiting until its estimate fits the budget"""
+        with self._cond:
+            while True:
+                estimate = self.estimate(input_bytes)
+                if self.running == 0 or self.reserved + estimate <= self.budget:
+                    break
+                logging.info('Waiting for memory: job needs ~%s, %s of %s reserved by %s running jobs',
+                             format_memory_size(estimate), format_memory_size(self.reserved),
+                             format_memory_size(self.budget), self.running)
+                self._cond.wait()
+            if estimate > self.budget:
+                logging.warning('Job estimated to need %s exceeds the memory budget of %s; running it alone',
+                                format_memory_size(estimate), format_memory_size(self.budget))
+            self.reserved += estimate
+            self.running += 1
+        try:
+            yield estimate
+        finally:
+            with self._cond:
+                self.reserved -= estimate
+                self.running -= 1
+                self._cond.notify_all()
@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+
+"""Minimal FASTA/FASTQ sequence reading for in-process k-mer hashing
+
+Files may be gzipped. The format is detected from the first character of the
+file (">" for FASTA, "@" for FASTQ) like Mash does, rather than from the
+filename.
+"""
+
+import gzip
+from typing import BinaryIO, Iterable, Iterator, List
+
+#: Gzip magic bytes
+GZIP_MAGIC = b'\x1f\x8b'
+
+
+def open_seq_file(path: str) -> BinaryIO:
+    """Open a possibly gzipped sequence file for reading in binary mode"""
+    with open(path, 'rb') as f:
+        magic = f.read(2)
+    if magic == GZIP_MAGIC:
+        return gzip.open(path, 'rb')
+    return open(path, 'rb')
+
+
+def iter_sequences_from_handle(handle: BinaryIO) -> Iterator[bytes]:
+    """Iterate over the sequences of an open FASTA or FASTQ binary file handle
+
+    Args:
+        handle: binary file handle positioned at the start of a FASTA/FASTQ record
+
+    Yields:
+        bytes: each record's sequence (FASTA multi-line sequences are joined)
+    """
+    first = handle.readline()
+    while first and not first.strip():
+        first = handle.readline()
+    if not first:
+        return
+    if first.startswith(b'@'):
+        while first:
+            seq = handle.readline().rstrip()
+            handle.readline()
+            handle.readline()
+            yield seq
+            first = handle.readline()
+    elif first.startswith(b'>'):
+        lines = []  # type: List[bytes]
+        for line in handle:
+            if line.startswith(b'>'):
+                yield b''.join(lines)
+                lines = []
+            else:
+                lines.append(line.rstrip())
+        yield b''.join(lines)
+    else:
+        raise ValueError('Unrecognized sequence file format; expected FASTA (">") or FASTQ ("@") records')
+
+
+def iter_sequences(path: str) -> Iterator[bytes]:
+    """Iterate over the sequences in a possibly gzipped FASTA or FASTQ file
+
+    Args:
+        path: FASTA/FASTQ file path
+
+    Yields:
+        bytes: each record's sequence
+    """
+    with open_seq_file(path) as handle:
+        yield from iter_sequences_from_handle(handle)
+
+
+def iter_decompressed_chunks(paths: List[str], chunk_size: int = 1 << 20) -> Iterator[bytes]:
+    """Decompressed contents of one or more possibly gzipped files, concatenated, in chunks
+
+    A newline is inserted between files that do not end with one so that records are not joined.
+
+    Args:
+        paths: file paths
+        chunk_size: max bytes per chunk
+
+    Yields:
+        bytes: decompressed data
+    """
+    for path in paths:
+        last = b''
+        with open_seq_file(path) as handle:
+            for chunk in iter(lambda: handle.read(chunk_size), b''):
+                last = chunk
+                yield chunk
+        if last and not last.endswith(b'\n'):
+            yield b'\n'
+
+
+def batch_sequences(seqs: Iterable[bytes], batch_bases: int = 1 << 23) -> Iterator[List[bytes]]:
+    """Group sequences into batches of roughly `batch_bases` total bases
+
+    Args:
+        seqs: sequences
+        batch_bases: approximate max number of bases per batch (a single longer sequence is its own batch)
+
+    Yields:
+        list of sequences
+    """
+    batch = []  # type: List[bytes]
+    n = 0
+    for seq in seqs:
+        if batch and n + len(seq) > batch_bases:
+            yield batch
+            batch = []
+            n = 0
+        batch.append(seq)
+        n += len(seq)
+    if batch:
+        yield batch
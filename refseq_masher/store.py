@@ -0,0 +1,206 @@
+# -*- coding: utf-8 -*-
+
+"""Indexed local SQLite store of results accumulated over many runs
+
+Each run is recorded in the `runs` table (command, UTC timestamp, version and
+options) and its result rows are appended to a table named after the command
+(`matches` or `contains`) with the run's ID and timestamp. Result tables get
+new columns as needed, since the taxonomy columns present in results depend on
+the genomes found. The database uses write-ahead logging so that it can be
+queried while results are being appended. Each run and all its result rows
+are inserted in a single transaction (in batches), so readers never see a
+partially stored run. The result tables are indexed on sample, taxid,
+assembly accession and run timestamp for fast historical lookups.
+"""
+
+import json
+import logging
+import sqlite3
+import time
+from typing import Dict, List, Optional
+
+import numpy as np
+import pandas as pd
+
+from . import __version__
+
+#: Result tables, one per command
+STORE_TABLES = ['matches', 'contains']
+#: Indexed result table columns
+STORE_INDEXED_COLUMNS = ['sample', 'taxid', 'assembly_accession', 'run_time']
+#: Timestamp format of `run_time` (UTC, sortable as text)
+STORE_TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+
+def sqlite_type(dtype) -> str:
+    """SQLite column type affinity for a pandas dtype"""
+    if pd.api.types.is_bool_dtype(dtype) or pd.api.types.is_integer_dtype(dtype):
+        return 'INTEGER'
+    if pd.api.types.is_float_dtype(dtype):
+        return 'REAL'
+    return 'TEXT'
+
+
+def quote_identifier(name: str) -> str:
+    return '"{}"'.format(name.replace('"', '""'))
+
+
+class ResultsStore:
+    """SQLite database of results of many runs
+
+    Args:
+        path: SQLite database path (created if missing)
+        batch_size: Number of rows inserted per `executemany` call
+    """
+
+    def __init__(self, path: str, batch_size: int = 10000):
+        self.path = path
+        self.batch_size = batch_size
+        self.conn = sqlite3.connect(path)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        with self.conn:
+            self.conn.execute('CREATE TABLE IF NOT EXISTS runs ('
+                              'run_id INTEGER PRIMARY KEY AUTOINCREMENT, '
+                              'command TEXT NOT NULL, '
+                              'run_time TEXT NOT NULL, '
+                              'version TEXT, '
+                              'options TEXT, '
+                              'n_rows INTEGER)')
+
+    def close(self) -> None:
+        self.conn.close()
+
+    def __enter__(self) -> 'ResultsStore':
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    def table_columns(self, table: str) -> List[str]:
+        return [row[1] for row in self.conn.execute('PRAGMA table_info({})'.format(quote_identifier(table)))]
+
+    def _ensure_table(self, table: str, df: pd.DataFrame) -> None:
+        """Create the result table and indexes or add any new columns of `df` to it"""
+        existing = self.table_columns(table)
+        with self.conn:
+            if not existing:
+                self.conn.execute('CREATE TABLE {} (run_id INTEGER NOT NULL REFERENCES runs(run_id), '
+                                  'run_time TEXT NOT NULL)'.format(quote_identifier(table)))
+                existing = ['run_id', 'run_time']
+            for col in df.columns:
+                if col not in existing:
+                    self.conn.execute('ALTER TABLE {} ADD COLUMN {} {}'.format(quote_identifier(table),
+                                                                             quote_identifier(col),
+                                                                             sqlite_type(df[col].dtype)))
+            columns = self.table_columns(table)
+            for col in STORE_INDEXED_COLUMNS:
+                if col in columns:
+                    self.conn.execute('CREATE INDEX IF NOT EXISTS {} ON {} ({})'.format(
+                        quote_identifier('idx_{}_{}'.format(table, col)), quote_identifier(table),
+                        quote_identifier(col)))
+
+    def append(self, table: str, df: pd.DataFrame, options: Optional[Dict] = None) -> int:
+        """Record a run and append its results
+
+        Args:
+            table: Result table (see `STORE_TABLES`), i.e. the command that produced the results
+            df: Results
+            options: Run options to record
+
+        Returns:
+            (int): run ID
+        """
+        if table not in STORE_TABLES:
+            raise ValueError('Unknown results table "{}". Expected one of {}'.format(table, STORE_TABLES))
+        run_time = time.strftime(STORE_TIME_FORMAT, time.gmtime())
+        self._ensure_table(table, df)
+        # store float32 values as the float64 of their shortest text representation, i.e. as they are written
+        df = df.assign(**{col: df[col].astype(str).astype(np.float64)
+                          for col in df.columns if df[col].dtype == np.float32})
+        columns = ['run_id', 'run_time'] + list(df.columns)
+        sql = 'INSERT INTO {} ({}) VALUES ({})'.format(quote_identifier(table),
+                                                        ', '.join(quote_identifier(col) for col in columns),
+                                                        ', '.join('?' * len(columns)))
+        # the run and all its rows are committed together or not at all
+        with self.conn:
+            cursor = self.conn.execute('INSERT INTO runs (command, run_time, version, options, n_rows) '
+                                       'VALUES (?, ?, ?, ?, ?)',
+                                       (table, run_time, __version__, json.dumps(options or {}, default=str),
+                                        df.shape[0]))
+            run_id = cursor.lastrowid
+            for start in range(0, df.shape[0], self.batch_size):
+                batch = df.iloc[start:start + self.batch_size]
+                values = batch.astype(object).where(batch.notna(), None)
+                self.conn.executemany(sql, ([run_id, run_time] + [x.item() if hasattr(x, 'item') else x
+                                                                  for x in row]
+                                            for row in values.itertuples(index=False)))
+        logging.info('Stored %s %s results of run %s in "%s"', df.shape[0], table, run_id, self.path)
+        return run_id
+
+    def query(self,
+              table: str,
+              samples: Optional[List[str]] = None,
+              taxids: Optional[List[int]] = None,
+              assembly_accessions: Optional[List[str]] = None,
+              since: Optional[str] = None,
+              until: Optional[str] = None,
+              run_ids: Optional[List[int]] = None,
+              limit: int = 0) -> pd.DataFrame:
+        """Stored results matching all the given filters
+
+        Args:
+            table: Result table (see `STORE_TABLES`)
+            samples: Sample names
+            taxids: NCBI taxonomy UIDs
+            assembly_accessions: RefSeq assembly accessions
+            since: Min run timestamp (UTC, e.g. "2024-01-31" or "2024-01-31 12:00:00")
+            until: Max run timestamp (UTC; dates include the whole day)
+            run_ids: Run IDs
+            limit: Max number of rows (0 for all)
+
+        Returns:
+            (pd.DataFrame): stored results ordered by run and insertion order
+        """
+        if table not in STORE_TABLES:
+            raise ValueError('Unknown results table "{}". Expected one of {}'.format(table, STORE_TABLES))
+        if not self.table_columns(table):
+            return pd.DataFrame()
+        where = []
+        params = []
+        for col, values in [('sample', samples),
+                            ('taxid', taxids),
+                            ('assembly_accession', assembly_accessions),
+                            ('run_id', run_ids)]:
+            if values:
+                where.append('{} IN ({})'.format(quote_identifier(col), ', '.join('?' * len(values))))
+                params += list(values)
+        if since:
+            where.append('run_time >= ?')
+            params.append(since)
+        if until:
+            # a date without time covers the whole day
+            where.append('run_time <= ?' if len(until) > 10 else 'run_time < date(?, \'+1 day\')')
+            params.append(until)
+        sql = 'SELECT * FROM {}'.format(quote_identifier(table))
+        if where:
+            sql += ' WHERE ' + ' AND '.join(where)
+        sql += ' ORDER BY run_id, rowid'
+        if limit > 0:
+            sql += ' LIMIT {:d}'.format(limit)
+        logging.debug('Querying results store: %s %s', sql, params)
+        return pd.read_sql_query(sql, self.conn, params=params)
+
+    def runs(self) -> pd.DataFrame:
+        """All recorded runs"""
+        return pd.read_sql_query('SELECT * FROM runs ORDER BY run_id', self.conn)
+
+
+def store_results(path: Optional[str], table: str, df: Optional[pd.DataFrame], options: Optional[Dict] = None) -> None:
+    """Append a run's results to a results store if a store path was given"""
+    if path is None:
+        return
+    if df is None:
+        df = pd.DataFrame()
+    with ResultsStore(path) as store:
+        store.append(table, df, options)
@@ -3,41 +3,99 @@
 """NCBI Taxonomy information assignment
 
 All taxonomic information for all unique NCBI Taxonomy UIDs of RefSeq genomes
-in the Mash RefSeq sketch database is available in `NCBI_TAXID_INFO`. This info
-is merged with Mash results on the `taxid` column.
+in the Mash RefSeq sketch database is available from `ncbi_taxid_info`, which
+reads only the requested columns of the table. This info is merged with Mash
+results on the `taxid` column.
 
 """
 
 import logging
+from typing import List, Optional, Tuple
 from pkg_resources import resource_filename
 
+import numpy as np
 import pandas as pd
 
 from . import program_name
+from .utils import compact_dtypes, load_once
 
 #: NCBI taxonomy info table package resource path
 NCBI_TAXID_INFO_CSV = resource_filename(program_name, 'data/ncbi_refseq_taxonomy_summary.csv')
-#: Eagerly read the NCBI taxonomy info table for merging with Mash results
-NCBI_TAXID_INFO = pd.read_csv(NCBI_TAXID_INFO_CSV, low_memory=False)
+#: NCBI taxonomy info table columns
+NCBI_TAXID_INFO_COLUMNS = pd.read_csv(NCBI_TAXID_INFO_CSV, nrows=0).columns.tolist()
 
 
-def merge_ncbi_taxonomy_info(dfmash: pd.DataFrame) -> pd.DataFrame:
+def taxonomy_columns(columns: Optional[List[str]] = None) -> Optional[Tuple[str, ...]]:
+    """NCBI taxonomy info columns (besides `taxid`) among the requested output `columns` or None for all"""
+    if columns is None:
+        return None
+    return tuple(col for col in NCBI_TAXID_INFO_COLUMNS if col != 'taxid' and col in columns)
+
+
+@load_once
+def ncbi_taxid_info(columns: Optional[Tuple[str, ...]] = None) -> pd.DataFrame:
+    """NCBI taxonomy info table with int32 taxids and categorical strings, read once per process per column selection
+
+    Args:
+        columns: Columns to read besides `taxid` (default: all)
+
+    Returns:
+        (pd.DataFrame): NCBI taxonomy info table
+    """
+    usecols = NCBI_TAXID_INFO_COLUMNS if columns is None else ['taxid'] + list(columns)
+    logging.info('Reading NCBI taxonomy info table columns: %s', usecols)
+    return pd.read_csv(NCBI_TAXID_INFO_CSV,
+                       low_memory=False,
+                       usecols=usecols,
+                       dtype={col: (np.int32 if col == 'taxid' else 'category') for col in usecols})
+
+
+def ncbi_taxonomy_info(taxids: pd.Series,
+                       drop_na_columns: bool = True,
+                       columns: Optional[List[str]] = None) -> pd.DataFrame:
+    """NCBI Taxonomy info of NCBI taxonomy UIDs without the columns that are all NA for them
+
+    Args:
+        taxids: NCBI taxonomy UIDs
+        drop_na_columns: Drop the columns that are all NA for these taxids; keeping them gives the same columns for
+            any taxids, e.g. for merging results in batches (see `drop_na_taxonomy_columns`)
+        columns: Output columns; only the taxonomy info columns among them are read and returned (default: all)
+
+    Returns:
+        (pd.DataFrame): taxonomy info of each taxid found
+    """
+    logging.info('Fetching all taxonomy info for %s unique NCBI Taxonomy UIDs', taxids.unique().size)
+    tax_info = ncbi_taxid_info(taxonomy_columns(columns))
+    df_tax_info = compact_dtypes(tax_info.loc[tax_info.taxid.isin(taxids), :])
+    if drop_na_columns and df_tax_info.shape[0] > 0:
+        logging.info('Dropping columns with all NA values (ncol=%s)', df_tax_info.shape[1])
+        df_tax_info = df_tax_info.dropna(axis=1, how='all')
+        logging.info('Columns with all NA values dropped (ncol=%s)', df_tax_info.shape[1])
+    return df_tax_info
+
+
+def merge_ncbi_taxonomy_info(dfmash: pd.DataFrame,
+                             df_tax_info: Optional[pd.DataFrame] = None,
+                             columns: Optional[List[str]] = None) -> pd.DataFrame:
     """Merge/join NCBI Taxonomy info with Mash results table
 
     Merge/join on `taxid` (NCBI taxonomy UID)
 
     Args:
         dfmash: Mash results dataframe
+        df_tax_info: Taxonomy info from `ncbi_taxonomy_info` to merge, e.g. fetched once for several results tables
+            (default: fetched for the taxids in `dfmash`)
+        columns: Output columns; only the taxonomy info columns among them are fetched and merged (default: all)
 
     Returns:
         (pd.DataFrame): dataframe with Mash results and taxonomy information
     """
-    logging.info('Fetching all taxonomy info for %s unique NCBI Taxonomy UIDs', dfmash.taxid.unique().size)
-    df_tax_info = NCBI_TAXID_INFO.loc[NCBI_TAXID_INFO.taxid.isin(dfmash.taxid), :]
+    if columns is not None and not taxonomy_columns(columns):
+        logging.info('No taxonomy info columns requested. Skipping merge with taxonomy info.')
+        return dfmash
+    if df_tax_info is None:
+        df_tax_info = ncbi_taxonomy_info(dfmash.taxid, columns=columns)
     if df_tax_info.shape[0] > 0:
-        logging.info('Dropping columns with all NA values (ncol=%s)', df_tax_info.shape[1])
-        df_tax_info = df_tax_info.dropna(axis=1, how='all')
-        logging.info('Columns with all NA values dropped (ncol=%s)', df_tax_info.shape[1])
         logging.info('Merging Mash results with relevant taxonomic information')
         dfmerge = pd.merge(dfmash, df_tax_info, how='left', on='taxid')
         logging.info('Merged Mash results with taxonomy info')
@@ -46,3 +104,14 @@ def merge_ncbi_taxonomy_info(dfmash: pd.DataFrame) -> pd.DataFrame:
         logging.warning('No taxonomy info merged with Mash results!')
 
     return dfmash
+
+
+def drop_na_taxonomy_columns(dfmerge: pd.DataFrame) -> pd.DataFrame:
+    """Drop the merged NCBI taxonomy info columns that are all NA
+
+    Results merged with all taxonomy info columns (`ncbi_taxonomy_info(..., drop_na_columns=False)`) then have the
+    same columns as if they were merged all at once with `merge_ncbi_taxonomy_info`.
+    """
+    tax_columns = [col for col in NCBI_TAXID_INFO_COLUMNS if col != 'taxid' and col in dfmerge.columns]
+    na_columns = [col for col in tax_columns if dfmerge[col].isna().all()]
+    return dfmerge.drop(columns=na_columns)
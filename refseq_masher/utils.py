@@ -1,32 +1,118 @@
 import logging
 import os
 import re
-from collections import defaultdict
+import sys
+import threading
+from collections import defaultdict, deque
+from functools import wraps
+from concurrent.futures import ThreadPoolExecutor
+from queue import Queue, Empty, Full
 from subprocess import Popen, PIPE
-from typing import List, Tuple, Union, Optional, Any
+from typing import List, Tuple, Union, Optional, Any, Callable, Iterable, Iterator
 
 import pandas as pd
 
 from refseq_masher.const import REGEX_FASTA, REGEX_FASTQ
-from .const import REGEX_FASTQ, REGEX_FASTA
+from .const import REGEX_FASTQ, REGEX_FASTA, RESULT_COLUMN_DTYPES
 
 NT_SUB = {x: y for x, y in zip('acgtrymkswhbvdnxACGTRYMKSWHBVDNX', 'tgcayrkmswdvbhnxTGCAYRKMSWDVBHNX')}
+#: Serializes the first calls of `load_once` loaders (reentrant since loaders call other loaders)
+_LOAD_ONCE_LOCK = threading.RLock()
 
 
-def run_command(cmdlist: List[str], stdin: Optional[Any] = None, stderr: Optional[Any] = PIPE) -> (int, str, str):
+def run_command(cmdlist: List[str],
+                stdin: Optional[Any] = None,
+                stderr: Optional[Any] = PIPE,
+                decode_stdout: bool = True) -> (int, Union[str, bytes], str):
+    """Run a command and return its exit code, stdout and stderr
+
+    Set `decode_stdout=False` to get the raw stdout bytes, e.g. for parsing large Mash output without decoding it.
+    """
     p = Popen(cmdlist,
               stdout=PIPE,
               stderr=stderr,
               stdin=stdin)
     stdout, stderr = p.communicate()
     exit_code = p.returncode
-    if isinstance(stdout, bytes):
+    if decode_stdout and isinstance(stdout, bytes):
         stdout = stdout.decode()
     if isinstance(stderr, bytes):
         stderr = stderr.decode()
     return exit_code, stdout, stderr
 
 
+def run_command_peak_rss(cmdlist: List[str],
+                         stdin: Optional[Any] = None,
+                         stderr: Optional[Any] = PIPE,
+                         decode_stdout: bool = True) -> (int, Union[str, bytes], str, int):
+    """`run_command` that also returns the peak resident set size in bytes of the command's process"""
+    p = Popen(cmdlist,
+              stdout=PIPE,
+              stderr=stderr,
+              stdin=stdin)
+    stderr_chunks = []
+    stderr_reader = None
+    if p.stderr is not None:
+        stderr_reader = threading.Thread(target=lambda: stderr_chunks.append(p.stderr.read()), daemon=True)
+        stderr_reader.start()
+    stdout = p.stdout.read()
+    p.stdout.close()
+    if stderr_reader is not None:
+        stderr_reader.join()
+        p.stderr.close()
+    # reap the process with os.wait4 to get its own resource usage
+    _, status, rusage = os.wait4(p.pid, 0)
+    exit_code = -os.WTERMSIG(status) if os.WIFSIGNALED(status) else os.WEXITSTATUS(status)
+    p.returncode = exit_code
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    peak_rss = rusage.ru_maxrss if sys.platform == 'darwin' else rusage.ru_maxrss * 1024
+    stderr = stderr_chunks[0] if stderr_chunks else None
+    if decode_stdout and isinstance(stdout, bytes):
+        stdout = stdout.decode()
+    if isinstance(stderr, bytes):
+        stderr = stderr.decode()
+    return exit_code, stdout, stderr, peak_rss
+
+
+def run_commands_teed(cmd_lists: List[List[str]],
+                      chunks: Iterable[bytes],
+                      decode_stdout: bool = True) -> List[Tuple[int, Union[str, bytes], str]]:
+    """Run commands concurrently, writing the same stdin data to all of them
+
+    The stdin data is produced once, e.g. read and decompressed once, and written to each command as it is read.
+    Commands that exit early stop receiving data while the others continue.
+
+    Args:
+        cmd_lists: Commands to run
+        chunks: Stdin data chunks
+        decode_stdout: Decode stdout to text or return the raw bytes
+
+    Returns:
+        List of (exit code, stdout, stderr) of each command
+    """
+    procs = [Popen(cmd_list, stdin=PIPE, stdout=PIPE, stderr=PIPE) for cmd_list in cmd_lists]
+    with ThreadPoolExecutor(max_workers=2 * len(procs)) as executor:
+        outputs = [(executor.submit(p.stdout.read), executor.submit(p.stderr.read)) for p in procs]
+        open_procs = list(procs)
+        for chunk in chunks:
+            for p in list(open_procs):
+                try:
+                    p.stdin.write(chunk)
+                except BrokenPipeError:
+                    logging.warning('Command "%s" stopped reading input', ' '.join(p.args))
+                    open_procs.remove(p)
+        for p in procs:
+            try:
+                p.stdin.close()
+            except BrokenPipeError:
+                pass
+        results = []
+        for p, (stdout, stderr) in zip(procs, outputs):
+            out = stdout.result()
+            results.append((p.wait(), out.decode() if decode_stdout else out, stderr.result().decode()))
+    return results
+
+
 def exc_exists(exc_name: str) -> bool:
     """Check if an executable exists
 
@@ -186,6 +272,156 @@ def collect_inputs(inputs: List[str]) -> Tuple[List[Tuple[str, str]], List[Tuple
     return contigs, reads
 
 
+def load_once(func: Callable) -> Callable:
+    """Cache a loader's result per arguments like `lru_cache(maxsize=None)`, loading it once even from many threads
+
+    `lru_cache` does not serialize first calls, so concurrent workers (e.g. `contains -j`) would each load the
+    multi-GB RefSeq sketch database and index and race on writing their cache files. Concurrent first calls of a
+    `load_once` loader wait for a single load instead.
+    """
+    cache = {}
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        key = (args, tuple(sorted(kwargs.items())))
+        try:
+            return cache[key]
+        except KeyError:
+            pass
+        with _LOAD_ONCE_LOCK:
+            if key not in cache:
+                cache[key] = func(*args, **kwargs)
+            return cache[key]
+
+    wrapper.cache_clear = cache.clear
+    return wrapper
+
+
+def bounded_imap(func: Callable, iterable: Iterable, n_workers: int = 1, max_pending: int = 0) -> Iterator:
+    """Ordered, lazy, thread-parallel map with a bounded number of items in flight
+
+    Unlike `ThreadPoolExecutor.map`, the input iterable is consumed lazily so that only up to
+    `max_pending` items (default 2 per worker) are held in memory at once.
+
+    Args:
+        func: Function to apply to each item
+        iterable: Items
+        n_workers: Number of worker threads; items are mapped in the calling thread if <= 1
+        max_pending: Max number of submitted items not yet yielded
+
+    Yields:
+        func(item) for each item in input order
+    """
+    if n_workers <= 1:
+        yield from map(func, iterable)
+        return
+    max_pending = max_pending or 2 * n_workers
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        for item in iterable:
+            pending.append(executor.submit(func, item))
+            if len(pending) >= max_pending:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+#: End of stream marker passed between `pipelined` stages
+_END = object()
+
+
+class _StageFailure:
+    """Exception raised in a `pipelined` stage, passed downstream to be re-raised to the consumer"""
+
+    def __init__(self, exc: BaseException):
+        self.exc = exc
+
+
+def pipelined(iterable: Iterable, stages: List[Callable], queue_depth: int = 2) -> Iterator:
+    """Ordered, lazy pipeline running each stage in its own thread with bounded queues between stages
+
+    While the consumer handles the result of item i, the last stage can work on item i + 1, the stage before it on
+    item i + 2 and so on. Each stage processes one item at a time. A stage blocks once `queue_depth` of its results
+    are waiting for the next stage (backpressure), so at most about `queue_depth` items are in flight per stage.
+    An exception raised by any stage stops the pipeline and is re-raised to the consumer once all stages have
+    finished their current item.
+
+    Args:
+        iterable: Items
+        stages: Functions applied to each item in order, each to the result of the previous one
+        queue_depth: Max number of items waiting between two stages; all stages run in the calling thread if <= 0
+
+    Yields:
+        Result of the last stage for each item in input order
+    """
+    if queue_depth <= 0:
+        for item in iterable:
+            for stage in stages:
+                item = stage(item)
+            yield item
+        return
+    stop = threading.Event()
+    queues = [Queue(maxsize=queue_depth) for _ in range(len(stages) + 1)]
+
+    def put(q: Queue, item) -> bool:
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except Full:
+                pass
+        return False
+
+    def get(q: Queue):
+        while not stop.is_set():
+            try:
+                return q.get(timeout=0.1)
+            except Empty:
+                pass
+        return _END
+
+    def feed():
+        try:
+            for item in iterable:
+                if not put(queues[0], item):
+                    return
+        except Exception as ex:
+            put(queues[0], _StageFailure(ex))
+            return
+        put(queues[0], _END)
+
+    def run_stage(stage: Callable, inq: Queue, outq: Queue):
+        while True:
+            item = get(inq)
+            if item is not _END and not isinstance(item, _StageFailure):
+                try:
+                    item = stage(item)
+                except Exception as ex:
+                    item = _StageFailure(ex)
+            if not put(outq, item) or item is _END or isinstance(item, _StageFailure):
+                return
+
+    threads = [threading.Thread(target=feed, daemon=True)]
+    threads += [threading.Thread(target=run_stage, args=(stage, queues[i], queues[i + 1]), daemon=True)
+                for i, stage in enumerate(stages)]
+    for thread in threads:
+        thread.start()
+    try:
+        while True:
+            item = get(queues[-1])
+            if item is _END:
+                return
+            if isinstance(item, _StageFailure):
+                raise item.exc
+            yield item
+    finally:
+        stop.set()
+        # let stages finish their current item so that resources they create (e.g. temporary files) can be cleaned
+        # up by the caller once the pipeline is closed
+        for thread in threads[1:]:
+            thread.join()
+
+
 LOG_FORMAT = '%(asctime)s %(levelname)s: %(message)s [in %(pathname)s:%(lineno)d]'
 
 
@@ -199,7 +435,68 @@ def init_console_logger(logging_verbosity=3):
     return lvl
 
 
-def order_output_columns(dfout: pd.DataFrame, cols: List[str]) -> pd.DataFrame:
+def compact_dtypes(df: pd.DataFrame) -> pd.DataFrame:
+    """Downcast results columns to `RESULT_COLUMN_DTYPES` and store string columns as categoricals
+
+    Results have many string columns (taxonomy, accessions, sample names) whose values repeat across rows, so
+    dictionary-encoding them as categoricals uses a fraction of the memory of Python string objects. The text
+    written by `to_csv` is unchanged. Categories no longer used by any row (e.g. after `head` or filtering) are
+    dropped, since a categorical keeps all its categories and those of a full RefSeq results table take far more
+    memory than a few top results. Compact results only after selecting their top N.
+
+    Args:
+        df: Results or taxonomy info dataframe
+
+    Returns:
+        (pd.DataFrame): dataframe with compact column dtypes
+    """
+    dtypes = {}
+    for col, dtype in df.dtypes.items():
+        if isinstance(dtype, pd.CategoricalDtype):
+            if len(dtype.categories) > df[col].nunique():
+                df = df.assign(**{col: df[col].cat.remove_unused_categories()})
+            continue
+        if col in RESULT_COLUMN_DTYPES:
+            compact = RESULT_COLUMN_DTYPES[col]
+            if compact.startswith('int') and df[col].isna().any():
+                compact = compact.capitalize()
+            if dtype != compact:
+                dtypes[col] = compact
+        elif pd.api.types.is_object_dtype(dtype) or pd.api.types.is_string_dtype(dtype):
+            dtypes[col] = 'category'
+    return df.astype(dtypes) if dtypes else df
+
+
+def concat_results(dfs: List[pd.DataFrame]) -> pd.DataFrame:
+    """Concatenate results dataframes with compact dtypes, keeping categorical columns categorical
+
+    `pd.concat` falls back to object dtype for categorical columns with different categories in each dataframe so
+    the categories of each categorical column are unioned first.
+
+    Args:
+        dfs: Results dataframes
+
+    Returns:
+        (pd.DataFrame): concatenated results
+    """
+    dfs = [compact_dtypes(df) for df in dfs]
+    categorical_columns = [col for col in dfs[0].columns
+                           if all(col in df.columns and isinstance(df[col].dtype, pd.CategoricalDtype) for df in dfs)]
+    for col in categorical_columns:
+        categories = dfs[0][col].cat.categories
+        for df in dfs[1:]:
+            categories = categories.union(df[col].cat.categories, sort=False)
+        dfs = [df.assign(**{col: df[col].cat.set_categories(categories)}) for df in dfs]
+    return pd.concat(dfs)
+
+
+def order_output_columns(dfout: pd.DataFrame, cols: List[str], columns: Optional[List[str]] = None) -> pd.DataFrame:
+    """Output columns in the preferred order `cols` or only the requested `columns` in their order if given
+
+    Requested columns missing from the results (e.g. taxonomy info that was not found) are output as all NA.
+    """
+    if columns is not None:
+        return dfout.reindex(columns=columns)
     set_columns = set(dfout.columns)
     present_columns = [x for x in cols if x in set_columns]
     rest_columns = list(set_columns - set(present_columns))
@@ -0,0 +1,217 @@
+# -*- coding: utf-8 -*-
+
+"""Watch-folder streaming classification of sequencing runs
+
+A watched directory is polled for new FASTQ files (e.g. Nanopore read chunks).
+A file is processed once its size and modification time are unchanged between
+two polls. Each file's reads are folded into its sample's running state (a
+Mash sketch for matches or a screen state for contains) without re-reading
+earlier files, and the sample's updated top hits are emitted after each file.
+
+Files in a subdirectory of the watched directory (e.g. `barcode01/`) belong to
+the sample named after the subdirectory; files directly in the watched
+directory belong to a sample named after the watched directory.
+"""
+
+import logging
+import os
+import time
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import pandas as pd
+
+from .const import REGEX_FASTQ, MASH_DIST_ORDERED_COLUMNS, MASH_SCREEN_ORDERED_COLUMNS
+from .mash.native_dist import refseq_dist_engine
+from .mash.native_screen import refseq_screen_engine
+from .mash.native_sketch import SketchState
+from .mash.parser import mash_dist_table_to_dataframe, mash_screen_table_to_dataframe
+from .seqio import iter_sequences, batch_sequences
+from .taxonomy import merge_ncbi_taxonomy_info
+from .utils import bounded_imap
+
+#: Watch modes
+WATCH_MODES = ['matches', 'contains']
+#: Running totals reported with each update of a sample's top hits
+WATCH_PROGRESS_COLUMNS = ['files', 'bases']
+
+
+def watched_sample_name(directory: str, path: str) -> str:
+    """Sample name of a file in a watched directory: its subdirectory or the watched directory's name"""
+    rel_dir = os.path.dirname(os.path.relpath(path, directory))
+    if rel_dir:
+        return rel_dir.split(os.sep)[0]
+    return os.path.basename(os.path.abspath(directory))
+
+
+class FolderWatcher:
+    """Polls a directory tree for new, completely written FASTQ files
+
+    Args:
+        directory: Directory to watch
+        interval: Seconds between polls
+    """
+
+    def __init__(self, directory: str, interval: float = 10.0):
+        self.directory = directory
+        self.interval = interval
+        self.processed = set()
+        #: (size, mtime) of unprocessed files at the last poll
+        self.last_stat = {}  # type: Dict[str, Tuple[int, int]]
+
+    def poll(self) -> List[str]:
+        """New FASTQ files that did not change since the previous poll, oldest first"""
+        stats = {}
+        for dirpath, _, filenames in os.walk(self.directory):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                if path in self.processed or not REGEX_FASTQ.match(filename):
+                    continue
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                stats[path] = (st.st_size, st.st_mtime_ns)
+        ready = [path for path, stat in stats.items() if stat[0] > 0 and self.last_stat.get(path) == stat]
+        self.last_stat = {path: stat for path, stat in stats.items() if path not in ready}
+        self.processed.update(ready)
+        return sorted(ready, key=lambda path: (stats[path][1], path))
+
+    def watch(self, idle_timeout: float = 0) -> Iterator[Tuple[str, str]]:
+        """Yield new FASTQ files and their sample names as they are completely written
+
+        Args:
+            idle_timeout: Stop after this many seconds without new files (0: watch until interrupted)
+
+        Yields:
+            (str, str): FASTQ file path and sample name
+        """
+        logging.info('Watching "%s" for new FASTQ files every %s seconds', self.directory, self.interval)
+        last_new = time.monotonic()
+        try:
+            while True:
+                ready = self.poll()
+                for path in ready:
+                    yield path, watched_sample_name(self.directory, path)
+                if ready:
+                    last_new = time.monotonic()
+                elif idle_timeout > 0 and time.monotonic() - last_new >= idle_timeout:
+                    logging.info('No new FASTQ files for %s seconds. Stopping.', idle_timeout)
+                    return
+                time.sleep(self.interval)
+        except KeyboardInterrupt:
+            logging.info('Stopped watching "%s"', self.directory)
+
+
+class StreamingClassifier:
+    """Running per-sample matches or contains state updated file by file
+
+    Args:
+        mode: "matches" (running Mash sketch vs RefSeq distances) or "contains" (running Mash screen)
+        mash_bin: Mash binary path (only used to decode the RefSeq sketch database on first use)
+        top_n_results: Number of top hits to report per update (0: all)
+        min_kmer_threshold: Matches: min copies of each k-mer required to be added to the sketch
+        min_identity: Contains: min identity to report
+        max_pvalue: Contains: max p-value to report
+        parallelism: Number of k-mer hashing threads
+    """
+
+    def __init__(self,
+                 mode: str = 'matches',
+                 mash_bin: str = 'mash',
+                 top_n_results: int = 5,
+                 min_kmer_threshold: int = 8,
+                 min_identity: float = 0.9,
+                 max_pvalue: float = 0.01,
+                 parallelism: int = 1):
+        if mode not in WATCH_MODES:
+            raise ValueError('Unknown watch mode "{}". Expected one of {}'.format(mode, WATCH_MODES))
+        self.mode = mode
+        self.top_n_results = top_n_results
+        self.min_kmer_threshold = min_kmer_threshold
+        self.min_identity = min_identity
+        self.max_pvalue = max_pvalue
+        self.parallelism = parallelism
+        if mode == 'matches':
+            self.engine = refseq_dist_engine(mash_bin)
+        else:
+            self.engine = refseq_screen_engine(mash_bin)
+        self.states = {}
+        self.progress = {}  # type: Dict[str, Dict[str, int]]
+
+    def _new_state(self):
+        if self.mode == 'matches':
+            db = self.engine.db
+            return SketchState(kmer_size=db.kmer_size,
+                               sketch_size=db.sketch_size,
+                               min_copies=self.min_kmer_threshold,
+                               hash_seed=db.hash_seed)
+        return self.engine.new_state()
+
+    def add_file(self, path: str, sample_name: str) -> Optional[pd.DataFrame]:
+        """Fold a FASTQ file into its sample's state
+
+        Returns:
+            (pd.DataFrame): sample's updated top hits or None if there are none
+        """
+        if sample_name not in self.states:
+            logging.info('New sample "%s"', sample_name)
+            self.states[sample_name] = self._new_state()
+            self.progress[sample_name] = dict(files=0, bases=0)
+        state = self.states[sample_name]
+        progress = self.progress[sample_name]
+        hash_sequences = state.hash_sequences if self.mode == 'matches' else self.engine.hash_sequences
+        batches = batch_sequences(iter_sequences(path))
+
+        def hash_batch(seqs):
+            return sum(len(seq) for seq in seqs), hash_sequences(seqs)
+
+        for n_bases, hashes in bounded_imap(hash_batch, batches, n_workers=self.parallelism):
+            progress['bases'] += n_bases
+            if self.mode == 'matches':
+                state.add_hashes(hashes)
+            else:
+                self.engine.add_hashes(state, hashes)
+        progress['files'] += 1
+        logging.info('Added "%s" to sample "%s" (files=%s, bases=%s)', path, sample_name, progress['files'],
+                     progress['bases'])
+        df = self.top_hits(sample_name)
+        if df is None:
+            return None
+        for column in WATCH_PROGRESS_COLUMNS:
+            df[column] = progress[column]
+        return df
+
+    def top_hits(self, sample_name: str) -> Optional[pd.DataFrame]:
+        """Current top hits of a sample or None if there are none"""
+        state = self.states[sample_name]
+        if self.mode == 'matches':
+            if state.hashes.size == 0:
+                return None
+            df = mash_dist_table_to_dataframe(self.engine.dist_table(state.hashes, state.estimated_length()))
+        else:
+            df = self.engine.results(state, min_identity=self.min_identity, max_pvalue=self.max_pvalue)
+            if df is None:
+                return None
+            df = mash_screen_table_to_dataframe(df)
+        if self.top_n_results > 0:
+            df = df.head(self.top_n_results)
+        df['sample'] = sample_name
+        return df
+
+    def output_columns(self) -> List[str]:
+        """Fixed output columns of every update so that updates can be streamed as one table"""
+        ordered = MASH_DIST_ORDERED_COLUMNS if self.mode == 'matches' else MASH_SCREEN_ORDERED_COLUMNS
+        return ordered[:1] + WATCH_PROGRESS_COLUMNS + ordered[1:]
+
+
+def watch_updates(watcher: FolderWatcher,
+                  classifier: StreamingClassifier,
+                  idle_timeout: float = 0) -> Iterator[pd.DataFrame]:
+    """Updated top hits with taxonomy info of each sample after each new file in a watched directory"""
+    columns = classifier.output_columns()
+    for path, sample_name in watcher.watch(idle_timeout=idle_timeout):
+        df = classifier.add_file(path, sample_name)
+        if df is None:
+            logging.info('No hits yet for sample "%s"', sample_name)
+            continue
+        yield merge_ncbi_taxonomy_info(df).reindex(columns=columns)
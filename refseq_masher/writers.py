@@ -1,6 +1,8 @@
 # -*- coding: utf-8 -*-
 
 import logging
+import sys
+from typing import Iterable
 
 import click
 import pandas as pd
@@ -20,3 +22,23 @@ def write_dataframe(dfout: pd.DataFrame,
         logging.info('Wrote output to "%s"', output_path)
 
 
+def write_dataframe_chunks(dfs: Iterable[pd.DataFrame],
+                           output_path: str,
+                           output_type: str) -> None:
+    """Write dataframes with the same columns as one table as they are generated
+
+    Only the header of the first dataframe is written so that output can be streamed without holding all rows in
+    memory.
+    """
+    df_write_args = dict(sep=OUTPUT_TYPES[output_type], index=None)
+    handle = sys.stdout if output_path == '-' else open(output_path, 'w')
+    try:
+        n_rows = 0
+        for i, df in enumerate(dfs):
+            df.to_csv(handle, header=(i == 0), **df_write_args)
+            handle.flush()
+            n_rows += df.shape[0]
+    finally:
+        if handle is not sys.stdout:
+            handle.close()
+    logging.info('Wrote %s rows of output to "%s"', n_rows, output_path)
@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+
+import pandas as pd
+
+from refseq_masher.checkpoint import CheckpointJournal, checkpointed
+
+
+def test_resume_skips_completed_samples(tmp_path):
+    fasta = tmp_path / 'a.fasta'
+    fasta.write_text('>a\nACGT\n')
+    ckpt_dir = str(tmp_path / 'ckpt')
+    calls = []
+
+    def run():
+        calls.append(1)
+        return pd.DataFrame(dict(sample=['a'], distance=[0.01]))
+
+    journal = CheckpointJournal(ckpt_dir, 'matches', dict(top_n_results=5))
+    df = checkpointed(journal, 'a', [str(fasta)], run)
+    assert len(calls) == 1
+
+    journal = CheckpointJournal(ckpt_dir, 'matches', dict(top_n_results=5))
+    df_resumed = checkpointed(journal, 'a', [str(fasta)], run)
+    assert len(calls) == 1, 'Completed sample should not be recomputed'
+    pd.testing.assert_frame_equal(df, df_resumed)
+
+    journal = CheckpointJournal(ckpt_dir, 'matches', dict(top_n_results=10))
+    checkpointed(journal, 'a', [str(fasta)], run)
+    assert len(calls) == 2, 'Changed options should invalidate checkpoint'
+
+
+def test_no_results_checkpointed(tmp_path):
+    fastq = tmp_path / 'r_1.fastq'
+    fastq.write_text('@r\nACGT\n+\nIIII\n')
+    ckpt_dir = str(tmp_path / 'ckpt')
+    journal = CheckpointJournal(ckpt_dir, 'contains', {})
+    assert checkpointed(journal, 'r', [str(fastq)], lambda: None) is None
+    journal = CheckpointJournal(ckpt_dir, 'contains', {})
+    assert checkpointed(journal, 'r', [str(fastq)], lambda: 1 / 0) is None
@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+
+import gzip
+
+import pandas as pd
+
+from refseq_masher.mash.classify import join_results
+from refseq_masher.seqio import iter_decompressed_chunks
+from refseq_masher.utils import run_commands_teed
+
+
+def test_inputs_decompressed_once_and_teed_to_all_commands(tmp_path):
+    reads_1 = tmp_path / 'reads_1.fastq.gz'
+    reads_2 = tmp_path / 'reads_2.fastq'
+    with gzip.open(str(reads_1), 'wb') as f:
+        f.write(b'@r1\nACGT\n+\nIIII')
+    reads_2.write_bytes(b'@r2\nTTTT\n+\nIIII\n')
+
+    (cat_exit_code, cat_stdout, _), (wc_exit_code, wc_stdout, _) = run_commands_teed(
+        [['cat'], ['wc', '-l']], iter_decompressed_chunks([str(reads_1), str(reads_2)], chunk_size=5))
+    assert cat_exit_code == wc_exit_code == 0
+    assert cat_stdout == '@r1\nACGT\n+\nIIII\n@r2\nTTTT\n+\nIIII\n'
+    assert int(wc_stdout) == 8
+
+
+def test_join_results_keeps_matches_and_contained_genomes():
+    info = dict(taxid=[1, 2], bioproject=['PRJNA1', 'PRJNA2'])
+    df_dist = pd.DataFrame(dict(match_id=['a', 'b'], distance=[0.01, 0.2], pvalue=[0.0, 1e-5],
+                                matching=['390/400', '50/400'], sample='s', **info))
+    df_screen = pd.DataFrame(dict(match_id=['c', 'a'], identity=[0.99, 0.98], shared_hashes=['380/400', '370/400'],
+                                  median_multiplicity=[10, 3], pvalue=[0.0, 0.0], sample='s',
+                                  taxid=[3, 1], bioproject=['PRJNA3', 'PRJNA1']))
+    df = join_results(df_dist, df_screen)
+    assert df.match_id.tolist() == ['a', 'b', 'c']
+    assert df.taxid.tolist() == [1, 2, 3]
+    assert df.bioproject.tolist() == ['PRJNA1', 'PRJNA2', 'PRJNA3']
+    assert df.median_multiplicity.tolist()[0] == 3
+    assert pd.isna(df.median_multiplicity.iloc[1])
+    assert {'dist_pvalue', 'screen_pvalue'} <= set(df.columns)
@@ -1,8 +1,11 @@
 # -*- coding: utf-8 -*-
 
+import os
+import sys
 from io import StringIO
 
 from click.testing import CliRunner
+import numpy as np
 import pytest
 import pandas as pd
 
@@ -30,3 +33,70 @@ def test_fasta(runner):
     df = pd.read_table(StringIO(result.output))
     assert df.top_taxonomy_name.str.contains(expected_top_tax_name).all(), \
         'All top 5 Mash RefSeq results should have "{}" in the top_taxonomy_name field'.format(expected_top_tax_name)
+
+
+FAKE_MASH = '''#!{python}
+# fake `mash dist`: one RefSeq match per query sketch with a distance computed from the sketch file contents
+import sys
+import zlib
+
+ref, sketch_path = sys.argv[2:]
+if 'bad' in sketch_path:
+    sys.exit('cannot dist ' + sketch_path)
+with open(sketch_path, 'rb') as f:
+    checksum = zlib.crc32(f.read())
+for taxid in (1000, 1001):
+    print('./rcn/refseq-NZ-{{0}}-PRJNA{{0}}-.-GCF_{{0}}.1-.-Genome_{{0}}.fna\\t{{1}}\\t{{2}}\\t0\\t{{3}}/400'.format(
+        taxid, sketch_path, (checksum % 1000 + taxid) / 1e5, checksum % 400))
+'''
+
+
+@pytest.fixture
+def fake_mash(tmp_path):
+    mash_bin = tmp_path / 'mash'
+    mash_bin.write_text(FAKE_MASH.format(python=sys.executable))
+    mash_bin.chmod(0o755)
+    return str(mash_bin)
+
+
+def write_fasta(path, rng, n=2000):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text('>contig\n{}\n'.format(''.join(rng.choice(list('ACGT'), n))))
+    return str(path)
+
+
+def run_matches(runner, mash_bin, tmp_dir, inputs, queue_depth):
+    return runner.invoke(cli.matches, ['--mash-bin', mash_bin, '--sketcher', 'native', '-T', str(tmp_dir),
+                                       '-q', str(queue_depth), *inputs])
+
+
+def test_pipelined_matches_same_as_sequential(runner, fake_mash, tmp_path):
+    rng = np.random.RandomState(7)
+    # same sample name in different folders; more samples than the queue depth
+    fastas = [write_fasta(tmp_path / 'dup1' / 'x.fasta', rng),
+              write_fasta(tmp_path / 'dup2' / 'x.fasta', rng)]
+    fastas += [write_fasta(tmp_path / 'samples' / 's{}.fasta'.format(i), rng) for i in range(5)]
+    tmp_dir = tmp_path / 'tmp'
+    tmp_dir.mkdir()
+    sequential = run_matches(runner, fake_mash, tmp_dir, fastas, 0)
+    assert sequential.exit_code == 0, sequential.output
+    df = pd.read_table(StringIO(sequential.output))
+    assert df['sample'].tolist() == [s for s in ['x', 'x', 's0', 's1', 's2', 's3', 's4'] for _ in range(2)]
+    assert df.distance.nunique() == 14, 'Each sample should be measured with its own sketch'
+    for _ in range(3):
+        pipelined = run_matches(runner, fake_mash, tmp_dir, fastas, 2)
+        assert pipelined.exit_code == 0, pipelined.output
+        assert pipelined.output == sequential.output
+    assert os.listdir(str(tmp_dir)) == []
+
+
+def test_pipelined_matches_failure_removes_sketches(runner, fake_mash, tmp_path):
+    rng = np.random.RandomState(7)
+    fastas = [write_fasta(tmp_path / 's{}.fasta'.format(i), rng) for i in range(3)]
+    fastas.insert(1, write_fasta(tmp_path / 'bad.fasta', rng))
+    tmp_dir = tmp_path / 'tmp'
+    tmp_dir.mkdir()
+    result = run_matches(runner, fake_mash, tmp_dir, fastas, 2)
+    assert result.exit_code != 0
+    assert 'Could not run Mash dist' in str(result.exception)
+    assert os.listdir(str(tmp_dir)) == [], 'Temporary sketches should be removed when a stage fails'
@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+
+import threading
+import time
+
+import pytest
+
+from refseq_masher.memory import MemoryAdmission, parse_memory_size
+
+
+def test_parse_memory_size():
+    assert parse_memory_size('512M') == 512 << 20
+    assert parse_memory_size('1.5G') == 3 << 29
+    assert parse_memory_size('16gb') == 16 << 30
+    assert parse_memory_size('4096') == 4096
+    with pytest.raises(ValueError):
+        parse_memory_size('lots')
+
+
+def test_memory_admission_limits_concurrent_jobs_and_learns():
+    admission = MemoryAdmission(100 << 20, fixed_bytes=30 << 20, bytes_per_input_byte=0.01)
+    admission.budget = 100 << 20
+    running = []
+    max_running = []
+    lock = threading.Lock()
+
+    def job():
+        with admission.admitted(0):
+            with lock:
+                running.append(1)
+                max_running.append(len(running))
+            time.sleep(0.05)
+            with lock:
+                running.pop()
+
+    threads = [threading.Thread(target=job) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert max(max_running) == 3
+    assert admission.reserved == 0 and admission.running == 0
+
+    admission.observe(0, 60 << 20)
+    assert admission.estimate(0) == 60 << 20
+    # a job larger than the budget still runs when nothing else is running
+    with admission.admitted(10 << 30) as estimate:
+        assert estimate > admission.budget
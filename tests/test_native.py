@@ -0,0 +1,286 @@
+# -*- coding: utf-8 -*-
+
+import struct
+
+import numpy as np
+import pandas as pd
+
+from refseq_masher.mash.cluster import ClusteredNativeDist, cluster_sketches
+from refseq_masher.mash.kmers import kmer_hashes
+from refseq_masher.mash.native_dist import NativeDist, FastNativeDist, exact_common_and_denom
+from refseq_masher.mash.native_screen import NativeScreen
+from refseq_masher.mash.msh import msh_bytes
+from refseq_masher.mash.native_sketch import SketchState, sketch_fastqs
+from refseq_masher.mash.pairwise import PairwiseDist
+from refseq_masher.mash.sketchdb import SketchDB
+from refseq_masher.mash.stats import mash_distance
+
+
+def random_genome(rng, n):
+    return rng.choice(np.frombuffer(b'ACGT', dtype=np.uint8), n).tobytes()
+
+
+def make_sketch_db(genomes, k=16, s=400):
+    rows = [np.unique(kmer_hashes([g], k=k))[:s] for g in genomes]
+    offsets = np.concatenate(([0], np.cumsum([r.size for r in rows])))
+    names = ['./rcn/refseq-NZ-{0}-PRJNA{0}-.-GCF_{0}.1-.-Genome_{0}.fna'.format(i + 1) for i in range(len(genomes))]
+    return SketchDB(kmer_size=k, hash_seed=42, hash_bits=32 if k <= 16 else 64, sketch_size=s,
+                    names=np.array(names),
+                    comments=np.array([''] * len(genomes)),
+                    lengths=np.array([len(g) for g in genomes]),
+                    offsets=offsets,
+                    hashes=np.concatenate(rows))
+
+
+def capnp_pointer(segment, ptr_word):
+    """Decode the Cap'n Proto struct or list pointer at `ptr_word` into (kind, target word, b, c)"""
+    lo, hi = struct.unpack_from('<iI', segment, 8 * ptr_word)
+    if lo == 0 and hi == 0:
+        return None
+    kind = lo & 3
+    target = ptr_word + 1 + (lo >> 2)
+    if kind == 0:
+        # struct: data words and pointer count
+        return kind, target, hi & 0xffff, hi >> 16
+    assert kind == 1, 'Only struct and list pointers are expected in a single segment message'
+    # list: element size code and element count (words for composite lists)
+    return kind, target, hi & 7, hi >> 3
+
+
+def capnp_struct(segment, ptr_word):
+    kind, target, data_words, ptr_count = capnp_pointer(segment, ptr_word)
+    assert kind == 0
+    return target, data_words, ptr_count
+
+
+def capnp_list(segment, ptr_word, element_size, dtype):
+    pointer = capnp_pointer(segment, ptr_word)
+    if pointer is None:
+        return None
+    kind, target, size_code, count = pointer
+    assert kind == 1 and size_code == element_size
+    return np.frombuffer(segment, dtype=dtype, count=count, offset=8 * target).tolist()
+
+
+def capnp_text(segment, ptr_word):
+    data = bytes(capnp_list(segment, ptr_word, 2, np.uint8))
+    assert data.endswith(b'\0')
+    return data[:-1].decode()
+
+
+def decode_msh(segment):
+    """Decode the `MinHash` message fields written by `msh_bytes` from a single segment"""
+    root, data_words, ptr_count = capnp_struct(segment, 0)
+    assert (data_words, ptr_count) == (3, 4)
+    kmer_size, _, sketch_size = struct.unpack_from('<III', segment, 8 * root)
+    hash_seed, = struct.unpack_from('<I', segment, 8 * root + 20)
+    ref_list, data_words, ptr_count = capnp_struct(segment, root + 3 + 2)
+    assert (data_words, ptr_count) == (0, 1)
+    kind, tag, size_code, n_words = capnp_pointer(segment, ref_list)
+    assert kind == 1 and size_code == 7
+    tag_lo, data_words, ptr_count = struct.unpack_from('<IHH', segment, 8 * tag)
+    n_refs = tag_lo >> 2
+    assert (data_words, ptr_count) == (2, 7) and n_words == n_refs * 9
+    references = []
+    for i in range(n_refs):
+        ref = tag + 1 + 9 * i
+        ptrs = ref + 2
+        references.append(dict(name=capnp_text(segment, ptrs + 2),
+                               comment=capnp_text(segment, ptrs + 3),
+                               length=struct.unpack_from('<Q', segment, 8 * ref + 8)[0],
+                               hashes=capnp_list(segment, ptrs + 4, 4, '<u4'),
+                               counts=capnp_list(segment, ptrs + 6, 4, '<u4'),
+                               counts_sorted=bool(segment[8 * ref + 4] & 1)))
+    return dict(kmer_size=kmer_size, sketch_size=sketch_size, hash_seed=hash_seed,
+                alphabet=capnp_text(segment, root + 3 + 3), references=references)
+
+
+def test_kmer_hashes_match_mash_murmurhash3():
+    # "ACGTACGTACGTACGT" is its own reverse complement and poly-T k-mers are hashed as poly-A
+    assert kmer_hashes([b'ACGTACGTACGTACGT']).tolist() == [4706917051267373191 & 0xffffffff]
+    assert kmer_hashes([b'tttttttttttttttt']).tolist() == [13494848630691601671 & 0xffffffff]
+    assert kmer_hashes([b'T' * 21], k=21).tolist() == [18154334747705351023]
+    assert kmer_hashes([b'ACGTNACGTACGTACGTACGTA']).size == 2
+
+
+def test_native_screen(tmp_path):
+    rng = np.random.default_rng(42)
+    genomes = [random_genome(rng, 50000) for _ in range(10)]
+    db = make_sketch_db(genomes)
+    fasta = tmp_path / 'sample.fasta'
+    fasta.write_bytes(b'>a\n' + genomes[3] + b'\n>b\n' + genomes[3][:25000] + b'\n')
+
+    df = NativeScreen(db).screen([str(fasta)], min_identity=0.9, max_pvalue=0.01)
+    assert df.match_id.tolist() == [db.names[3]]
+    assert df.identity.iloc[0] == 1.0
+    assert df.shared_hashes.iloc[0] == '400/400'
+    assert df.median_multiplicity.iloc[0] in (1, 2)
+
+
+def test_incremental_screen_state_only_keeps_hits():
+    rng = np.random.default_rng(43)
+    genomes = [random_genome(rng, 20000) for _ in range(10)]
+    screen = NativeScreen(make_sketch_db(genomes))
+    seqs = [genomes[2], genomes[5][:10000], genomes[2][:5000]]
+    all_hashes = screen.hash_sequences(seqs)
+    once = screen.new_state()
+    screen.add_hashes(once, all_hashes)
+
+    state = screen.new_state()
+    for seq in seqs:
+        screen.add_hashes(state, screen.hash_sequences([seq]))
+    _, hit_positions = screen.index.lookup(all_hashes)
+    positions, counts = np.unique(hit_positions, return_counts=True)
+    assert state.positions.tolist() == positions.tolist()
+    assert state.counts.tolist() == counts.tolist()
+    assert positions.size < screen.union_hashes.size
+
+    df = screen.results(state, min_identity=0.5, max_pvalue=1.0)
+    pd.testing.assert_frame_equal(df, screen.results(once, min_identity=0.5, max_pvalue=1.0))
+    assert df.match_id.tolist() == [screen.db.names[2], screen.db.names[5]]
+    assert df.shared_hashes.iloc[0] == '400/400'
+    assert screen.results(screen.new_state()) is None
+
+
+def test_native_dist_matches_bottom_s_union_jaccard():
+    rng = np.random.default_rng(7)
+    genomes = [random_genome(rng, int(n)) for n in rng.integers(1000, 20000, 50)]
+    db = make_sketch_db(genomes, s=100)
+    query = bytearray(genomes[0])
+    for i in rng.choice(len(query), len(query) // 50, replace=False):
+        query[i] = b'ACGT'[(b'ACGT'.index(query[i]) + 1) % 4]
+    query_hashes = np.unique(kmer_hashes([bytes(query)]))[:100]
+
+    common, denom = NativeDist(db).common_and_denom(query_hashes)
+    for row in range(len(db)):
+        union = np.union1d(db.row_hashes(row), query_hashes)
+        bottom = union[:100]
+        assert common[row] == np.intersect1d(np.intersect1d(bottom, db.row_hashes(row)), query_hashes).size
+        assert denom[row] == min(union.size, 100)
+
+    df = NativeDist(db).dist_table(query_hashes, len(query))
+    assert df.sort_values('distance').match_id.iloc[0] == db.names[0]
+
+
+def test_fast_native_dist_agrees_with_full_resolution():
+    rng = np.random.default_rng(11)
+    genomes = [random_genome(rng, 20000) for _ in range(40)]
+    db = make_sketch_db(genomes, s=400)
+    query_hashes = np.unique(kmer_hashes([genomes[5][:15000]]))[:400]
+
+    df_full = NativeDist(db).dist_table(query_hashes, 15000).sort_values('distance')
+    df_fast = FastNativeDist(db, db.downsample(50)).dist_table(query_hashes, 15000, n_candidates=10)
+    df_fast = df_fast.sort_values('distance')
+    assert df_fast.match_id.iloc[0] == df_full.match_id.iloc[0] == db.names[5]
+    assert df_fast.matching.iloc[0] == df_full.matching.iloc[0]
+    assert df_fast.coarse_rank.iloc[0] == 1
+
+
+def test_fast_native_dist_rescores_all_coarse_ties_at_the_cutoff():
+    rng = np.random.default_rng(17)
+    genomes = [random_genome(rng, 20000) for _ in range(10)]
+    db = make_sketch_db(genomes, s=400)
+    query_hashes = np.unique(kmer_hashes([genomes[7]]))[:400]
+    # all coarse sketches are the query's own bottom-50 hashes, so all genomes tie on the coarse score
+    coarse_db = make_sketch_db(genomes, s=400).downsample(50)
+    coarse_db.hashes = np.tile(query_hashes[:50], len(genomes))
+    df_fast = FastNativeDist(db, coarse_db).dist_table(query_hashes, 20000, n_candidates=3)
+    assert df_fast.shape[0] == len(genomes)
+    assert (df_fast.coarse_rank == 1).all()
+    assert df_fast.sort_values('distance').match_id.iloc[0] == db.names[7]
+
+
+def test_clustered_native_dist_reports_cluster_members():
+    rng = np.random.default_rng(13)
+    genomes = []
+    for _ in range(10):
+        genome = random_genome(rng, 20000)
+        # near-identical strains differing only at their ends
+        genomes += [genome, genome[:19900] + random_genome(rng, 100), genome[100:]]
+    db = make_sketch_db(genomes, s=400)
+    clusters = cluster_sketches(db, max_distance=0.01)
+    assert len(clusters) == 10
+    assert clusters.sizes.tolist() == [3] * 10
+
+    query_hashes = np.unique(kmer_hashes([genomes[12][:15000]]))[:400]
+    df_full = NativeDist(db).dist_table(query_hashes, 15000).sort_values('distance', kind='stable')
+    df_clustered = ClusteredNativeDist(db, clusters).dist_table(query_hashes, 15000, min_members=5)
+    df_clustered = df_clustered.sort_values('distance', kind='stable')
+    # unrelated random genomes share no hashes with the query so only its own cluster is expanded
+    assert df_clustered.shape[0] == 3
+    assert df_clustered.match_id.tolist()[:3] == df_full.match_id.tolist()[:3]
+    assert df_clustered.matching.tolist()[:3] == df_full.matching.tolist()[:3]
+
+
+def test_pairwise_blocks_match_exact_distances():
+    rng = np.random.default_rng(17)
+    genomes = [random_genome(rng, int(n)) for n in rng.integers(1000, 8000, 12)]
+    genomes += [g[:len(g) // 2] + random_genome(rng, 500) for g in genomes[:5]]
+    db = make_sketch_db(genomes, s=200)
+    dist = PairwiseDist(db, block_size=5)
+
+    matrix = pd.concat(dist.matrix_blocks(), ignore_index=True)
+    assert matrix.shape == (len(db), len(db) + 1)
+    assert matrix['sample'].tolist() == db.names.tolist()
+    for row in range(len(db)):
+        common, denom = exact_common_and_denom(db.row_hashes(row), db, np.arange(len(db)))
+        assert np.allclose(matrix.iloc[row, 1:].astype(float), mash_distance(common, denom, 16), rtol=1e-5)
+
+    edges = pd.concat(dist.edge_blocks(max_distance=0.2), ignore_index=True)
+    expected = {(db.names[i], db.names[12 + i]) for i in range(5)}
+    assert set(zip(edges.sample1, edges.sample2)) == expected
+
+
+def test_streaming_sketch_matches_one_shot_sketch_with_min_copies():
+    rng = np.random.default_rng(19)
+    genome = random_genome(rng, 5000)
+    reads = [genome[i:i + 150] for i in rng.integers(0, len(genome) - 150, 300)]
+    state = SketchState(sketch_size=100, min_copies=3)
+    for start in range(0, len(reads), 40):
+        state.add_sequences(reads[start:start + 40])
+
+    hashes, counts = np.unique(np.concatenate([kmer_hashes([r]) for r in reads]), return_counts=True)
+    assert state.hashes.tolist() == hashes[counts >= 3][:100].tolist()
+    assert state.counts.tolist() == counts[counts >= 3][:100].tolist()
+    assert state.bases == 300 * 150
+
+
+def test_sparse_sketch_length_estimated_like_mash():
+    # a single k-mer with Mash hash 28049; `mash sketch -r` estimates the length as 2^32 * 1 / 28049
+    state = SketchState(sketch_size=400)
+    state.add_sequences([b'ACCTTTCCATGCCAGC'])
+    assert state.hashes.tolist() == [28049]
+    assert state.estimated_length() == 153123
+    assert state.to_sketch_db('sample', reads=True).lengths[0] == 153123
+
+
+def test_sketch_fastqs_and_msh_encoding(tmp_path):
+    rng = np.random.default_rng(23)
+    genome = random_genome(rng, 5000)
+    fastq = tmp_path / 'reads.fastq'
+    with open(fastq, 'w') as f:
+        for i, start in enumerate(rng.integers(0, len(genome) - 150, 300)):
+            f.write('@r{}\n{}\n+\n{}\n'.format(i, genome[start:start + 150].decode(), 'I' * 150))
+    state = sketch_fastqs([str(fastq)], s=100, m=3, parallelism=2)
+    db = state.to_sketch_db('sample', reads=True)
+    assert db.row_hashes(0).tolist() == state.hashes.tolist()
+    assert db.lengths[0] == state.estimated_length()
+
+    data = msh_bytes(db, counts=[state.counts])
+    n_segments, n_words = np.frombuffer(data[:8], dtype='<u4')
+    assert n_segments == 0 and 8 * (n_words + 1) == len(data)
+    msh = decode_msh(data[8:])
+    assert (msh['kmer_size'], msh['sketch_size'], msh['hash_seed'], msh['alphabet']) == (16, 100, 42, 'ACGT')
+    (ref,) = msh['references']
+    assert ref['name'] == 'sample' and ref['comment'] == ''
+    assert ref['length'] == db.lengths[0]
+    assert ref['hashes'] == state.hashes.tolist()
+    assert ref['counts'] == state.counts.tolist() and ref['counts_sorted']
+
+    genomes_db = make_sketch_db([random_genome(rng, n) for n in (3000, 4000, 5000)], s=50)
+    msh = decode_msh(msh_bytes(genomes_db)[8:])
+    assert [ref['name'] for ref in msh['references']] == genomes_db.names.tolist()
+    assert [ref['length'] for ref in msh['references']] == [3000, 4000, 5000]
+    for i, ref in enumerate(msh['references']):
+        assert ref['hashes'] == genomes_db.row_hashes(i).tolist()
+        assert ref['counts'] is None and not ref['counts_sorted']
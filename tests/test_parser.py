@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+
+import pickle
+
+import numpy as np
+import pandas as pd
+
+from refseq_masher.mash.parser import read_mash_table, mash_dist_output_to_dataframe, \
+    mash_dist_table_to_dataframe, mash_screen_output_to_dataframe, parse_refseq_info, MASH_SCREEN_COLUMNS
+from refseq_masher.taxonomy import ncbi_taxonomy_info, merge_ncbi_taxonomy_info
+from refseq_masher.utils import concat_results
+
+MATCH_1 = './rcn/refseq-NZ-1147754-PRJNA224116-.-GCF_000313715.1-.-Salmonella_enterica_subsp._enterica_serovar_' \
+          'Enteritidis_str._LA5.fna'
+MATCH_2 = './rcn/refseq-NZ-562-PRJNA1-SAMN2-GCF_2.1-.-Escherichia_coli.fna'
+
+
+def test_mash_dist_output_first_line_is_not_a_header():
+    out = '{}\tq.msh\t0.0212\t1.5e-300\t250/400\n{}\tq.msh\t0\t0\t400/400\n'.format(MATCH_1, MATCH_2).encode()
+    df = mash_dist_output_to_dataframe(out)
+    assert df.match_id.tolist() == [MATCH_2, MATCH_1]
+    assert df.taxid.tolist() == [562, 1147754]
+    assert df.pvalue.tolist() == [0.0, 1.5e-300]
+    assert df.matching.tolist() == ['400/400', '250/400']
+    assert df.serovar.isna().tolist() == [True, False]
+    assert mash_dist_output_to_dataframe(out.decode()).equals(df)
+
+
+def test_mash_screen_output_parsing():
+    out = '0.98\t390/400\t12\t0\t{}\t[3 seqs] Salmonella\n0.91\t120/400\t2\t1e-10\t{}\t\n'.format(MATCH_1, MATCH_2)
+    df = mash_screen_output_to_dataframe(out.encode())
+    assert df.shape[0] == 2
+    assert df.median_multiplicity.tolist() == [12, 2]
+    assert df.match_comment.isna().tolist() == [False, True]
+    # lines with different numbers of fields are read with pandas
+    ragged = read_mash_table(out.encode().replace(b'\t\n', b'\n'), MASH_SCREEN_COLUMNS)
+    assert ragged.identity.dtype == np.float64
+    assert ragged.match_comment.tolist()[0] == '[3 seqs] Salmonella'
+    assert ragged.match_comment.isna().tolist() == [False, True]
+    assert mash_screen_output_to_dataframe(b'') is None
+
+
+def test_column_projection():
+    assert parse_refseq_info(MATCH_1, columns=['sample', 'serovar']) == dict(match_id=MATCH_1, taxid=1147754,
+                                                                             serovar='Enteritidis')
+    out = '{}\tq.msh\t0.0212\t1.5e-300\t250/400\n'.format(MATCH_1).encode()
+    df = mash_dist_output_to_dataframe(out, columns=['sample', 'distance', 'assembly_accession'])
+    assert sorted(df.columns) == ['assembly_accession', 'distance', 'match_id', 'taxid']
+    df_tax_info = ncbi_taxonomy_info(df.taxid, columns=['top_taxonomy_name'])
+    assert df_tax_info.columns.tolist() == ['taxid', 'top_taxonomy_name']
+    assert merge_ncbi_taxonomy_info(df, columns=['sample', 'distance']) is df
+
+
+def test_top_n_results_keep_only_their_categories():
+    n = 20000
+    match_ids = ['./rcn/refseq-NZ-{0}-PRJNA{0}-SAMN{0}-GCF_{0}.1-.-Genome_{0}.fna'.format(i) for i in range(n)]
+    df = pd.DataFrame(dict(match_id=match_ids,
+                           distance=np.linspace(0, 1, n),
+                           pvalue=np.zeros(n),
+                           matching=['{}/400'.format(i % 400) for i in range(n)]))
+    df = mash_dist_table_to_dataframe(df).head(5)
+    df['sample'] = 's1'
+    dfout = concat_results([df, df.assign(sample='s2')])
+    assert isinstance(dfout.match_id.dtype, pd.CategoricalDtype)
+    assert len(dfout.match_id.cat.categories) == 5
+    assert len(dfout.matching.cat.categories) == 5
+    assert dfout.memory_usage(deep=True).sum() < 20000
+    assert len(pickle.dumps(dfout)) < 20000
@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from refseq_masher.store import ResultsStore
+
+
+def test_results_store_append_and_query(tmpdir):
+    path = str(tmpdir.join('results.db'))
+    df1 = pd.DataFrame(dict(sample=['s1', 's2'],
+                            taxid=[562, 1280],
+                            assembly_accession=['GCF_1', 'GCF_2'],
+                            distance=np.array([0.01, 0.2], dtype=np.float32)))
+    df2 = pd.DataFrame(dict(sample=['s1'], taxid=[562], assembly_accession=['GCF_3'], serovar=['Typhi']))
+    with ResultsStore(path, batch_size=1) as store:
+        run1 = store.append('matches', df1, dict(kmer_size=16))
+        run2 = store.append('matches', df2)
+        assert 'serovar' in store.table_columns('matches')
+        indexes = {row[1] for row in store.conn.execute("PRAGMA index_list('matches')")}
+        assert {'idx_matches_sample', 'idx_matches_taxid', 'idx_matches_assembly_accession',
+                'idx_matches_run_time'} <= indexes
+        df = store.query('matches', samples=['s1'], taxids=[562])
+        assert df.run_id.tolist() == [run1, run2]
+        assert df.assembly_accession.tolist() == ['GCF_1', 'GCF_3']
+        assert df.distance.iloc[0] == 0.01
+        assert pd.isna(df.serovar.iloc[0])
+        assert store.query('matches', since='9999-01-01').empty
+        assert store.query('matches', until='9999-01-01', limit=2).shape[0] == 2
+        assert store.runs().n_rows.tolist() == [2, 1]
+        assert store.query('contains').empty
+
+
+def test_results_store_failed_append_stores_nothing(tmpdir):
+    path = str(tmpdir.join('results.db'))
+    df = pd.DataFrame(dict(sample=['s1', 's2', 's3'], taxid=[562, 1280, object()]))
+    with ResultsStore(path, batch_size=1) as store:
+        with pytest.raises(Exception):
+            store.append('matches', df)
+        assert store.runs().empty
+        assert store.query('matches').empty
@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+
+import threading
+import time
+
+import pandas as pd
+import pytest
+
+from refseq_masher.utils import bounded_imap, concat_results, load_once, pipelined
+
+
+def test_concat_results_compact_dtypes_keep_output_text():
+    df1 = pd.DataFrame(dict(sample='s1', match_id=['a', 'b'], taxid=[28901, 562], distance=[0.0123456, 0.1],
+                            pvalue=[1.5e-300, 0.0], serovar=[None, None]))
+    df2 = pd.DataFrame(dict(sample='s2', match_id=['b', 'c'], taxid=[562, 1280], distance=[0.5, 1.0],
+                            pvalue=[0.01, 1.0], serovar=['Enteritidis', None]))
+    df = concat_results([df1, df2])
+    assert df.taxid.dtype == 'int32'
+    assert df.distance.dtype == 'float32'
+    assert df.pvalue.dtype == 'float64'
+    for col in ['sample', 'match_id', 'serovar']:
+        assert isinstance(df[col].dtype, pd.CategoricalDtype)
+    assert df.to_csv(sep='\t', index=None) == pd.concat([df1, df2]).to_csv(sep='\t', index=None)
+
+
+def test_pipelined_keeps_order_and_raises_stage_errors():
+    stages = [lambda x: x + 1, lambda x: x * 2, str]
+    for queue_depth in [0, 1, 3]:
+        assert list(pipelined(range(20), stages, queue_depth=queue_depth)) == [str((x + 1) * 2) for x in range(20)]
+
+    def fail_on_5(x):
+        if x == 5:
+            raise ValueError('bad sample')
+        return x
+
+    results = []
+    with pytest.raises(ValueError, match='bad sample'):
+        for x in pipelined(range(20), [fail_on_5, lambda x: x]):
+            results.append(x)
+    assert results == list(range(5))
+
+
+def test_load_once_loads_once_from_concurrent_workers():
+    calls = []
+    lock = threading.Lock()
+
+    @load_once
+    def load(name):
+        with lock:
+            calls.append(name)
+        time.sleep(0.05)
+        return [name]
+
+    results = list(bounded_imap(lambda _: load('db'), range(8), n_workers=8))
+    assert calls == ['db']
+    assert all(result is results[0] for result in results)
+    assert load(name='other') == ['other']